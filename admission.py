@@ -0,0 +1,104 @@
+
+import collections
+import math
+import threading
+import time
+
+import flask
+
+
+class TokenBuckets():
+  '''One token bucket per key, refilling at |rate| tokens a second.
+
+  Each bucket holds at most |burst| tokens. Only the |capacity| most recently
+  used keys are remembered; a forgotten key starts over with a full bucket,
+  which is what it would have refilled to anyway. |clock| is only replaced
+  by tests.
+  '''
+  def __init__(self, rate:float, burst:float, capacity:int = 65536,
+               clock=time.monotonic):
+    self._rate = rate
+    self._burst = burst
+    self._capacity = capacity
+    self._clock = clock
+    self._lock = threading.Lock()
+    self._buckets = collections.OrderedDict()
+
+  def _Add(self, key, delta:float) -> float:
+    '''Adds |delta| to |key|'s tokens unless that leaves it below 0.
+
+    Returns 0 if it did, or how long until it could.
+    '''
+    now = self._clock()
+    with self._lock:
+      tokens, updated = self._buckets.pop(key, (self._burst, now))
+      tokens = min(self._burst, tokens + (now - updated) * self._rate)
+      wait = 0
+      if tokens + delta >= 0:
+        tokens = min(self._burst, tokens + delta)
+      else:
+        wait = -(tokens + delta) / self._rate
+      self._buckets[key] = (tokens, now)
+      while len(self._buckets) > self._capacity:
+        self._buckets.popitem(last=False)
+      return wait
+
+  def Take(self, key) -> float:
+    '''Takes a token for |key|. Returns 0, or how long until one is free.'''
+    return self._Add(key, -1)
+
+  def Refund(self, key):
+    '''Gives back a token taken for a request that was turned away.'''
+    self._Add(key, 1)
+
+
+def TooManyRequests(retry_after:float) -> flask.Response:
+  '''A 429 telling the client when to come back, in whole seconds.'''
+  return flask.Response(
+    'Too many requests', 429,
+    {'Retry-After': str(max(1, math.ceil(retry_after)))})
+
+
+class Admission():
+  '''Rate limits routes by client and by game before their handlers run.
+
+  The client is the uid cookie, or the remote address without one; nothing
+  is looked up, so a rejected request never reaches a DAO. Limits are kept
+  per process.
+  '''
+  def __init__(self):
+    self._limits = {}
+
+  def Limit(self, method:str, rule:str, per_client:TokenBuckets = None,
+            per_game:TokenBuckets = None):
+    '''Applies |per_client| and |per_game| to |method| requests for |rule|.
+
+    The same TokenBuckets can be given for several routes to share a budget.
+    '''
+    self._limits[(method, rule)] = (per_client, per_game)
+
+  def Check(self) -> float:
+    '''Returns 0 to admit the current request, or seconds to retry after.'''
+    request = flask.request
+    if request.url_rule is None:
+      return 0
+    limits = self._limits.get((request.method, request.url_rule.rule))
+    if limits is None:
+      return 0
+    per_client, per_game = limits
+    client = request.cookies.get('uid') or request.remote_addr
+    if per_client and (wait := per_client.Take(client)):
+      return wait
+    if per_game and (gid := (request.view_args or {}).get('gid')):
+      if wait := per_game.Take(gid):
+        # The client did nothing wrong; keep its budget for the next try.
+        if per_client:
+          per_client.Refund(client)
+        return wait
+    return 0
+
+  def Install(self, app:flask.Flask):
+    def Admit():
+      if wait := self.Check():
+        return TooManyRequests(wait)
+    app.before_request(Admit)
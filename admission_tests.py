@@ -0,0 +1,94 @@
+
+import flask
+
+from impulse.testing import unittest
+from what2pick import admission
+
+
+class FakeClock():
+  def __init__(self):
+    self.now = 100.0
+
+  def __call__(self) -> float:
+    return self.now
+
+
+class TokenBucketsUnittests(unittest.TestCase):
+  def setup(self):
+    self._clock = FakeClock()
+    self._buckets = admission.TokenBuckets(
+      rate=2, burst=3, capacity=2, clock=self._clock)
+
+  def test_burstThenRate(self):
+    for _ in range(3):
+      self.assertEqual(0, self._buckets.Take('a'))
+    self.assertEqual(0.5, self._buckets.Take('a'))
+    self._clock.now += 0.25
+    self.assertEqual(0.25, self._buckets.Take('a'))
+    self._clock.now += 0.25
+    self.assertEqual(0, self._buckets.Take('a'))
+    self.assertEqual(0.5, self._buckets.Take('a'))
+
+  def test_refillIsCappedAtBurst(self):
+    self._buckets.Take('a')
+    self._clock.now += 60
+    for _ in range(3):
+      self.assertEqual(0, self._buckets.Take('a'))
+    self.assertGreater(self._buckets.Take('a'), 0)
+
+  def test_refundReturnsAToken(self):
+    for _ in range(3):
+      self._buckets.Take('a')
+    self._buckets.Refund('a')
+    self.assertEqual(0, self._buckets.Take('a'))
+    self.assertGreater(self._buckets.Take('a'), 0)
+    self._buckets.Refund('b')
+    for _ in range(3):
+      self.assertEqual(0, self._buckets.Take('b'))
+    self.assertGreater(self._buckets.Take('b'), 0)
+
+  def test_keysAreIndependentAndForgotten(self):
+    for _ in range(3):
+      self._buckets.Take('a')
+    self.assertEqual(0, self._buckets.Take('b'))
+    self.assertEqual(0, self._buckets.Take('c'))
+    self.assertEqual(0, self._buckets.Take('a'))
+
+
+class AdmissionUnittests(unittest.TestCase):
+  def setup(self):
+    self._clock = FakeClock()
+    self._per_client = admission.TokenBuckets(
+      rate=1, burst=2, clock=self._clock)
+    self._per_game = admission.TokenBuckets(
+      rate=1, burst=1, clock=self._clock)
+    limits = admission.Admission()
+    limits.Limit('GET', '/p/<gid>/poll', self._per_client, self._per_game)
+    app = flask.Flask(__name__)
+    app.add_url_rule('/p/<gid>/poll', 'poll', lambda gid: 'OK')
+    app.add_url_rule('/other', 'other', lambda: 'OK')
+    limits.Install(app)
+    self._client = app.test_client()
+
+  def _Poll(self, gid:str, uid:str):
+    self._client.set_cookie('uid', uid)
+    return self._client.get(f'/p/{gid}/poll')
+
+  def test_clientLimit(self):
+    self.assertEqual(200, self._Poll('g1', 'me').status_code)
+    self.assertEqual(200, self._Poll('g2', 'me').status_code)
+    res = self._Poll('g3', 'me')
+    self.assertEqual(429, res.status_code)
+    self.assertEqual('1', res.headers['Retry-After'])
+    self.assertEqual(200, self._Poll('g3', 'you').status_code)
+
+  def test_gameRejectionKeepsClientToken(self):
+    self.assertEqual(200, self._Poll('g1', 'you').status_code)
+    self.assertEqual(429, self._Poll('g1', 'me').status_code)
+    self.assertEqual(429, self._Poll('g1', 'me').status_code)
+    self.assertEqual(200, self._Poll('g2', 'me').status_code)
+    self.assertEqual(200, self._Poll('g3', 'me').status_code)
+
+  def test_unlimitedRoutesAreAdmitted(self):
+    for _ in range(5):
+      self.assertEqual(200, self._client.get('/other').status_code)
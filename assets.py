@@ -0,0 +1,74 @@
+
+import gzip
+import hashlib
+import mimetypes
+import os
+
+import flask
+
+
+# A year, the longest lifetime caches are expected to honour.
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+class Asset():
+  '''One file, with the fingerprinted name it is served under.'''
+  def __init__(self, name:str, body:bytes):
+    digest = hashlib.sha256(body).hexdigest()[:16]
+    stem, ext = os.path.splitext(name)
+    self.name = name
+    self.fingerprinted = f'{stem}.{digest}{ext}'
+    self.etag = digest
+    self.body = body
+    self.gzipped = gzip.compress(body, compresslevel=9, mtime=0)
+    self.mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+
+class AssetBundle():
+  '''Fingerprinted, precompressed copies of the assets in |directory|.
+
+  Everything is read, hashed and compressed once when the bundle is built.
+  A file's URL changes whenever its contents do, so responses can be cached
+  forever; the gzipped copy is only kept if it is actually smaller.
+  '''
+  def __init__(self, directory:str, prefix:str = '/assets',
+               extensions:tuple = ('.css', '.js')):
+    self._prefix = prefix
+    self._by_name = {}
+    self._by_fingerprint = {}
+    for name in sorted(os.listdir(directory)):
+      if not name.endswith(extensions):
+        continue
+      with open(os.path.join(directory, name), 'rb') as f:
+        asset = Asset(name, f.read())
+      if len(asset.gzipped) >= len(asset.body):
+        asset.gzipped = None
+      self._by_name[name] = asset
+      self._by_fingerprint[asset.fingerprinted] = asset
+
+  def Url(self, name:str) -> str:
+    '''The URL to reference |name| by in templates.'''
+    return f'{self._prefix}/{self._by_name[name].fingerprinted}'
+
+  def Serve(self, fingerprinted:str) -> flask.Response:
+    asset = self._by_fingerprint.get(fingerprinted)
+    if asset is None:
+      flask.abort(404)
+    gzipped = asset.gzipped and flask.request.accept_encodings['gzip']
+    etag = f'{asset.etag}-gzip' if gzipped else asset.etag
+    if flask.request.if_none_match.contains(etag):
+      res = flask.make_response('', 304)
+    else:
+      res = flask.make_response(asset.gzipped if gzipped else asset.body)
+      if gzipped:
+        res.headers['Content-Encoding'] = 'gzip'
+    res.mimetype = asset.mimetype
+    res.set_etag(etag)
+    res.headers['Cache-Control'] = IMMUTABLE
+    res.headers['Vary'] = 'Accept-Encoding'
+    return res
+
+  def Install(self, app:flask.Flask):
+    '''Serves the bundle from |app| and gives its templates asset(name).'''
+    app.add_url_rule(f'{self._prefix}/<fingerprinted>', 'assets', self.Serve)
+    app.jinja_env.globals['asset'] = self.Url
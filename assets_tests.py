@@ -0,0 +1,68 @@
+
+import shutil
+import tempfile
+
+import flask
+
+from impulse.testing import unittest
+from what2pick import assets
+
+
+class AssetBundleUnittests(unittest.TestCase):
+  def setup(self):
+    self._dir = tempfile.mkdtemp()
+    self._css = b'body { color: black; }\n' * 50
+    with open(f'{self._dir}/site.css', 'wb') as f:
+      f.write(self._css)
+    with open(f'{self._dir}/tiny.js', 'wb') as f:
+      f.write(b'1')
+    with open(f'{self._dir}/notes.txt', 'wb') as f:
+      f.write(b'not an asset')
+    self._bundle = assets.AssetBundle(self._dir)
+    app = flask.Flask(__name__)
+    self._bundle.Install(app)
+    self._client = app.test_client()
+
+  def cleanup(self):
+    shutil.rmtree(self._dir)
+
+  def test_urlsChangeWithContents(self):
+    url = self._bundle.Url('site.css')
+    self.assertRegex(url, r'^/assets/site\.[0-9a-f]{16}\.css$')
+    with open(f'{self._dir}/site.css', 'ab') as f:
+      f.write(b'p {}\n')
+    self.assertNotEqual(url, assets.AssetBundle(self._dir).Url('site.css'))
+    with self.assertRaises(KeyError):
+      self._bundle.Url('notes.txt')
+
+  def test_servesGzipWhenAccepted(self):
+    url = self._bundle.Url('site.css')
+    res = self._client.get(url, headers={'Accept-Encoding': 'gzip'})
+    self.assertEqual(200, res.status_code)
+    self.assertEqual('gzip', res.headers['Content-Encoding'])
+    self.assertEqual(assets.IMMUTABLE, res.headers['Cache-Control'])
+    self.assertEqual('Accept-Encoding', res.headers['Vary'])
+    self.assertTrue(res.headers['Content-Type'].startswith('text/css'))
+    self.assertLess(len(res.data), len(self._css))
+    res = self._client.get(url)
+    self.assertNotIn('Content-Encoding', res.headers)
+    self.assertEqual(self._css, res.data)
+
+  def test_smallFilesAreNotGzipped(self):
+    res = self._client.get(self._bundle.Url('tiny.js'),
+                           headers={'Accept-Encoding': 'gzip'})
+    self.assertNotIn('Content-Encoding', res.headers)
+    self.assertEqual(b'1', res.data)
+
+  def test_matchingETagGets304(self):
+    url = self._bundle.Url('site.css')
+    etag = self._client.get(url).headers['ETag']
+    res = self._client.get(url, headers={'If-None-Match': etag})
+    self.assertEqual(304, res.status_code)
+    self.assertEqual(b'', res.data)
+    res = self._client.get(url, headers={'If-None-Match': etag,
+                                         'Accept-Encoding': 'gzip'})
+    self.assertEqual(200, res.status_code)
+
+  def test_unknownAssetsAreNotFound(self):
+    self.assertEqual(404, self._client.get('/assets/site.css').status_code)
@@ -1,31 +1,134 @@
+const game_section = document.getElementById('game');
+const gameid = game_section.attributes['gameid'].value;
+
+let game_state = null;
+let game_version = null;
+let refreshing = false;
+let refresh_again = false;
+
+function post_action(gameopt, data, onerr) {
+  fetch(`/p/${gameid}/${gameopt}`, {
+    method: 'POST',
+    headers: {'Content-Type': 'application/json'},
+    body: JSON.stringify(data)
+  })
+  .then(e => {
+    if (e.status !== 200)
+      return e.text();
+  })
+  .then(err => {
+    if (err && err !== 'OK')
+      onerr(err);
+    refresh_state();
+  });
+}
 
 function do_on_click(el, get_data, gameopt, onerr) {
   el.addEventListener('click', e => {
-    const gameid = e.target.attributes['gameid'].value;
-    if (!gameid)
-      return;
-
     const data = get_data(e.target);
     if (data === null)
       return;
+    post_action(gameopt, data, onerr);
+  });
+}
+
+function do_on_child_click(el, classname, get_data, gameopt, onerr) {
+  el.addEventListener('click', e => {
+    if (e.target.classList.contains(classname))
+      post_action(gameopt, get_data(e.target), onerr);
+  });
+}
+
+function apply_diff(diff) {
+  for (const [key, value] of Object.entries(diff)) {
+    if (key !== 'options') {
+      game_state[key] = value;
+      continue;
+    }
+    for (const [start, end, replacement] of value.slice().reverse())
+      game_state.options.splice(start, end - start, ...replacement);
+  }
+}
+
+function make_icon(classname, attr, value) {
+  const icon = document.createElement('i');
+  icon.className = `fa ${classname}`;
+  icon.setAttribute(attr, value);
+  return icon;
+}
+
+function make_list_item(classname, textclass, text, icon) {
+  const li = document.createElement('li');
+  li.className = classname;
+  if (icon)
+    li.appendChild(icon);
+  const span = document.createElement('span');
+  span.className = textclass;
+  span.textContent = text;
+  li.appendChild(span);
+  return li;
+}
+
+function show(id, visible) {
+  document.getElementById(id).style.display = visible ? '' : 'none';
+}
 
-    fetch(`/p/${gameid}/${gameopt}`, {
-      method: 'POST',
-      headers: {'Content-Type': 'application/json'},
-      body: JSON.stringify(data)
-    })
-    .then(e => {
-      if (e.status === 200)
-        window.location.reload();
-      else
-        return e.text();
-    })
-    .then(err => {
-      if (err && err !== 'OK')
-        onerr(err);
-      else
-        window.location.reload();
-    });
+function render(viewer) {
+  const turn = document.getElementById('turn-status');
+  const current = game_state.players.concat(game_state.watchers).find(
+    ([uid, _]) => uid === game_state.next_player);
+  if (game_state.decided)
+    turn.textContent = 'A decision has been made!';
+  else
+    turn.textContent = `It's currently ${current ? current[1] : ''}'s turn`;
+  show('turn-status', !viewer.can_add);
+  show('add-new-item', viewer.can_add);
+  show('select-item', viewer.can_select);
+  show('adm-skip', viewer.am_admin);
+  show('adm-toggle', viewer.am_admin);
+  document.getElementById('adm-toggle').textContent =
+    `${game_state.kick_on_last_remove ? 'Disable' : 'Enable'} Kick On Remove`;
+
+  document.getElementById('game-items').replaceChildren(
+    ...game_state.options.map((option, index) => make_list_item(
+      'item', 'option-name', option,
+      viewer.can_remove && make_icon('fa-trash', 'option', index + 1))));
+
+  const players = document.getElementById('players');
+  const spectators = document.getElementById('spectators-label');
+  players.replaceChildren(
+    players.firstElementChild,
+    ...game_state.players.map(([uid, name]) => make_list_item(
+      'player', 'player-name', name,
+      viewer.am_admin && make_icon('fa-gavel', 'name', uid))),
+    spectators,
+    ...game_state.watchers.map(([_, name]) => make_list_item(
+      'player', 'player-name', name)));
+}
+
+function refresh_state() {
+  if (refreshing) {
+    refresh_again = true;
+    return;
+  }
+  refreshing = true;
+  const since = game_version === null ? '' : `?since=${game_version}`;
+  fetch(`/p/${gameid}/state${since}`)
+  .then(e => e.json())
+  .then(body => {
+    if (body.state)
+      game_state = body.state;
+    else
+      apply_diff(body.diff);
+    game_version = body.version;
+    render(body.viewer);
+  })
+  .finally(() => {
+    refreshing = false;
+    if (refresh_again) {
+      refresh_again = false;
+      refresh_state();
+    }
   });
 }
 
@@ -48,14 +151,16 @@ do_on_click(document.getElementById('adm-toggle'), (t) => {
   return {};
 }, 'toggle_dec_mode', () => {});
 
-for (elem of document.getElementsByClassName('fa-trash')) {
-  do_on_click(elem, (t) => {
-    return {'option': parseInt(t.attributes['option'].value) - 1};
-  }, 'del', alert);
-}
+do_on_child_click(document.getElementById('game-items'), 'fa-trash', (t) => {
+  return {'option': parseInt(t.attributes['option'].value) - 1};
+}, 'del', alert);
+
+do_on_child_click(document.getElementById('players'), 'fa-gavel', (t) => {
+  return {'target': t.attributes['name'].value};
+}, 'adm_kick', alert);
 
-for (elem of document.getElementsByClassName('fa-gavel')) {
-  do_on_click(elem, (t) => {
-    return {'target': t.attributes["name"].value};
-  }, 'adm_kick', alert);
-}
\ No newline at end of file
+// The page itself is not a state we can diff against, so the first refresh
+// always fetches the full state and only later ones ask for a diff.
+const game_events = new EventSource(
+  `/p/${gameid}/events?since=${game_section.attributes['version'].value}`);
+game_events.addEventListener('reload', refresh_state);
@@ -0,0 +1,133 @@
+
+import bisect
+import contextlib
+import math
+import threading
+import time
+
+
+DEFAULT_BUCKETS = (
+  .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+def _Escape(value) -> str:
+  return (str(value).replace('\\', r'\\')
+                    .replace('"', r'\"')
+                    .replace('\n', r'\n'))
+
+
+def _Labels(names:tuple, values:tuple) -> str:
+  if not names:
+    return ''
+  pairs = ','.join(f'{n}="{_Escape(v)}"' for n, v in zip(names, values))
+  return '{' + pairs + '}'
+
+
+def _Number(value) -> str:
+  if value == math.inf:
+    return '+Inf'
+  return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram():
+  '''Counts observations into fixed buckets, one series per label value set.'''
+  def __init__(self, name:str, doc:str, labels:tuple = (),
+               buckets:tuple = DEFAULT_BUCKETS):
+    self._name = name
+    self._doc = doc
+    self._labels = tuple(labels)
+    self._buckets = tuple(sorted(buckets))
+    self._lock = threading.Lock()
+    self._series = {}
+
+  def Observe(self, value:float, *labels):
+    bucket = bisect.bisect_left(self._buckets, value)
+    with self._lock:
+      series = self._series.get(labels)
+      if series is None:
+        series = self._series[labels] = [[0] * (len(self._buckets) + 1), 0]
+      series[0][bucket] += 1
+      series[1] += value
+
+  @contextlib.contextmanager
+  def Time(self, *labels):
+    '''Observes how long the with block took, in seconds.'''
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.Observe(time.perf_counter() - start, *labels)
+
+  def Render(self) -> list:
+    lines = [f'# HELP {self._name} {self._doc}',
+             f'# TYPE {self._name} histogram']
+    with self._lock:
+      series = sorted((k, list(c), s) for k, (c, s) in self._series.items())
+    bounds = self._buckets + (math.inf,)
+    for labels, counts, total in series:
+      cumulative = 0
+      for bound, count in zip(bounds, counts):
+        cumulative += count
+        le = _Labels(self._labels + ('le',), labels + (_Number(bound),))
+        lines.append(f'{self._name}_bucket{le} {cumulative}')
+      labeled = _Labels(self._labels, labels)
+      lines.append(f'{self._name}_sum{labeled} {_Number(total)}')
+      lines.append(f'{self._name}_count{labeled} {cumulative}')
+    return lines
+
+
+class Gauge():
+  '''A value read from |callback| whenever the metrics are rendered.
+
+  Without labels the callback returns a number, otherwise a dict from label
+  value tuples to numbers.
+  '''
+  def __init__(self, name:str, doc:str, callback, labels:tuple = ()):
+    self._name = name
+    self._doc = doc
+    self._callback = callback
+    self._labels = tuple(labels)
+
+  def Render(self) -> list:
+    lines = [f'# HELP {self._name} {self._doc}',
+             f'# TYPE {self._name} gauge']
+    values = self._callback()
+    if not self._labels:
+      values = {(): values}
+    for labels, value in sorted(values.items()):
+      lines.append(
+        f'{self._name}{_Labels(self._labels, labels)} {_Number(value)}')
+    return lines
+
+
+class Registry():
+  '''Named metrics, rendered together in the Prometheus text format.'''
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._metrics = {}
+
+  def Histogram(self, name:str, doc:str, labels:tuple = (),
+                buckets:tuple = DEFAULT_BUCKETS) -> Histogram:
+    '''Returns the histogram called |name|, creating it the first time.'''
+    with self._lock:
+      if name not in self._metrics:
+        self._metrics[name] = Histogram(name, doc, labels, buckets)
+      return self._metrics[name]
+
+  def Gauge(self, name:str, doc:str, callback, labels:tuple = ()) -> Gauge:
+    '''Registers a gauge, replacing any earlier one called |name|.'''
+    with self._lock:
+      self._metrics[name] = Gauge(name, doc, callback, labels)
+      return self._metrics[name]
+
+  def Render(self) -> str:
+    with self._lock:
+      metrics = list(self._metrics.values())
+    lines = []
+    for metric in metrics:
+      lines.extend(metric.Render())
+    return '\n'.join(lines) + '\n'
+
+
+# The registry served at /metrics.
+REGISTRY = Registry()
@@ -0,0 +1,47 @@
+
+from impulse.testing import unittest
+from what2pick import metrics
+
+
+class MetricsUnittests(unittest.TestCase):
+  def setup(self):
+    self._registry = metrics.Registry()
+
+  def test_histogramBucketsAreCumulative(self):
+    histogram = self._registry.Histogram(
+      'latency', 'How long.', ('route',), buckets=(1, 5))
+    histogram.Observe(0.5, '/a')
+    histogram.Observe(3, '/a')
+    histogram.Observe(10, '/a')
+    self.assertEqual([
+      '# HELP latency How long.',
+      '# TYPE latency histogram',
+      'latency_bucket{route="/a",le="1"} 1',
+      'latency_bucket{route="/a",le="5"} 2',
+      'latency_bucket{route="/a",le="+Inf"} 3',
+      'latency_sum{route="/a"} 13.5',
+      'latency_count{route="/a"} 3',
+    ], histogram.Render())
+
+  def test_registryReusesHistograms(self):
+    first = self._registry.Histogram('latency', 'How long.')
+    self.assertIs(first, self._registry.Histogram('latency', 'Ignored.'))
+
+  def test_timeObservesTheBlock(self):
+    histogram = self._registry.Histogram('latency', 'How long.')
+    with histogram.Time():
+      pass
+    self.assertIn('latency_count 1', histogram.Render())
+
+  def test_labelsAreEscaped(self):
+    gauge = self._registry.Gauge(
+      'open', 'Open things.', lambda: {('a"b\\c\nd',): 2}, ('name',))
+    self.assertEqual('open{name="a\\"b\\\\c\\nd"} 2', gauge.Render()[-1])
+
+  def test_renderAll(self):
+    self._registry.Gauge('size', 'Items.', lambda: 4)
+    self._registry.Histogram('latency', 'How long.', buckets=(1,))
+    text = self._registry.Render()
+    self.assertTrue(text.endswith('\n'))
+    self.assertIn('# TYPE size gauge\nsize 4\n', text)
+    self.assertIn('# TYPE latency histogram\n', text)
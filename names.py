@@ -1,24 +1,154 @@
-
+import mmap
+import os
 import random
+import stat
+import struct
+import sys
+import tempfile
+import threading
 
 from impulse.util import resources
 
 
-NAMELIST = []
+class NameTable():
+  '''A read-only list of names, memory-mapped from its compiled form.
+
+  The file is a 4 byte magic and a little-endian uint32 count, then count + 1
+  uint32 offsets into the utf-8 names that follow. Looking a name up reads two
+  offsets and one slice; nothing is parsed up front, and every process that
+  maps the same file shares its pages.
+
+  Opening checks that the header and offsets fit the file and that the last
+  offset ends it; each lookup checks its own pair of offsets.
+  '''
+  MAGIC = b'W2PN'
+  HEADER = struct.Struct('<4sI')
+  OFFSET = struct.Struct('<I')
+
+  def __init__(self, path:str):
+    with open(path, 'rb') as f:
+      if os.fstat(f.fileno()).st_size < NameTable.HEADER.size:
+        raise ValueError(f'{path} is not a compiled name table')
+      self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, self._count = NameTable.HEADER.unpack_from(self._map, 0)
+    if magic != NameTable.MAGIC:
+      raise ValueError(f'{path} is not a compiled name table')
+    self._data = NameTable.HEADER.size + (self._count + 1) * 4
+    if self._data > len(self._map):
+      raise ValueError(f'{path} is truncated')
+    end, = NameTable.OFFSET.unpack_from(self._map, self._data - 4)
+    if self._data + end != len(self._map):
+      raise ValueError(f'{path} does not end where its offsets do')
+
+  @staticmethod
+  def Compile(names:list) -> bytes:
+    encoded = [name.encode() for name in names]
+    offsets = [0]
+    for name in encoded:
+      offsets.append(offsets[-1] + len(name))
+    return b''.join([
+      NameTable.HEADER.pack(NameTable.MAGIC, len(encoded)),
+      struct.pack(f'<{len(offsets)}I', *offsets),
+      *encoded,
+    ])
+
+  def __len__(self) -> int:
+    return self._count
+
+  def __getitem__(self, index:int) -> str:
+    if not 0 <= index < self._count:
+      raise IndexError(index)
+    at = NameTable.HEADER.size + index * 4
+    start, = NameTable.OFFSET.unpack_from(self._map, at)
+    end, = NameTable.OFFSET.unpack_from(self._map, at + 4)
+    if not start <= end <= len(self._map) - self._data:
+      raise ValueError(f'corrupt name table entry {index}')
+    return self._map[self._data + start:self._data + end].decode()
+
+  def Random(self) -> str:
+    return self[random.randrange(self._count)]
+
+
+def CompileNameFile(source:str, dest:str):
+  '''Writes the compiled table for the names in |source|, one per line.'''
+  with open(source) as f:
+    table = NameTable.Compile(f.read().splitlines())
+  partial = f'{dest}.{os.getpid()}'
+  with open(partial, 'wb') as f:
+    f.write(table)
+  os.replace(partial, dest)
+
+
+def _PrivateDir() -> str:
+  '''A directory in the temp directory only this user can write to.
+
+  Processes run by the same user share it. If the usual name is taken by
+  anything but such a directory, a fresh one is made for this process.
+  '''
+  path = os.path.join(tempfile.gettempdir(), f'what2pick-{os.getuid()}')
+  try:
+    os.mkdir(path, 0o700)
+  except FileExistsError:
+    pass
+  st = os.lstat(path)
+  if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid()
+      or st.st_mode & 0o077):
+    return tempfile.mkdtemp(prefix='what2pick-')
+  return path
+
+
+def _CompiledPath(source:str) -> str:
+  '''A compiled table next to |source| if one was shipped, else a cached one.
+
+  The cache lives in _PrivateDir(), named after the source's size and mtime,
+  so a changed names.txt is compiled again and the user's other processes
+  reuse the same file.
+  '''
+  shipped = os.path.splitext(source)[0] + '.bin'
+  if os.path.exists(shipped):
+    return shipped
+  st = os.stat(source)
+  cached = os.path.join(_PrivateDir(),
+                        f'names-{st.st_size}-{st.st_mtime_ns}.bin')
+  if not os.path.exists(cached):
+    CompileNameFile(source, cached)
+  return cached
+
+
+NAMES = None
+_names_lock = threading.Lock()
 
 
 def PrimeNameList():
-  global NAMELIST
-  with resources.Resources.Open('what2pick/names.txt') as f:
-    NAMELIST = f.read().splitlines()
+  '''Maps the name table; call at startup to keep it off the first signup.'''
+  global NAMES
+  with _names_lock:
+    if NAMES is None:
+      source = f'{resources.Resources.Dir()}/what2pick/names.txt'
+      NAMES = NameTable(_CompiledPath(source))
 
 
 def GetRandomName():
-  global NAMELIST
-  if not NAMELIST:
+  if NAMES is None:
     PrimeNameList()
-  return NAMELIST[random.randint(0, len(NAMELIST) - 1)]
+  return NAMES.Random()
+
+
+def GetRandomFullName(avoid=(), attempts:int = 32):
+  '''A random first and last name that is not in |avoid|.
+
+  With over a hundred million combinations a clash is rare; if every attempt
+  clashes anyway, the name is made unique with a number.
+  '''
+  for _ in range(attempts):
+    name = f'{GetRandomName()} {GetRandomName()}'
+    if name not in avoid:
+      return name
+  suffix = 2
+  while f'{name} {suffix}' in avoid:
+    suffix += 1
+  return f'{name} {suffix}'
 
 
-def GetRandomFullName():
-  return f'{GetRandomName()} {GetRandomName()}'
+if __name__ == '__main__':
+  CompileNameFile(sys.argv[1], sys.argv[2])
@@ -0,0 +1,96 @@
+
+import os
+import shutil
+import stat
+import struct
+import tempfile
+
+from impulse.testing import unittest
+from what2pick import names
+
+
+class NameTableUnittests(unittest.TestCase):
+  def setup(self):
+    self._dir = tempfile.mkdtemp()
+    self._source = f'{self._dir}/names.txt'
+    with open(self._source, 'w') as f:
+      f.write('Ada\nGrace\nÉmile\n')
+
+  def cleanup(self):
+    shutil.rmtree(self._dir)
+
+  def _Write(self, data:bytes) -> str:
+    path = f'{self._dir}/table.bin'
+    with open(path, 'wb') as f:
+      f.write(data)
+    return path
+
+  def test_compiledNamesReadBack(self):
+    names.CompileNameFile(self._source, f'{self._dir}/names.bin')
+    table = names.NameTable(f'{self._dir}/names.bin')
+    self.assertEqual(['Ada', 'Grace', 'Émile'], list(table))
+    self.assertIn(table.Random(), ('Ada', 'Grace', 'Émile'))
+    with self.assertRaises(IndexError):
+      table[3]
+
+  def test_emptyTable(self):
+    self.assertEqual(0, len(names.NameTable(
+      self._Write(names.NameTable.Compile([])))))
+
+  def test_rejectsMalformedFiles(self):
+    table = names.NameTable.Compile(['Ada', 'Grace'])
+    for data in (b'', b'W2P', b'XXXX' + table[4:], table[:-1],
+                 table + b'!', table[:4] + struct.pack('<I', 1000) + table[8:]):
+      with self.assertRaises(ValueError):
+        names.NameTable(self._Write(data))
+
+  def test_rejectsOffsetsOutOfOrder(self):
+    table = bytearray(names.NameTable.Compile(['Ada', 'Grace']))
+    struct.pack_into('<I', table, 12, 9)
+    table = names.NameTable(self._Write(bytes(table)))
+    with self.assertRaises(ValueError):
+      table[1]
+
+
+class CompiledPathUnittests(unittest.TestCase):
+  def setup(self):
+    self._dir = tempfile.mkdtemp()
+    self._tempdir = tempfile.tempdir
+    tempfile.tempdir = self._dir
+    self._source = f'{self._dir}/names.txt'
+    with open(self._source, 'w') as f:
+      f.write('Ada\nGrace\n')
+
+  def cleanup(self):
+    tempfile.tempdir = self._tempdir
+    shutil.rmtree(self._dir)
+
+  def test_cachedInPrivateDirectory(self):
+    path = names._CompiledPath(self._source)
+    self.assertEqual(f'{self._dir}/what2pick-{os.getuid()}',
+                     os.path.dirname(path))
+    self.assertEqual(0o700, stat.S_IMODE(os.stat(os.path.dirname(path))
+                                         .st_mode))
+    self.assertEqual(2, len(names.NameTable(path)))
+    self.assertEqual(path, names._CompiledPath(self._source))
+
+  def test_sharedDirectoryIsNotTrusted(self):
+    shared = f'{self._dir}/what2pick-{os.getuid()}'
+    os.mkdir(shared)
+    os.chmod(shared, 0o777)
+    path = names._CompiledPath(self._source)
+    self.assertNotEqual(shared, os.path.dirname(path))
+    self.assertEqual(0o700, stat.S_IMODE(os.stat(os.path.dirname(path))
+                                         .st_mode))
+
+  def test_symlinkIsNotFollowed(self):
+    os.symlink(tempfile.mkdtemp(dir=self._dir),
+               f'{self._dir}/what2pick-{os.getuid()}')
+    path = names._CompiledPath(self._source)
+    self.assertNotEqual(f'{self._dir}/what2pick-{os.getuid()}',
+                        os.path.dirname(path))
+
+  def test_shippedTableWins(self):
+    names.CompileNameFile(self._source, f'{self._dir}/names.bin')
+    self.assertEqual(f'{self._dir}/names.bin',
+                     names._CompiledPath(self._source))
@@ -0,0 +1,338 @@
+
+import collections
+import contextlib
+import logging
+import os
+import socket
+import threading
+import time
+
+
+class TooManyWaiters(Exception):
+  '''Raised by NotificationRegistry.Wait when a key has all the waiters
+  it is allowed.'''
+
+
+class Subscription():
+  '''A single listener on an EventHub key.
+
+  A subscription is a deque and an event that the hub sets when something
+  is delivered. Its reader blocks in Next; under the gevent worker main runs,
+  the threading primitives are gevent's, so a parked reader is a greenlet and
+  costs little more than its connection's fd. Under real threads it holds
+  one.
+  '''
+  def __init__(self, hub, key):
+    self._hub = hub
+    self._key = key
+    self._events = collections.deque()
+    self._ready = threading.Event()
+
+  def Deliver(self, event):
+    self._events.append(event)
+    self._ready.set()
+
+  def Next(self, timeout=None) -> list:
+    if not self._events:
+      self._ready.wait(timeout)
+    self._ready.clear()
+    events = []
+    while self._events:
+      events.append(self._events.popleft())
+    return events
+
+  def Close(self):
+    self._hub.Unsubscribe(self._key, self)
+
+
+class EventHub():
+  '''Fans events for a key out to every subscription on that key.'''
+  def __init__(self, keepalive:int = 15):
+    self._lock = threading.Lock()
+    self._subscribers = {}
+    self._keepalive = keepalive
+
+  def Subscribe(self, key) -> Subscription:
+    subscription = Subscription(self, key)
+    with self._lock:
+      self._subscribers.setdefault(key, set()).add(subscription)
+    return subscription
+
+  def Unsubscribe(self, key, subscription:Subscription):
+    with self._lock:
+      subscribers = self._subscribers.get(key)
+      if subscribers is None:
+        return
+      subscribers.discard(subscription)
+      if not subscribers:
+        del self._subscribers[key]
+
+  def Publish(self, key, event:str, data:str = '', eventid=None):
+    with self._lock:
+      subscribers = list(self._subscribers.get(key, ()))
+    for subscription in subscribers:
+      subscription.Deliver((event, data, eventid))
+
+  def SubscriberCount(self, key=None) -> int:
+    with self._lock:
+      if key is not None:
+        return len(self._subscribers.get(key, ()))
+      return sum(len(s) for s in self._subscribers.values())
+
+  def Stream(self, key, catch_up=lambda: ()):
+    '''Generates a text/event-stream body for |key| until the client leaves.
+
+    |catch_up| is called once subscribed and returns events the client missed
+    while disconnected, so nothing published in between is lost. Between
+    events the generator waits in Subscription.Next, which is what whoever
+    drives it blocks on.
+    '''
+    subscription = self.Subscribe(key)
+    try:
+      yield 'retry: 3000\n\n'
+      events = list(catch_up())
+      while True:
+        if not events:
+          yield ': keepalive\n\n'
+        for event, data, eventid in events:
+          if eventid is not None:
+            yield f'id: {eventid}\n'
+          yield f'event: {event}\ndata: {data}\n\n'
+        events = subscription.Next(timeout=self._keepalive)
+    finally:
+      subscription.Close()
+
+
+class LocalNotifier():
+  '''Shares changes with nobody; the process only hears about its own.'''
+  def Start(self, callback):
+    pass
+
+  def Publish(self, key:str, version:int):
+    pass
+
+
+class SocketNotifier():
+  '''Broadcasts changes to every process sharing |directory|.
+
+  Each process binds a unix datagram socket named after its pid there and
+  sends each change to every other socket in the directory, which it lists
+  at most once every |refresh| seconds. A socket nobody is bound to any more
+  is removed by the first sender that fails to reach it. Sends never block:
+  a peer too far behind to accept a datagram misses it, and its pollers wait
+  for the next change or their timeout as before. A notice that cannot be
+  parsed or handled is logged and skipped.
+
+  Processes forked after Start get sockets of their own, so an app created
+  before gunicorn forks its workers still has every worker listening.
+  '''
+  def __init__(self, directory:str, refresh:float = 1.0):
+    self._directory = directory
+    self._refresh = refresh
+    self._callback = None
+    self._socket = None
+    self._path = None
+    self._peers = []
+    self._peers_read = 0
+    self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    self._sender.setblocking(False)
+    os.makedirs(directory, exist_ok=True)
+    os.register_at_fork(after_in_child=self._Rebind)
+
+  def Start(self, callback):
+    '''Calls |callback|(key, version) for changes published elsewhere.'''
+    self._callback = callback
+    self._Bind()
+
+  def _Bind(self):
+    self._path = os.path.join(self._directory, f'{os.getpid()}.sock')
+    with contextlib.suppress(FileNotFoundError):
+      os.unlink(self._path)
+    self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    self._socket.bind(self._path)
+    threading.Thread(
+      target=self._Receive, args=(self._socket,), daemon=True).start()
+
+  def _Rebind(self):
+    if self._callback is None:
+      return
+    self._socket.close()
+    self._peers_read = 0
+    self._Bind()
+
+  def _Receive(self, sock:socket.socket):
+    while True:
+      try:
+        message = sock.recv(1024)
+      except OSError:
+        return
+      try:
+        key, _, version = message.decode().partition(' ')
+        self._callback(key, int(version))
+      except Exception:
+        logging.exception('dropped change notice %r', message)
+
+  def _Peers(self) -> list:
+    if time.monotonic() - self._peers_read > self._refresh:
+      self._peers = [os.path.join(self._directory, name)
+                     for name in os.listdir(self._directory)
+                     if name.endswith('.sock')]
+      self._peers_read = time.monotonic()
+    return [peer for peer in self._peers if peer != self._path]
+
+  def Publish(self, key:str, version:int):
+    message = f'{key} {version}'.encode()
+    for peer in self._Peers():
+      try:
+        self._sender.sendto(message, peer)
+      except (ConnectionRefusedError, FileNotFoundError):
+        with contextlib.suppress(OSError):
+          os.unlink(peer)
+        self._peers_read = 0
+      except BlockingIOError:
+        pass
+
+  def Close(self):
+    if self._socket is not None:
+      self._socket.close()
+      with contextlib.suppress(FileNotFoundError):
+        os.unlink(self._path)
+
+
+class _RegistryEntry():
+  def __init__(self, version:int, condition:threading.Condition, history:int):
+    self.version = version
+    self.condition = condition
+    self.waiters = 0
+    self.touched = time.monotonic()
+    self.states = collections.OrderedDict()
+    self.history = history
+
+  def Record(self, version:int, state):
+    if version in self.states:
+      return self.states[version]
+    self.states[version] = state
+    while len(self.states) > self.history:
+      self.states.popitem(last=False)
+    return state
+
+
+class NotificationRegistry():
+  '''Tracks a monotonically increasing change version per key.
+
+  Versions come from one process-wide clock, so an entry that is evicted and
+  later recreated starts at a version no older than anything a client could
+  have seen for it. Clients that are behind therefore never wait, at worst
+  they refresh once more than strictly necessary. Entries nobody is waiting
+  on are evicted in LRU order once |capacity| is exceeded or |ttl| seconds
+  pass without them being touched.
+
+  Each entry also remembers the last |history| states published with a
+  version, so callers can diff against what a client was last sent.
+
+  A version is the clock shifted left by 16 bits, with the low bits naming
+  the process that made the change. Several processes can therefore share
+  clients: Notify(after=) moves the clock past versions heard from the
+  others, and no two processes ever record different states under the same
+  version.
+  '''
+  def __init__(self, capacity:int = 4096, ttl:int = 600, history:int = 8):
+    self._lock = threading.Lock()
+    self._entries = collections.OrderedDict()
+    self._clock = 0
+    self._capacity = capacity
+    self._ttl = ttl
+    self._history = history
+
+  def _Entry(self, key) -> _RegistryEntry:
+    entry = self._entries.pop(key, None)
+    self._Evict()
+    if entry is None:
+      entry = _RegistryEntry(
+        (self._clock << 16) | 0xffff, threading.Condition(self._lock),
+        self._history)
+    self._entries[key] = entry
+    entry.touched = time.monotonic()
+    return entry
+
+  def _Evict(self):
+    expired = time.monotonic() - self._ttl
+    for key in list(self._entries):
+      entry = self._entries[key]
+      if len(self._entries) < self._capacity and entry.touched > expired:
+        return
+      if not entry.waiters:
+        del self._entries[key]
+
+  def Version(self, key) -> int:
+    with self._lock:
+      return self._Entry(key).version
+
+  def Notify(self, key, state=None, after:int = 0) -> int:
+    '''Moves |key| to a new version later than both its own and |after|.'''
+    with self._lock:
+      entry = self._Entry(key)
+      self._clock = max(self._clock, after >> 16) + 1
+      entry.version = (self._clock << 16) | (os.getpid() & 0xffff)
+      if state is not None:
+        entry.Record(entry.version, state)
+      entry.condition.notify_all()
+      return entry.version
+
+  def Latest(self, key):
+    '''Returns (version, state), where state is None if none was recorded.'''
+    with self._lock:
+      entry = self._Entry(key)
+      return entry.version, entry.states.get(entry.version)
+
+  def Record(self, key, version:int, state):
+    '''Stores |state| for |version| unless one is already known.
+
+    Returns whichever state is now recorded for |version|, which is the one
+    that must be served so later diffs line up. Nothing is recorded if the
+    key has already moved past |version|.
+    '''
+    with self._lock:
+      entry = self._Entry(key)
+      if entry.version != version:
+        return entry.states.get(version, state)
+      return entry.Record(version, state)
+
+  def State(self, key, version:int):
+    with self._lock:
+      entry = self._entries.get(key)
+      return entry.states.get(version) if entry else None
+
+  def Wait(self, key, since:int|None = None, timeout:float = 60,
+           max_waiters:int|None = None) -> int:
+    '''Blocks until |key| moves past |since|, returning the current version.
+
+    With no |since|, waits for the next change after the call. Only a client
+    holding the current version waits: one that is behind, or holds a version
+    this process never issued (from another worker, or from before a restart)
+    returns at once to resync, even when |key| has |max_waiters| waiters.
+    Otherwise that raises TooManyWaiters.
+    '''
+    with self._lock:
+      entry = self._Entry(key)
+      if since is None:
+        since = entry.version
+      if entry.version != since:
+        return entry.version
+      if max_waiters is not None and entry.waiters >= max_waiters:
+        raise TooManyWaiters(key)
+      entry.waiters += 1
+      try:
+        entry.condition.wait_for(lambda: entry.version > since, timeout)
+      finally:
+        entry.waiters -= 1
+        entry.touched = time.monotonic()
+      return entry.version
+
+  def Waiters(self) -> int:
+    with self._lock:
+      return sum(e.waiters for e in self._entries.values())
+
+  def __len__(self):
+    with self._lock:
+      return len(self._entries)
@@ -0,0 +1,146 @@
+
+import os
+import queue
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+from impulse.testing import unittest
+from what2pick import notifications
+
+
+class EventHubUnittests(unittest.TestCase):
+  def setup(self):
+    self._hub = notifications.EventHub(keepalive=0.05)
+
+  def test_publishFansOut(self):
+    first = self._hub.Subscribe('game')
+    second = self._hub.Subscribe('game')
+    other = self._hub.Subscribe('other')
+    self._hub.Publish('game', 'reload', '7', eventid=7)
+    self.assertEqual([('reload', '7', 7)], first.Next(timeout=0))
+    self.assertEqual([('reload', '7', 7)], second.Next(timeout=0))
+    self.assertEqual([], other.Next(timeout=0))
+    self.assertEqual(3, self._hub.SubscriberCount())
+    first.Close()
+    second.Close()
+    self.assertEqual(0, self._hub.SubscriberCount('game'))
+
+  def test_nextWakesOnPublish(self):
+    subscription = self._hub.Subscribe('game')
+    threading.Timer(0.05, self._hub.Publish, ('game', 'reload')).start()
+    start = time.monotonic()
+    self.assertEqual([('reload', '', None)], subscription.Next(timeout=5))
+    self.assertLess(time.monotonic() - start, 5)
+
+  def test_streamCatchesUpAndKeepsAlive(self):
+    stream = self._hub.Stream('game', lambda: [('reload', '3', 3)])
+    self.assertEqual('retry: 3000\n\n', next(stream))
+    self.assertEqual('id: 3\n', next(stream))
+    self.assertEqual('event: reload\ndata: 3\n\n', next(stream))
+    self.assertEqual(': keepalive\n\n', next(stream))
+    self.assertEqual(1, self._hub.SubscriberCount('game'))
+    self._hub.Publish('game', 'reload', '4')
+    self.assertEqual('event: reload\ndata: 4\n\n', next(stream))
+    stream.close()
+    self.assertEqual(0, self._hub.SubscriberCount('game'))
+
+
+class NotificationRegistryUnittests(unittest.TestCase):
+  def setup(self):
+    self._registry = notifications.NotificationRegistry(capacity=2, ttl=60)
+
+  def test_versionsIncrease(self):
+    first = self._registry.Version('a')
+    second = self._registry.Notify('a', {'n': 1})
+    third = self._registry.Notify('a', {'n': 2})
+    self.assertLess(first, second)
+    self.assertLess(second, third)
+    self.assertEqual((third, {'n': 2}), self._registry.Latest('a'))
+    self.assertEqual({'n': 1}, self._registry.State('a', second))
+    self.assertGreater(self._registry.Notify('b', after=third << 4),
+                       third << 4)
+
+  def test_evictedKeysDoNotGoBack(self):
+    seen = self._registry.Notify('a')
+    self._registry.Version('b')
+    self._registry.Version('c')
+    self.assertEqual(2, len(self._registry))
+    self.assertGreater(self._registry.Version('a'), seen)
+
+  def test_recordKeepsFirstState(self):
+    version = self._registry.Version('a')
+    self.assertEqual('x', self._registry.Record('a', version, 'x'))
+    self.assertEqual('x', self._registry.Record('a', version, 'y'))
+    later = self._registry.Notify('a')
+    self.assertEqual('x', self._registry.Record('a', version, 'z'))
+    self._registry.Notify('a')
+    self.assertEqual('z', self._registry.Record('a', later, 'z'))
+    self.assertIsNone(self._registry.State('a', later))
+
+  def test_waitReturnsOnNotify(self):
+    version = self._registry.Version('a')
+    threading.Timer(0.05, self._registry.Notify, ('a',)).start()
+    self.assertGreater(self._registry.Wait('a', version, timeout=5), version)
+    self.assertEqual(0, self._registry.Waiters())
+
+  def test_waitTimesOut(self):
+    version = self._registry.Version('a')
+    self.assertEqual(version, self._registry.Wait('a', version, timeout=0.05))
+
+  def test_waitResyncsForeignVersions(self):
+    version = self._registry.Notify('a')
+    start = time.monotonic()
+    self.assertEqual(version, self._registry.Wait('a', version + 1))
+    self.assertEqual(version, self._registry.Wait('a', version ^ 1))
+    self.assertEqual(version, self._registry.Wait('a', version << 8))
+    self.assertLess(time.monotonic() - start, 1)
+
+  def test_tooManyWaiters(self):
+    version = self._registry.Version('a')
+    waiter = threading.Thread(
+      target=self._registry.Wait, args=('a', version, 5))
+    waiter.start()
+    while not self._registry.Waiters():
+      time.sleep(0.01)
+    with self.assertRaises(notifications.TooManyWaiters):
+      self._registry.Wait('a', version, max_waiters=1)
+    self.assertEqual(version, self._registry.Wait('a', version - 1,
+                                                  max_waiters=1))
+    self._registry.Notify('a')
+    waiter.join()
+
+
+class SocketNotifierUnittests(unittest.TestCase):
+  def setup(self):
+    self._dir = tempfile.mkdtemp()
+    self._received = queue.Queue()
+    self._listener = notifications.SocketNotifier(self._dir)
+    self._listener.Start(lambda key, version:
+                         self._received.put((key, version)))
+    self._sender = notifications.SocketNotifier(self._dir, refresh=0)
+
+  def cleanup(self):
+    self._listener.Close()
+    shutil.rmtree(self._dir)
+
+  def test_publishReachesOtherProcesses(self):
+    self._sender.Publish('game', 7)
+    self.assertEqual(('game', 7), self._received.get(timeout=5))
+
+  def test_badNoticesAreSkipped(self):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+      sock.sendto(b'game seven', self._listener._path)
+      sock.sendto(b'\xff', self._listener._path)
+    self._sender.Publish('game', 8)
+    self.assertEqual(('game', 8), self._received.get(timeout=5))
+
+  def test_deadPeersAreRemoved(self):
+    dead = os.path.join(self._dir, '1.sock')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+      sock.bind(dead)
+    self._sender.Publish('game', 9)
+    self.assertFalse(os.path.exists(dead))
+    self.assertEqual(('game', 9), self._received.get(timeout=5))
@@ -1,4 +1,10 @@
 
+import collections
+import contextlib
+import dataclasses
+import functools
+import sqlite3
+import threading
 import time
 import uuid
 
@@ -8,24 +14,28 @@ from pylib.web import http
 from what2pick import sql_storage
 
 
-@sql_storage.TableSpec('payshoff')
+@sql_storage.TableSpec('payshoff', indexes=[
+  sql_storage.Index('admin'),
+  sql_storage.Index('last_access', where='decided = 0'),
+])
 class PaysHoff:
   gameid: sql_storage.PrimaryKey(uuid.UUID)
   admin: uuid.UUID
-  players: sql_storage.CSV(uuid.UUID)
-  watchers: sql_storage.CSV(uuid.UUID)
+  players: sql_storage.CSVSet(uuid.UUID)
+  watchers: sql_storage.CSVSet(uuid.UUID)
   next_player: uuid.UUID
-  must_add: sql_storage.CSV(uuid.UUID)
+  must_add: sql_storage.CSVSet(uuid.UUID)
   options: sql_storage.TSV(str)
   decided: bool
   active_timer: bool
   seconds_to_pick: int
   kick_on_last_remove: bool
   last_access: sql_storage.UnixTime
+  row_version: sql_storage.RowVersion() = 0
+  move_seq: int = 0
 
   def AdvanceToNextUser(self):
-    self.next_player = self.players[
-      (self.players.index(self.next_player) + 1) % len(self.players)]
+    self.next_player = self.players.Next(self.next_player)
 
   def CheckAdmin(self, user:uuid.UUID):
     if user != self.admin:
@@ -39,28 +49,284 @@ class PaysHoff:
     if self.next_player != user:
       raise http.HttpException('Not your turn', http.Code.METHOD_NOT_ALLOWED)
 
+  def Apply(self, move:'PaysHoffMove'):
+    '''Plays |move|, which was checked against the game before it was made.'''
+    player = move.player
+    if move.kind == JOIN:
+      self.players.append(player)
+      self.must_add.append(player)
+    elif move.kind == ADD:
+      self.options.append(move.arg)
+      if player in self.must_add:
+        self.must_add.remove(player)
+      self.AdvanceToNextUser()
+    elif move.kind == REMOVE:
+      option = int(move.arg)
+      self.options = self.options[:option] + self.options[option+1:]
+      if player == self.next_player:
+        self.AdvanceToNextUser()
+        if not len(self.options) and self.kick_on_last_remove:
+          self.players.remove(player)
+          self.watchers.append(player)
+    elif move.kind == WATCH:
+      target = uuid.UUID(move.arg)
+      if self.next_player == target:
+        self.AdvanceToNextUser()
+      self.watchers.append(target)
+      self.players.remove(target)
+      if target in self.must_add:
+        self.must_add.remove(target)
+    elif move.kind == TOGGLE_KICK:
+      self.kick_on_last_remove = not self.kick_on_last_remove
+    elif move.kind == SKIP:
+      self.AdvanceToNextUser()
+    elif move.kind == SELECT:
+      self.decided = True
+    else:
+      raise ValueError(f'unknown move {move.kind}')
+    self.move_seq = move.seq
+
+
+JOIN = 'join'
+ADD = 'add'
+REMOVE = 'del'
+WATCH = 'watch'
+TOGGLE_KICK = 'toggle_kick'
+SKIP = 'skip'
+SELECT = 'sel'
+
+
+@sql_storage.TableSpec('payshoff_moves', indexes=[
+  sql_storage.Index('gameid', 'seq', unique=True),
+], shard_by='gameid')
+class PaysHoffMove:
+  '''One move of a game, in the order |seq| the moves were made.
+
+  The PaysHoff row is a snapshot of the game after its move |move_seq|; the
+  game as it is now is that snapshot with every later move applied.
+  '''
+  moveid: sql_storage.PrimaryKey(str)
+  gameid: uuid.UUID
+  seq: int
+  kind: str
+  player: uuid.UUID
+  arg: str
+  made: sql_storage.UnixTime
+
+  def ToJson(self) -> dict:
+    return {'seq': self.seq, 'kind': self.kind, 'player': str(self.player),
+            'arg': self.arg}
+
+
+def _RetryOnConflict(method, attempts:int = 5):
+  '''Re-runs a mutation whose write lost a race with another process.
+
+  The failed attempt has already dropped the game from the cache, so each
+  retry starts from the row as it now is in the database.
+  '''
+  @functools.wraps(method)
+  def Retrying(*args, **kwargs):
+    for _ in range(attempts - 1):
+      try:
+        return method(*args, **kwargs)
+      except sql_storage.UpdateConflict:
+        pass
+    return method(*args, **kwargs)
+  return Retrying
+
+
+class GameCache():
+  '''A size-bounded LRU of live PaysHoff rows.
+
+  Each game id hashes to one of |generations| counters, which every eviction
+  bumps, explicit or LRU. A row read from the database is only cached if its
+  counter has not moved since the read began, so a reader racing an eviction
+  cannot put back a row that may since have gone stale.
+  '''
+  def __init__(self, capacity:int, generations:int = 1024):
+    self._lock = threading.Lock()
+    self._games = collections.OrderedDict()
+    self._checked = {}
+    self._generations = [0] * generations
+    self._capacity = capacity
+    self._hits = 0
+    self._misses = 0
+    self._evictions = 0
+
+  def Get(self, gameid:uuid.UUID) -> PaysHoff|None:
+    with self._lock:
+      game = self._games.get(gameid)
+      if game is None:
+        self._misses += 1
+        return None
+      self._hits += 1
+      self._games.move_to_end(gameid)
+      return game
+
+  def Generation(self, gameid:uuid.UUID) -> int:
+    '''Taken before reading a game, to be handed back to Put.'''
+    with self._lock:
+      return self._generations[hash(gameid) % len(self._generations)]
+
+  def Put(self, game:PaysHoff, generation:int|None = None) -> PaysHoff:
+    '''Caches |game| and returns the cached row, which wins any race.
+
+    Nothing is cached if |game| was read before the latest eviction of its id
+    and |generation| says so.
+    '''
+    with self._lock:
+      stripe = hash(game.gameid) % len(self._generations)
+      if generation is not None and generation != self._generations[stripe]:
+        return game
+      if game.gameid not in self._games:
+        self._games[game.gameid] = game
+        self._checked[game.gameid] = time.monotonic()
+      self._games.move_to_end(game.gameid)
+      while len(self._games) > self._capacity:
+        gameid, _ = self._games.popitem(last=False)
+        del self._checked[gameid]
+        self._generations[hash(gameid) % len(self._generations)] += 1
+        self._evictions += 1
+      return self._games[game.gameid]
+
+  def Due(self, gameid:uuid.UUID, interval:float) -> bool:
+    '''Whether a cached game was last checked over |interval| seconds ago.
+
+    Answering yes counts as checking it, so one caller does the check.
+    '''
+    now = time.monotonic()
+    with self._lock:
+      checked = self._checked.get(gameid)
+      if checked is None or now - checked < interval:
+        return False
+      self._checked[gameid] = now
+      return True
+
+  def Evict(self, gameid:uuid.UUID):
+    with self._lock:
+      self._generations[hash(gameid) % len(self._generations)] += 1
+      if self._games.pop(gameid, None) is not None:
+        del self._checked[gameid]
+        self._evictions += 1
+
+  def Games(self) -> list:
+    with self._lock:
+      return list(self._games.values())
+
+  def Stats(self) -> dict:
+    with self._lock:
+      return {
+        'hits': self._hits,
+        'misses': self._misses,
+        'evictions': self._evictions,
+        'size': len(self._games),
+        'capacity': self._capacity,
+      }
+
 
 class PaysHoffDAO(sql_storage.SQLStorageBase):
-  def __init__(self, dbfile:str):
-    super().__init__(dbfile)
-    self.Cursor(on_connect_db=self._CreateTable)
+  '''Games, served from a write-through cache of live PaysHoff rows.
+
+  Mutations of one game are serialized by a striped lock, applied to the
+  cached row, and written to sqlite before the lock is released. A mutation
+  that fails for any reason other than a rejected move drops the cached row
+  so the next reader goes back to the database.
+
+  Games can be spread over |shards| database files by game id, so moves in
+  different rooms do not queue on one sqlite writer lock.
 
-  def _CreateTable(self, _):
-    self.CreateTableForType(PaysHoff)
+  Each move is written as a small PaysHoffMove row rather than rewriting the
+  whole game; the game row is only rewritten, as a snapshot, every
+  |snapshot_every| moves, or less often in games with more members. Two
+  processes making the same game's next move collide on its sequence
+  number, and the loser retries like any conflict.
+
+  Other processes' moves reach the cache through Forget. In case a notice
+  is lost, a cached game is also checked for moves it has not seen when it
+  is read |revalidate| seconds after its last check.
+  '''
+  TABLES = (PaysHoff, PaysHoffMove)
+
+  def __init__(self, dbfile:str, cache_capacity:int = 1024,
+               lock_stripes:int = 64, shards:int = 1,
+               group_commit:float = 0, snapshot_every:int = 32,
+               revalidate:float = 5):
+    super().__init__(dbfile, shards, group_commit)
+    self.Migrate(*self.TABLES)
+    self._snapshot_every = snapshot_every
+    self._revalidate = revalidate
+    self._cache = GameCache(cache_capacity)
+    self._locks = [threading.Lock() for _ in range(lock_stripes)]
 
   def _GetTimestamp(self):
     return int(time.time())
-    
+
+  def _GameLock(self, gameid:uuid.UUID) -> threading.Lock:
+    return self._locks[hash(gameid) % len(self._locks)]
+
+  @contextlib.contextmanager
+  def _Mutating(self, gameid:uuid.UUID):
+    with self._GameLock(gameid):
+      game = self.GetGameById(gameid)
+      try:
+        yield game
+      except http.HttpException:
+        raise
+      except:
+        self._cache.Evict(gameid)
+        raise
+
+  def _Play(self, game:PaysHoff, kind:str, player:uuid.UUID, arg:str = ''):
+    '''Applies a checked move to |game| and appends it to the move log.'''
+    seq = game.move_seq + 1
+    move = PaysHoffMove(moveid=f'{game.gameid}/{seq}', gameid=game.gameid,
+                        seq=seq, kind=kind, player=player, arg=arg, made=0)
+    game.Apply(move)
+    try:
+      self.Insert(move)
+    except sqlite3.IntegrityError:
+      raise sql_storage.UpdateConflict(f'move {seq} of {game.gameid} is taken')
+    if seq % self._SnapshotInterval(game) == 0:
+      self._Snapshot(game)
+
+  def _SnapshotInterval(self, game:PaysHoff) -> int:
+    '''Moves between snapshots, at least one per member of the game.
+
+    A snapshot rewrites every member list, so spacing them by the game's size
+    keeps the cost per move constant in large rooms. Rounding to a power of
+    two keeps earlier snapshot points valid as the game grows.
+    '''
+    members = len(game.players) + len(game.watchers)
+    return max(self._snapshot_every, 1 << members.bit_length())
+
+  def _Snapshot(self, game:PaysHoff):
+    '''Rewrites the game row, so loading it replays fewer moves.
+
+    The move is already stored, so losing this race is not an error: another
+    process has written a snapshot at least as recent.
+    '''
+    try:
+      self.Update(game)
+    except sql_storage.UpdateConflict:
+      self._cache.Evict(game.gameid)
+
+  def CacheStats(self) -> dict:
+    return self._cache.Stats()
+
+  def Forget(self, gameid:uuid.UUID):
+    '''Drops a game changed by another process, so it is read again.'''
+    self._cache.Evict(gameid)
+
   @typecheck.Ensure
   def CreateGame(self, player:uuid.UUID) -> PaysHoff:
     gameid = uuid.uuid4()
     ph_game = PaysHoff(
       gameid = gameid,
       admin = player,
-      players = [player],
-      watchers = [],
+      players = sql_storage.OrderedSet([player]),
+      watchers = sql_storage.OrderedSet(),
       next_player = player,
-      must_add = [player],
+      must_add = sql_storage.OrderedSet([player]),
       options = [],
       decided = False,
       active_timer = False,
@@ -68,113 +334,136 @@ class PaysHoffDAO(sql_storage.SQLStorageBase):
       kick_on_last_remove = False,
       last_access = 0)
     self.Insert(ph_game)
+    self._cache.Put(ph_game)
     return ph_game
 
+  def _Behind(self, game:PaysHoff) -> bool:
+    '''Whether another process has made moves |game| has not seen.'''
+    return bool(self.GetMoves(game.gameid, game.move_seq))
+
+  def Copy(self, game:PaysHoff) -> PaysHoff:
+    '''A private copy of |game|, for code that iterates its members.
+
+    Cached games are shared, and moves change their sets in place. The copy
+    is made under the game's lock, so no move lands while it is taken.
+    '''
+    with self._GameLock(game.gameid):
+      return dataclasses.replace(
+        game,
+        players = sql_storage.OrderedSet(game.players),
+        watchers = sql_storage.OrderedSet(game.watchers),
+        must_add = sql_storage.OrderedSet(game.must_add),
+        options = list(game.options))
+
+  def CachedGamesOf(self, uid:uuid.UUID) -> list:
+    '''The ids of cached games |uid| plays or watches in.'''
+    return [game.gameid for game in self._cache.Games()
+            if uid in game.players or uid in game.watchers]
+
   @typecheck.Ensure
   def GetGameById(self, gameid:uuid.UUID, noexcept=False) -> PaysHoff|None:
+    if game := self._cache.Get(gameid):
+      if not (self._cache.Due(gameid, self._revalidate) and
+              self._Behind(game)):
+        return game
+      self._cache.Evict(gameid)
+    generation = self._cache.Generation(gameid)
     games = list(self.GetAll(PaysHoff, gameid=gameid))
     if len(games) != 1:
       if noexcept:
         return None
       raise http.HttpException.NotFound(gameid)
-    return games[0]
+    game = games[0]
+    for move in self.GetMoves(gameid, game.move_seq):
+      game.Apply(move)
+    return self._cache.Put(game, generation)
 
+  @typecheck.Ensure
+  def GetMoves(self, gameid:uuid.UUID, since:int = 0) -> list:
+    '''The moves of a game after move |since|, oldest first.'''
+    return self.GetAllAfter(PaysHoffMove, 'seq', since, gameid=gameid)
+
+  @_RetryOnConflict
   @typecheck.Ensure
   def JoinGame(self, gameid:uuid.UUID, player:uuid.UUID):
-    game = self.GetGameById(gameid, noexcept=True)
-    if not game:
+    if not self.GetGameById(gameid, noexcept=True):
       return self.CreateGame(player), False
-    if player in game.players:
-      return game, False
-    if player in game.watchers:
-      return game, False
-    game.players.append(player)
-    game.must_add.append(player)
-    self.Update(game)
+    with self._Mutating(gameid) as game:
+      if player in game.players:
+        return game, False
+      if player in game.watchers:
+        return game, False
+      self._Play(game, JOIN, player)
     return game, True
 
+  @_RetryOnConflict
   @typecheck.Ensure
   def ToggleKickOnLastRemoveMode(self, gid:uuid.UUID, admin:uuid.UUID):
-    game = self.GetGameById(gid)
-    game.CheckAllowChanges()
-    game.CheckAdmin(admin)
-    game.kick_on_last_remove = not game.kick_on_last_remove
-    self.Update(game)
+    with self._Mutating(gid) as game:
+      game.CheckAllowChanges()
+      game.CheckAdmin(admin)
+      self._Play(game, TOGGLE_KICK, admin)
     return game
 
+  @_RetryOnConflict
   @typecheck.Ensure
   def SetPlayerToWatcher(self, gid:uuid.UUID, player:uuid.UUID, adm:uuid.UUID):
-    game = self.GetGameById(gid)
-    game.CheckAllowChanges()
-    game.CheckAdmin(adm)
-    if len(game.players) == 1:
-      raise http.HttpException('must keep 1 player', http.Code.NOT_ACCEPTABLE)
-    if player not in game.players:
-      raise http.HttpException('not active player', http.Code.BAD_REQUEST)
-    if player in game.watchers:
-      raise http.HttpException('already a watcher', http.Code.BAD_REQUEST)
-    if game.next_player == player:
-      game.AdvanceToNextUser()
-    game.watchers.append(player)
-    game.players.remove(player)
-    if player in game.must_add:
-      game.must_add.remove(player)
-    self.Update(game)
+    with self._Mutating(gid) as game:
+      game.CheckAllowChanges()
+      game.CheckAdmin(adm)
+      if len(game.players) == 1:
+        raise http.HttpException('must keep 1 player', http.Code.NOT_ACCEPTABLE)
+      if player not in game.players:
+        raise http.HttpException('not active player', http.Code.BAD_REQUEST)
+      if player in game.watchers:
+        raise http.HttpException('already a watcher', http.Code.BAD_REQUEST)
+      self._Play(game, WATCH, adm, str(player))
     return game, True
 
+  @_RetryOnConflict
   @typecheck.Ensure
   def AddOption(self, gameid:uuid.UUID, player:uuid.UUID, option:str):
-    game = self.GetGameById(gameid)
-    game.CheckAllowChanges()
-    game.CheckNextPlayer(player)
-    option = option[:30].replace('\t', '_')
-    game.options.append(option)
-    if player in game.must_add:
-      game.must_add.remove(player)
-    game.AdvanceToNextUser()
-    self.Update(game)
+    with self._Mutating(gameid) as game:
+      game.CheckAllowChanges()
+      game.CheckNextPlayer(player)
+      self._Play(game, ADD, player, option[:30].replace('\t', '_'))
     return game
 
+  @_RetryOnConflict
   @typecheck.Ensure
   def RemoveOption(self, gameid:uuid.UUID, player:uuid.UUID, option:int):
-    game = self.GetGameById(gameid)
-    game.CheckAllowChanges()
-    if player not in (game.next_player, game.admin):
-      raise http.HttpException('Not your turn', http.Code.METHOD_NOT_ALLOWED)
-    if option >= len(game.options) or option < 0:
-      raise http.HttpException('Index out of bounds', http.Code.BAD_REQUEST)
-    if game.next_player in game.must_add:
-      raise http.HttpException('Everyone must add', http.Code.NOT_ACCEPTABLE)
-    if len(game.options) == 1 and len(game.players) == 1:
-      raise http.HttpException('You must Select!', http.Code.NOT_ACCEPTABLE)
-
-    game.options = game.options[:option] + game.options[option+1:]
-    if player == game.next_player:
-      game.AdvanceToNextUser()
-      if not len(game.options) and game.kick_on_last_remove:
-        game.players.remove(player)
-        game.watchers.append(player)
-    self.Update(game)
+    with self._Mutating(gameid) as game:
+      game.CheckAllowChanges()
+      if player not in (game.next_player, game.admin):
+        raise http.HttpException('Not your turn', http.Code.METHOD_NOT_ALLOWED)
+      if option >= len(game.options) or option < 0:
+        raise http.HttpException('Index out of bounds', http.Code.BAD_REQUEST)
+      if game.next_player in game.must_add:
+        raise http.HttpException('Everyone must add', http.Code.NOT_ACCEPTABLE)
+      if len(game.options) == 1 and len(game.players) == 1:
+        raise http.HttpException('You must Select!', http.Code.NOT_ACCEPTABLE)
+      self._Play(game, REMOVE, player, str(option))
     return game
 
+  @_RetryOnConflict
   @typecheck.Ensure
   def Select(self, gameid:uuid.UUID, player:uuid.UUID) -> PaysHoff:
-    game = self.GetGameById(gameid)
-    game.CheckAllowChanges()
-    game.CheckNextPlayer(player)
-    if game.must_add:
-      raise http.HttpException('Everyone must add', http.Code.NOT_ACCEPTABLE)
-    if len(game.options) != 1:
-      raise http.HttpException('Too many choices', http.Code.METHOD_NOT_ALLOWED)
-    game.decided = True 
-    self.Update(game)
+    with self._Mutating(gameid) as game:
+      game.CheckAllowChanges()
+      game.CheckNextPlayer(player)
+      if game.must_add:
+        raise http.HttpException('Everyone must add', http.Code.NOT_ACCEPTABLE)
+      if len(game.options) != 1:
+        raise http.HttpException(
+          'Too many choices', http.Code.METHOD_NOT_ALLOWED)
+      self._Play(game, SELECT, player)
     return game
 
+  @_RetryOnConflict
   @typecheck.Ensure
   def AdminSkipNextUser(self, gameid:uuid.UUID, player:uuid.UUID):
-    game = self.GetGameById(gameid)
-    game.CheckAdmin(player)
-    game.CheckAllowChanges()
-    game.AdvanceToNextUser()
-    self.Update(game)
+    with self._Mutating(gameid) as game:
+      game.CheckAdmin(player)
+      game.CheckAllowChanges()
+      self._Play(game, SKIP, player)
     return game
\ No newline at end of file
@@ -0,0 +1,216 @@
+
+import os
+import tempfile
+import uuid
+
+from impulse.testing import unittest
+from pylib.web import http
+from what2pick import pays_hoff_dao
+from what2pick import sql_storage
+
+
+class GameCacheUnittests(unittest.TestCase):
+  def setup(self):
+    self._dao = pays_hoff_dao.PaysHoffDAO(sql_storage.MEMORY)
+    self._cache = pays_hoff_dao.GameCache(2)
+
+  def test_leastRecentlyUsedIsEvicted(self):
+    games = [self._dao.CreateGame(uuid.uuid4()) for _ in range(3)]
+    self._cache.Put(games[0])
+    self._cache.Put(games[1])
+    self._cache.Get(games[0].gameid)
+    self._cache.Put(games[2])
+    self.assertIs(games[0], self._cache.Get(games[0].gameid))
+    self.assertIsNone(self._cache.Get(games[1].gameid))
+    self.assertEqual({'hits': 2, 'misses': 1, 'evictions': 1, 'size': 2,
+                      'capacity': 2}, self._cache.Stats())
+
+  def test_firstPutWins(self):
+    game = self._dao.CreateGame(uuid.uuid4())
+    stale, = self._dao.GetAll(pays_hoff_dao.PaysHoff, gameid=game.gameid)
+    self.assertIs(game, self._cache.Put(game))
+    self.assertIs(game, self._cache.Put(stale))
+    self._cache.Evict(game.gameid)
+    self.assertIsNone(self._cache.Get(game.gameid))
+
+  def test_readsRacingAnEvictAreNotCached(self):
+    game = self._dao.CreateGame(uuid.uuid4())
+    generation = self._cache.Generation(game.gameid)
+    self._cache.Evict(game.gameid)
+    self.assertIs(game, self._cache.Put(game, generation))
+    self.assertIsNone(self._cache.Get(game.gameid))
+    generation = self._cache.Generation(game.gameid)
+    self.assertIs(game, self._cache.Put(game, generation))
+    self.assertIs(game, self._cache.Get(game.gameid))
+
+  def test_readsRacingAnLRUEvictionAreNotCached(self):
+    game = self._dao.CreateGame(uuid.uuid4())
+    self._cache.Put(game)
+    generation = self._cache.Generation(game.gameid)
+    for _ in range(2):
+      self._cache.Put(self._dao.CreateGame(uuid.uuid4()))
+    self.assertIsNone(self._cache.Get(game.gameid))
+    self.assertIs(game, self._cache.Put(game, generation))
+    self.assertIsNone(self._cache.Get(game.gameid))
+
+  def test_dueOncePerInterval(self):
+    game = self._cache.Put(self._dao.CreateGame(uuid.uuid4()))
+    self.assertFalse(self._cache.Due(game.gameid, 60))
+    self.assertTrue(self._cache.Due(game.gameid, 0))
+    self.assertFalse(self._cache.Due(game.gameid, 60))
+    self.assertFalse(self._cache.Due(uuid.uuid4(), 0))
+
+
+class RetryOnConflictUnittests(unittest.TestCase):
+  def test_retriesConflictsOnly(self):
+    calls = []
+    @pays_hoff_dao._RetryOnConflict
+    def Flaky(failures):
+      calls.append(1)
+      if len(calls) <= failures:
+        raise sql_storage.UpdateConflict('lost')
+      return len(calls)
+    self.assertEqual(3, Flaky(2))
+    calls.clear()
+    with self.assertRaises(sql_storage.UpdateConflict):
+      Flaky(5)
+    self.assertEqual(5, len(calls))
+    calls.clear()
+    @pays_hoff_dao._RetryOnConflict
+    def Broken():
+      calls.append(1)
+      raise ValueError()
+    with self.assertRaises(ValueError):
+      Broken()
+    self.assertEqual(1, len(calls))
+
+
+class PaysHoffDAOUnittests(unittest.TestCase):
+  def setup(self):
+    self._dao = pays_hoff_dao.PaysHoffDAO(sql_storage.MEMORY)
+    self._admin = uuid.uuid4()
+    self._game = self._dao.CreateGame(self._admin)
+
+  def test_movesAreWrittenThrough(self):
+    gid = self._game.gameid
+    self._dao.AddOption(gid, self._admin, 'pizza')
+    self.assertIs(self._game, self._dao.GetGameById(gid))
+    self._dao.Forget(gid)
+    self.assertEqual(['pizza'], self._dao.GetGameById(gid).options)
+
+  def test_rejectedMovesKeepTheCachedGame(self):
+    gid = self._game.gameid
+    with self.assertRaises(http.HttpException):
+      self._dao.AddOption(gid, uuid.uuid4(), 'pizza')
+    self.assertIs(self._game, self._dao.GetGameById(gid))
+
+  def test_copiesAreNotChangedByMoves(self):
+    gid = self._game.gameid
+    others = [uuid.uuid4() for _ in range(3)]
+    for other in others:
+      self._dao.JoinGame(gid, other)
+    copy = self._dao.Copy(self._game)
+    seen = []
+    for player in copy.players:
+      seen.append(player)
+      if player == self._admin:
+        self._dao.SetPlayerToWatcher(gid, others[0], self._admin)
+    self.assertEqual([self._admin, *others], seen)
+    self.assertEqual([self._admin, *others[1:]], self._game.players)
+    self.assertEqual([], copy.watchers)
+    self.assertEqual([others[0]], self._game.watchers)
+
+  def test_failedWritesDropTheCachedGame(self):
+    gid = self._game.gameid
+    def Failing(_):
+      raise OSError('disk full')
+    self._dao.Insert = Failing
+    with self.assertRaises(OSError):
+      self._dao.AddOption(gid, self._admin, 'pizza')
+    del self._dao.Insert
+    self.assertIsNot(self._game, self._dao.GetGameById(gid))
+    self.assertEqual([], self._dao.GetGameById(gid).options)
+
+
+class MoveLogUnittests(unittest.TestCase):
+  def setup(self):
+    self._dao = pays_hoff_dao.PaysHoffDAO(sql_storage.MEMORY, snapshot_every=4)
+    self._admin = uuid.uuid4()
+    self._others = [uuid.uuid4(), uuid.uuid4()]
+    self._gid = self._dao.CreateGame(self._admin).gameid
+
+  def _Play(self):
+    for other in self._others:
+      self._dao.JoinGame(self._gid, other)
+    for i, player in enumerate([self._admin, *self._others]):
+      self._dao.AddOption(self._gid, player, f'option {i}')
+    self._dao.SetPlayerToWatcher(self._gid, self._others[1], self._admin)
+    self._dao.RemoveOption(self._gid, self._admin, 0)
+    return self._dao.GetGameById(self._gid)
+
+  def _Fields(self, game) -> tuple:
+    return (list(game.players), list(game.watchers), list(game.must_add),
+            game.options, game.next_player, game.move_seq)
+
+  def test_movesAreNumberedInOrder(self):
+    self._Play()
+    moves = self._dao.GetMoves(self._gid)
+    self.assertEqual(list(range(1, 8)), [move.seq for move in moves])
+    self.assertEqual(['join', 'join', 'add', 'add', 'add', 'watch', 'del'],
+                     [move.kind for move in moves])
+    self.assertEqual([6, 7],
+                     [move.seq for move in self._dao.GetMoves(self._gid, 5)])
+    self.assertEqual({'seq': 3, 'kind': 'add', 'player': str(self._admin),
+                      'arg': 'option 0'}, moves[2].ToJson())
+
+  def test_snapshotPlusReplayIsTheLiveGame(self):
+    live = self._Fields(self._Play())
+    row, = self._dao.GetAll(pays_hoff_dao.PaysHoff, gameid=self._gid)
+    self.assertEqual(4, row.move_seq)
+    self._dao.Forget(self._gid)
+    self.assertEqual(live, self._Fields(self._dao.GetGameById(self._gid)))
+
+  def test_snapshotsSpreadOutInLargeRooms(self):
+    for _ in range(8):
+      self._dao.JoinGame(self._gid, uuid.uuid4())
+    game = self._dao.GetGameById(self._gid)
+    self.assertEqual(16, self._dao._SnapshotInterval(game))
+    row, = self._dao.GetAll(pays_hoff_dao.PaysHoff, gameid=self._gid)
+    self.assertEqual(0, row.move_seq)
+    for _ in range(8):
+      self._dao.AdminSkipNextUser(self._gid, self._admin)
+    row, = self._dao.GetAll(pays_hoff_dao.PaysHoff, gameid=self._gid)
+    self.assertEqual(16, row.move_seq)
+
+  def test_rejectedMovesAreNotLogged(self):
+    with self.assertRaises(http.HttpException):
+      self._dao.AddOption(self._gid, uuid.uuid4(), 'pizza')
+    self.assertEqual([], self._dao.GetMoves(self._gid))
+
+
+class SharedFileUnittests(unittest.TestCase):
+  def setup(self):
+    self._tf = tempfile.mkstemp()[1]
+    self._mine = pays_hoff_dao.PaysHoffDAO(self._tf, revalidate=0)
+    self._theirs = pays_hoff_dao.PaysHoffDAO(self._tf)
+    self._admin = uuid.uuid4()
+    self._gid = self._mine.CreateGame(self._admin).gameid
+
+  def cleanup(self):
+    os.remove(self._tf)
+
+  def test_lostNoticesAreCaughtUp(self):
+    cached = self._mine.GetGameById(self._gid)
+    self._theirs.AddOption(self._gid, self._admin, 'pizza')
+    game = self._mine.GetGameById(self._gid)
+    self.assertIsNot(cached, game)
+    self.assertEqual(['pizza'], game.options)
+    self.assertIs(game, self._mine.GetGameById(self._gid))
+
+  def test_lostRacesAreRetried(self):
+    stale = pays_hoff_dao.PaysHoffDAO(self._tf, revalidate=3600)
+    stale.GetGameById(self._gid)
+    self._theirs.AddOption(self._gid, self._admin, 'pizza')
+    game = stale.JoinGame(self._gid, uuid.uuid4())[0]
+    self.assertEqual(['pizza'], game.options)
+    self.assertEqual([1, 2], [m.seq for m in stale.GetMoves(self._gid)])
@@ -0,0 +1,133 @@
+
+import argparse
+import os
+import sqlite3
+
+from what2pick import sql_storage
+
+
+def _Schema(conn:sqlite3.Connection, tables) -> list:
+  '''(type, name, sql) for |tables| and their indexes, tables first.'''
+  marks = ','.join('?' * len(tables))
+  return conn.execute(
+    "SELECT type, name, sql FROM sqlite_master "
+    f"WHERE sql IS NOT NULL AND tbl_name IN ({marks}) "
+    "ORDER BY type != 'table'", tuple(tables)).fetchall()
+
+
+def ShardKeys(tables) -> dict:
+  '''The column each of the TableSpecs |tables| is sharded by, by table.'''
+  return {t.__tablespec_tablename__: t.__tablespec_shardkey__ for t in tables}
+
+
+def _ShardColumnIndex(conn:sqlite3.Connection, table:str,
+                      column:str|None) -> int|None:
+  '''The index of |column|, or of the primary key if |column| is None.'''
+  for cid, name, _, _, _, pk in conn.execute(f'PRAGMA table_info({table})'):
+    if name == column or (column is None and pk):
+      return cid
+  if column is not None:
+    raise ValueError(f'{table} has no column {column} to shard by')
+  return None
+
+
+def Reshard(source:str, source_shards:int, dest:str, dest_shards:int,
+            tables, batch:int = 1000) -> dict:
+  '''Copies the TableSpecs |tables| of a sharded database into new shards.
+
+  Only those tables are copied, with their indexes and schema_version rows;
+  anything else in the files, like the users kept unsharded next to the
+  first shard, is left alone. Rows are routed the way SQLStorageBase routes
+  them, by the hash of the column their TableSpec shards them by, so the
+  result can be opened with |dest_shards| shards. Rows without one go to the
+  first shard. The source is only read; the destination files must not
+  exist yet. Returns the number of rows copied per table.
+  '''
+  shard_keys = ShardKeys(tables)
+  sources = sql_storage.ShardFiles(source, source_shards)
+  targets = sql_storage.ShardFiles(dest, dest_shards)
+  for target in targets:
+    if os.path.exists(target):
+      raise ValueError(f'{target} already exists')
+  for path in sources:
+    if not os.path.exists(path):
+      raise ValueError(f'{path} does not exist')
+
+  readers = [sqlite3.connect(f'file:{p}?mode=ro', uri=True) for p in sources]
+  writers = [sqlite3.connect(t) for t in targets]
+  copied = {}
+  try:
+    schema = _Schema(readers[0], ['schema_version', *shard_keys])
+    for writer in writers:
+      writer.execute('PRAGMA journal_mode=WAL')
+      for _, _, sql in schema:
+        writer.execute(sql)
+    for kind, table, _ in schema:
+      if kind != 'table':
+        continue
+      if table == 'schema_version':
+        # Migrate's bookkeeping describes each file; every shard gets a copy.
+        marks = ','.join('?' * len(shard_keys))
+        rows = readers[0].execute(
+          f'SELECT * FROM schema_version WHERE tablename IN ({marks})',
+          tuple(shard_keys)).fetchall()
+        for writer in writers:
+          writer.executemany(
+            'INSERT INTO schema_version VALUES (?, ?, ?)', rows)
+        continue
+      skey = _ShardColumnIndex(readers[0], table, shard_keys.get(table))
+      copied[table] = 0
+      for reader in readers:
+        cursor = reader.execute(f'SELECT * FROM {table}')
+        columns = ','.join('?' * len(cursor.description))
+        query = f'INSERT INTO {table} VALUES ({columns})'
+        while rows := cursor.fetchmany(batch):
+          groups = {}
+          for row in rows:
+            shard = 0
+            if skey is not None:
+              shard = sql_storage.ShardOf(row[skey], dest_shards)
+            groups.setdefault(shard, []).append(row)
+          for shard, group in groups.items():
+            writers[shard].executemany(query, group)
+          copied[table] += len(rows)
+    for writer in writers:
+      writer.commit()
+  except:
+    for writer in writers:
+      writer.close()
+    for target in targets:
+      for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(target + suffix):
+          os.remove(target + suffix)
+    raise
+  finally:
+    for reader in readers:
+      reader.close()
+  for writer in writers:
+    writer.close()
+  return copied
+
+
+def GameTables() -> tuple:
+  '''The tables CreateApp's game_shards applies to; users are unsharded.'''
+  from what2pick import pays_hoff_dao
+  return pays_hoff_dao.PaysHoffDAO.TABLES
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description='Splits or merges the shards of a what2pick database.')
+  parser.add_argument('source', help='database file, as passed to the DAO')
+  parser.add_argument('--from-shards', type=int, default=1)
+  parser.add_argument('--to-shards', type=int, required=True)
+  parser.add_argument('--dest', help='defaults to the source database name')
+  args = parser.parse_args()
+  copied = Reshard(args.source, args.from_shards,
+                   args.dest or args.source, args.to_shards, GameTables())
+  for table, rows in copied.items():
+    print(f'{table}: {rows} rows')
+
+
+if __name__ == '__main__':
+  main()
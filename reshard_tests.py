@@ -0,0 +1,46 @@
+
+import os
+import shutil
+import sqlite3
+import tempfile
+
+from impulse.testing import unittest
+from what2pick import pays_hoff_dao
+from what2pick import reshard
+from what2pick import sql_storage
+from what2pick import user_dao
+from what2pick import what2pick_server
+
+
+class ReshardUnittests(unittest.TestCase):
+  def setup(self):
+    self._dir = tempfile.mkdtemp()
+    self._source = f'{self._dir}/storage.db'
+    what2pick_server.MigrateSchema(self._source)
+    users = user_dao.UserDAO(self._source)
+    self._user = users.CreateUser()
+    users.Close()
+    games = pays_hoff_dao.PaysHoffDAO(self._source)
+    self._gid = games.CreateGame(self._user.uid).gameid
+    games.AddOption(self._gid, self._user.uid, 'pizza')
+
+  def cleanup(self):
+    shutil.rmtree(self._dir)
+
+  def test_onlyGameTablesAreSharded(self):
+    dest = f'{self._dir}/resharded.db'
+    copied = reshard.Reshard(self._source, 1, dest, 3, reshard.GameTables())
+    self.assertEqual({'payshoff': 1, 'payshoff_moves': 1}, copied)
+    for path in sql_storage.ShardFiles(dest, 3):
+      with sqlite3.connect(path) as conn:
+        tables = {name for name, in conn.execute(
+          "SELECT name FROM sqlite_master WHERE type = 'table'")}
+        versions = {name for name, in conn.execute(
+          'SELECT tablename FROM schema_version')}
+      self.assertNotIn('users', tables)
+      self.assertEqual({'payshoff', 'payshoff_moves'}, versions)
+    self.assertFalse(os.path.exists(dest))
+    games = pays_hoff_dao.PaysHoffDAO(dest, shards=3)
+    self.assertEqual(['pizza'], games.GetGameById(self._gid).options)
+    self.assertEqual(
+      [1], [move.seq for move in games.GetMoves(self._gid)])
@@ -1,10 +1,26 @@
 
-import copy
+import concurrent.futures
+import contextlib
 import dataclasses
+import functools
+import hashlib
+import operator
+import os
+import queue
+import re
 import sqlite3
 import threading
 import time
 import uuid
+import zlib
+
+
+class UpdateConflict(Exception):
+  '''Raised when a versioned row was changed by someone since it was read.'''
+
+
+class PoolExhausted(Exception):
+  '''Raised when no pooled connection was freed within the checkout timeout.'''
 
 
 class UnixTime():
@@ -32,12 +48,17 @@ class TableColumnType():
     int: ('INTEGER', int, int),
     bool: ('INTEGER', int, bool),
     uuid.UUID: ('TEXT', str, uuid.UUID),
-    UnixTime: ('INTEGER', UnixTime.Now, UnixTime.FromTime)
+    UnixTime: ('INTEGER', UnixTime.Now, UnixTime.FromTime, True)
   }
 
   @staticmethod
-  def RegisterType(_type, sqltype, tosql, fromsql):
-    TableColumnType._typemap[_type] = (sqltype, tosql, fromsql)
+  def RegisterType(_type, sqltype, tosql, fromsql, always_dirty=False):
+    '''Maps |_type| to a column type.
+
+    Columns of an |always_dirty| type are written by every Update, which is
+    how UnixTime columns record the time of the last write.
+    '''
+    TableColumnType._typemap[_type] = (sqltype, tosql, fromsql, always_dirty)
 
   @staticmethod
   def TypeFor(_type):
@@ -46,8 +67,8 @@ class TableColumnType():
     if _type not in TableColumnType._typemap:
       print(f'Warning, unsupported type {_type} stored as a string')
       _type = str
-    sqlcol, tosql, fromsql = TableColumnType._typemap[_type]
-    return TableColumnType(sqlcol, fromsql, tosql)
+    sqlcol, tosql, fromsql, *always_dirty = TableColumnType._typemap[_type]
+    return TableColumnType(sqlcol, fromsql, tosql, *always_dirty)
 
   @staticmethod
   def SplitInto(value, sep, fn):
@@ -61,14 +82,23 @@ class TableColumnType():
       return ''
     return sep.join([str(fn(v)) for v in value])
 
-  def __init__(self, sqltext, fromsql, tosql):
+  def __init__(self, sqltext, fromsql, tosql, always_dirty=False, lazy=False):
     self._sqltext = sqltext
     self._fromsql = fromsql
     self._tosql = tosql
+    self._always_dirty = always_dirty
+    self._lazy = lazy
 
   def SqlText(self):
     return self._sqltext
 
+  def AlwaysDirty(self):
+    return self._always_dirty
+
+  def Lazy(self):
+    '''Whether rows keep this column's sql value until it is first read.'''
+    return self._lazy
+
   def FromSql(self, v):
     return self._fromsql(v)
 
@@ -82,124 +112,1304 @@ def PrimaryKey(_type):
   return tct
 
 
+class _RowVersionColumn(TableColumnType):
+  pass
+
+
+def RowVersion():
+  '''A column that Update uses for compare-and-swap.
+
+  Declare it with a default of 0. Update only writes a row whose version still
+  matches the one it was read with, increments it, and raises UpdateConflict
+  if the row moved on in the meantime.
+  '''
+  return _RowVersionColumn('INTEGER NOT NULL DEFAULT 0', int, int)
+
+
 def CSV(_type):
   tct = TableColumnType.TypeFor(_type)
   return TableColumnType('TEXT',
     lambda s: TableColumnType.SplitInto(s, ',', tct.FromSql),
-    lambda v: TableColumnType.JoinInto(v, ',', tct.ToSql))
+    lambda v: TableColumnType.JoinInto(v, ',', tct.ToSql),
+    lazy=True)
 
 
 def TSV(_type):
   tct = TableColumnType.TypeFor(_type)
   return TableColumnType('TEXT',
     lambda s: TableColumnType.SplitInto(s, '\t', tct.FromSql),
-    lambda v: TableColumnType.JoinInto(v, '\t', tct.ToSql))
+    lambda v: TableColumnType.JoinInto(v, '\t', tct.ToSql),
+    lazy=True)
+
+
+class OrderedSet():
+  '''A set that keeps insertion order, as a doubly linked hash.
+
+  Membership, append, remove and Next are O(1), where a list would scan, so
+  a game can hold thousands of players without each move paying for them.
+  Iteration, len and == behave like the list of its items. Like a dict, it
+  must not change while it is being iterated.
+  '''
+  __slots__ = ('_links', '_first', '_last')
+
+  def __init__(self, items=()):
+    self._links = {}
+    self._first = self._last = None
+    for item in items:
+      self.append(item)
+
+  def append(self, item):
+    '''Adds |item| at the end, unless it is already in the set.'''
+    if item in self._links:
+      return
+    self._links[item] = [self._last, None]
+    if self._last is None:
+      self._first = item
+    else:
+      self._links[self._last][1] = item
+    self._last = item
+
+  def remove(self, item):
+    if item not in self._links:
+      raise ValueError(f'{item} is not in the set')
+    before, after = self._links.pop(item)
+    if before is None:
+      self._first = after
+    else:
+      self._links[before][1] = after
+    if after is None:
+      self._last = before
+    else:
+      self._links[after][0] = before
+
+  def Next(self, item):
+    '''The item after |item|, wrapping around to the first.'''
+    if item not in self._links:
+      raise ValueError(f'{item} is not in the set')
+    after = self._links[item][1]
+    return self._first if after is None else after
+
+  def __contains__(self, item) -> bool:
+    return item in self._links
+
+  def __len__(self) -> int:
+    return len(self._links)
+
+  def __iter__(self):
+    item = self._first
+    while item is not None:
+      yield item
+      item = self._links[item][1]
+
+  def __eq__(self, other) -> bool:
+    if isinstance(other, (OrderedSet, list)):
+      return len(self) == len(other) and list(self) == list(other)
+    return NotImplemented
+
+  def __repr__(self) -> str:
+    return f'OrderedSet({list(self)!r})'
+
+
+def CSVSet(_type):
+  '''Stored exactly like CSV(_type), but read back as an OrderedSet.'''
+  tct = TableColumnType.TypeFor(_type)
+  return TableColumnType('TEXT',
+    lambda s: OrderedSet(TableColumnType.SplitInto(s, ',', tct.FromSql)),
+    lambda v: TableColumnType.JoinInto(v, ',', tct.ToSql),
+    lazy=True)
+
+
+class Index():
+  '''A secondary index for a TableSpec, on one or more of its columns.
+
+  |where| makes it a partial index, e.g. Index('last_access', where='decided
+  = 0') only covers open games.
+  '''
+  def __init__(self, *columns:str, unique:bool = False, where:str = None,
+               name:str = None):
+    if not columns:
+      raise ValueError('An index needs at least one column')
+    self._columns = columns
+    self._unique = unique
+    self._where = where
+    self._name = name
+
+  def Name(self, tablename:str) -> str:
+    return self._name or '_'.join(['idx', tablename, *self._columns])
+
+  def Columns(self) -> tuple:
+    return self._columns
+
+  def CreateQuery(self, tablename:str) -> str:
+    unique = 'UNIQUE ' if self._unique else ''
+    columns = ','.join(self._columns)
+    query = (f'CREATE {unique}INDEX IF NOT EXISTS {self.Name(tablename)} '
+             f'ON {tablename} ({columns})')
+    if self._where:
+      query += f' WHERE {self._where}'
+    return query
+
+
+class _TableCodec():
+  '''The SQL and per-column conversions for a TableSpec, compiled once.
+
+  Rows are snapshotted as the tuple of their encoded column values, which is
+  exactly what sqlite hands back on a read, so dirty tracking costs one
+  encode and a tuple comparison instead of a deep copy.
+  '''
+  def __init__(self, clazz):
+    fields = clazz.__tablespec_fields__
+    name = clazz.__tablespec_tablename__
+    pkey = clazz.__tablespec_primarykey__
+    version = clazz.__tablespec_rowversion__
+    self.columns = tuple(fields)
+    self.encoders = tuple(_EncodeLazily(t.ToSql) if t.Lazy() else t.ToSql
+                          for t in fields.values())
+    self.decoders = tuple(_Raw if t.Lazy() else t.FromSql
+                          for t in fields.values())
+    self.always_dirty = frozenset(
+      i for i, t in enumerate(fields.values()) if t.AlwaysDirty())
+    self.pkey = self.columns.index(pkey) if pkey else None
+    self.version = self.columns.index(version) if version else None
+    # Lazy columns are read straight from their slot so that encoding a row
+    # never forces them to be decoded.
+    self.getter = operator.attrgetter(*(
+      _RawSlot(c) if t.Lazy() else c for c, t in fields.items()))
+    if len(self.columns) == 1:
+      self.getter = lambda impl, get=self.getter: (get(impl),)
+    columns = ','.join(self.columns)
+    self.insert = (f'INSERT into {name} ({columns}) '
+                   f'values ({",".join("?" * len(self.columns))})')
+    self.select = f'SELECT {columns} FROM {name}'
+    self.delete = f'DELETE FROM {name} WHERE {pkey} is ?'
+    self._name = name
+    self._selects = {}
+    self._updates = {}
+
+  def Encode(self, impl) -> tuple:
+    return tuple(encode(value) for encode, value
+                 in zip(self.encoders, self.getter(impl)))
+
+  def Decode(self, row) -> list:
+    return [decode(value) for decode, value in zip(self.decoders, row)]
+
+  def Dirty(self, encoded:tuple, snapshot:tuple) -> tuple:
+    '''Indices of the columns to write, never including the row version.'''
+    return tuple(i for i, (now, then) in enumerate(zip(encoded, snapshot))
+                 if i != self.version and
+                    (now != then or i in self.always_dirty))
+
+  def Select(self, keys:tuple) -> str:
+    '''SELECT matching |keys|, a tuple of (column, is_null) pairs.'''
+    if keys not in self._selects:
+      query = self.select
+      if keys:
+        # '=' rather than 'is', so that partial indexes can match the query.
+        query += ' WHERE ' + ' AND '.join(
+          f'{f} is NULL' if null else f'{f} = :{f}' for f, null in keys)
+      self._selects[keys] = query
+    return self._selects[keys]
+
+  def Update(self, dirty:tuple) -> str:
+    if dirty not in self._updates:
+      setstr = ','.join(f'{self.columns[i]} = ?' for i in dirty)
+      where = f'{self.columns[self.pkey]} is ?'
+      if self.version is not None:
+        version = self.columns[self.version]
+        setstr += f', {version} = {version} + 1'
+        where += f' AND {version} = ?'
+      self._updates[dirty] = f'UPDATE {self._name} SET {setstr} WHERE {where}'
+    return self._updates[dirty]
+
+
+class _Raw():
+  '''A column value as it came from sqlite, not yet decoded.'''
+  __slots__ = ('value',)
+
+  def __init__(self, value):
+    self.value = value
+
+
+def _EncodeLazily(tosql):
+  return lambda v: v.value if type(v) is _Raw else tosql(v)
+
+
+def _RawSlot(name:str) -> str:
+  return f'__tablespec_{name}__'
 
 
-def TableSpec(tablename:str):
-  '''Converts a class into a dataclass with extra sql-y features.'''
+class _LazyColumn():
+  '''Decodes a column's raw sql value the first time the field is read.
+
+  Shared rows may be read from several threads at once; the lock makes sure
+  they all end up with the same decoded object, so no one mutates a copy.
+  '''
+  _lock = threading.Lock()
+
+  def __init__(self, slot, fromsql):
+    self._slot = slot
+    self._fromsql = fromsql
+
+  def __get__(self, impl, owner=None):
+    if impl is None:
+      return self
+    value = self._slot.__get__(impl, owner)
+    if type(value) is _Raw:
+      decoded = self._fromsql(value.value)
+      with _LazyColumn._lock:
+        value = self._slot.__get__(impl, owner)
+        if type(value) is _Raw:
+          self._slot.__set__(impl, decoded)
+          value = decoded
+    return value
+
+  def __set__(self, impl, value):
+    self._slot.__set__(impl, value)
+
+
+def _WithSlots(clazz, fields:dict):
+  '''Rebuilds a dataclass with __slots__ for its fields and its snapshot.
+
+  Lazy columns live in a separate slot behind a _LazyColumn descriptor.
+  '''
+  names = tuple(clazz.__dataclass_fields__)
+  lazy = [name for name, t in fields.items() if t.Lazy()]
+  namespace = {k:v for k,v in clazz.__dict__.items()
+               if k not in names and k not in ('__dict__', '__weakref__')}
+  namespace['__slots__'] = tuple(
+    _RawSlot(name) if name in lazy else name for name in names
+  ) + ('__tablespec_snapshot__',)
+  slotted = type(clazz)(clazz.__name__, clazz.__bases__, namespace)
+  slotted.__qualname__ = clazz.__qualname__
+  for name in lazy:
+    slot = slotted.__dict__[_RawSlot(name)]
+    setattr(slotted, name, _LazyColumn(slot, fields[name].FromSql))
+  return slotted
+
+
+def _SnapshotOf(impl) -> tuple|None:
+  return getattr(impl, '__tablespec_snapshot__', None)
+
+
+def TableSpec(tablename:str, indexes=(), shard_by:str|None = None):
+  '''Converts a class into a dataclass with extra sql-y features.
+
+  The class gets __slots__, and its SQL statements and column conversions are
+  compiled here once rather than on every query. Rows are sharded by their
+  primary key unless |shard_by| names another column, e.g. to keep rows that
+  belong to the same parent on the parent's shard.
+  '''
   def TableSpecWrapper(clazz):
     clazz = dataclasses.dataclass(clazz)
-    clazz.__tablespec_fields__ = {}
+    fields = {name: TableColumnType.TypeFor(field.type)
+              for name, field in clazz.__dataclass_fields__.items()}
+    clazz = _WithSlots(clazz, fields)
+    clazz.__tablespec_fields__ = fields
     clazz.__tablespec_tablename__ = tablename
-    clazz.__tablespec_preupdate__ = None
+    clazz.__tablespec_indexes__ = tuple(indexes)
     clazz.__tablespec_primarykey__ = None
-    for name, field in clazz.__dataclass_fields__.items():
-      clazz.__tablespec_fields__[name] = TableColumnType.TypeFor(field.type)
+    clazz.__tablespec_rowversion__ = None
+    for name in clazz.__dataclass_fields__:
       if 'PRIMARY KEY' in clazz.__tablespec_fields__[name].SqlText():
         clazz.__tablespec_primarykey__ = name
+      if isinstance(clazz.__tablespec_fields__[name], _RowVersionColumn):
+        clazz.__tablespec_rowversion__ = name
+    clazz.__tablespec_shardkey__ = shard_by or clazz.__tablespec_primarykey__
+    if shard_by is not None and shard_by not in fields:
+      raise ValueError(f'{tablename} has no column {shard_by} to shard by')
+    for index in clazz.__tablespec_indexes__:
+      for column in index.Columns():
+        if column not in clazz.__tablespec_fields__:
+          raise ValueError(f'{tablename} has no column {column} to index')
+    clazz.__tablespec_codec__ = _TableCodec(clazz)
     return clazz
   return TableSpecWrapper
 
 
+def _Chunks(iterable, size:int):
+  chunk = []
+  for item in iterable:
+    chunk.append(item)
+    if len(chunk) == size:
+      yield chunk
+      chunk = []
+  if chunk:
+    yield chunk
+
+
+def _GroupBy(items, key) -> list:
+  '''Groups |items| by |key|, keeping first-seen order of keys and items.'''
+  groups = {}
+  for item in items:
+    groups.setdefault(key(item), []).append(item)
+  return list(groups.items())
+
+
+_STATEMENT_TABLE = re.compile(
+  r'\b(?:FROM|INTO|UPDATE|TABLE(?:\s+IF\s+NOT\s+EXISTS)?|ON)\s+(\w+)',
+  re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=1024)
+def DescribeStatement(query:str) -> tuple:
+  '''Returns (kind, table) for a statement, e.g. ('UPDATE', 'users').
+
+  The table is '' for statements that do not name one, like COMMIT.
+  '''
+  words = query.split(None, 1)
+  kind = words[0].upper() if words else ''
+  match = _STATEMENT_TABLE.search(query)
+  return kind, match.group(1) if match else ''
+
+
+class _TimedConnection(sqlite3.Connection):
+  '''Reports execute, executemany and commit times to ConnectionPool.Time.
+
+  Rows fetched after execute returns are not included, so for a SELECT this
+  is the time to the first row, which includes waiting on database locks.
+  '''
+  def execute(self, query, *args):
+    timer = ConnectionPool._timer
+    if timer is None:
+      return super().execute(query, *args)
+    start = time.perf_counter()
+    try:
+      return super().execute(query, *args)
+    finally:
+      timer(query, time.perf_counter() - start)
+
+  def executemany(self, query, *args):
+    timer = ConnectionPool._timer
+    if timer is None:
+      return super().executemany(query, *args)
+    start = time.perf_counter()
+    try:
+      return super().executemany(query, *args)
+    finally:
+      timer(query, time.perf_counter() - start)
+
+  def commit(self):
+    timer = ConnectionPool._timer
+    if timer is None:
+      return super().commit()
+    start = time.perf_counter()
+    try:
+      return super().commit()
+    finally:
+      timer('COMMIT', time.perf_counter() - start)
+
+
+class _GroupCommitWriter():
+  '''Runs the writes to one database file on a single thread.
+
+  Jobs are callables taking a connection. The writer takes the first queued
+  job, gathers whatever else arrives within |window| seconds, up to
+  |max_batch| jobs, and runs them all in one transaction, so a burst of
+  writes shares one commit. Each job runs in its own savepoint, so one that
+  raises is rolled back alone and its future gets the exception. Futures
+  resolve once the whole batch is committed.
+  '''
+  def __init__(self, pool:'ConnectionPool', window:float,
+               max_batch:int = 256):
+    self._pool = pool
+    self._window = window
+    self._max_batch = max_batch
+    self._queue = queue.SimpleQueue()
+    threading.Thread(target=self._Loop, daemon=True).start()
+
+  def Submit(self, job) -> concurrent.futures.Future:
+    future = concurrent.futures.Future()
+    self._queue.put((job, future))
+    return future
+
+  def _Loop(self):
+    while True:
+      batch = [self._queue.get()]
+      deadline = time.monotonic() + self._window
+      while len(batch) < self._max_batch:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+          break
+        try:
+          batch.append(self._queue.get(timeout=remaining))
+        except queue.Empty:
+          break
+      self._Commit(batch)
+
+  def _Commit(self, batch:list):
+    outcomes = []
+    try:
+      with self._pool.Lease() as conn:
+        conn.execute('BEGIN')
+        for job, future in batch:
+          if not future.set_running_or_notify_cancel():
+            continue
+          conn.execute('SAVEPOINT job')
+          try:
+            outcomes.append((future, job(conn), None))
+          except Exception as e:
+            conn.execute('ROLLBACK TO job')
+            outcomes.append((future, None, e))
+          conn.execute('RELEASE job')
+        conn.commit()
+    except Exception as e:
+      for _, future in batch:
+        if not future.done():
+          future.set_exception(e)
+      return
+    for future, result, error in outcomes:
+      if error is None:
+        future.set_result(result)
+      else:
+        future.set_exception(error)
+
+
+class ConnectionPool():
+  '''A bounded pool of sqlite connections to one database file.
+
+  Connections are shared by every SQLStorageBase in the process that uses the
+  same file. A thread leases one connection at a time; nested leases on the
+  same thread reuse it. Connections left idle for |idle_timeout| seconds are
+  closed the next time the pool is used. A thread that finds all |size|
+  connections leased waits at most |checkout_timeout| seconds for one.
+  '''
+  PRAGMAS = (
+    'journal_mode=WAL',
+    'synchronous=NORMAL',
+    'mmap_size=268435456',
+    'cache_size=-16384',
+    'temp_store=MEMORY',
+  )
+
+  _pools = {}
+  _pools_lock = threading.Lock()
+  _tracer = None
+  _timer = None
+
+  @staticmethod
+  def _AfterFork():
+    # Connections inherited from the parent must not be used by the child,
+    # so every pool starts over without closing them.
+    for pool in ConnectionPool._pools.values():
+      pool._condition = threading.Condition()
+      pool._idle = []
+      pool._open = 0
+      pool._local = threading.local()
+      pool._writer = None
+
+  @staticmethod
+  def Pools() -> dict:
+    '''Every pool opened so far, by absolute database path.'''
+    with ConnectionPool._pools_lock:
+      return dict(ConnectionPool._pools)
+
+  @staticmethod
+  def Trace(callback):
+    '''Calls |callback| with the text of every statement run from now on.
+
+    The callback runs on the thread that executed the statement, and is
+    installed on each connection as it is checked out. None turns tracing off.
+    '''
+    ConnectionPool._tracer = callback
+
+  @staticmethod
+  def Time(callback):
+    '''Calls |callback|(query, seconds) after each execute and commit.
+
+    Commits are reported with the query 'COMMIT'. None turns timing off.
+    '''
+    ConnectionPool._timer = callback
+
+  @staticmethod
+  def For(dbfile:str, **options) -> 'ConnectionPool':
+    '''Returns the process-wide pool for |dbfile|.
+
+    |options| are passed to the constructor when the pool is first created,
+    and ignored after that.
+    '''
+    key = os.path.abspath(dbfile)
+    with ConnectionPool._pools_lock:
+      if key not in ConnectionPool._pools:
+        ConnectionPool._pools[key] = ConnectionPool(dbfile, **options)
+      return ConnectionPool._pools[key]
+
+  def __init__(self, dbfile:str, size:int = 8, idle_timeout:int = 300,
+               busy_timeout:float = 5.0, checkout_timeout:float = 30.0):
+    self._database_file = dbfile
+    self._size = size
+    self._checkout_timeout = checkout_timeout
+    self._idle_timeout = idle_timeout
+    self._busy_timeout = busy_timeout
+    self._condition = threading.Condition()
+    self._idle = []
+    self._open = 0
+    self._local = threading.local()
+    self._group_commit = 0
+    self._writer = None
+
+  def EnableGroupCommit(self, window:float):
+    '''Sends this file's single-row writes through one group-commit writer.'''
+    self._group_commit = window
+
+  def Writer(self) -> _GroupCommitWriter|None:
+    '''The group-commit writer, started on first use, if it is enabled.'''
+    if not self._group_commit:
+      return None
+    with self._condition:
+      if self._writer is None:
+        self._writer = _GroupCommitWriter(self, self._group_commit)
+      return self._writer
+
+  def _Open(self) -> sqlite3.Connection:
+    conn = sqlite3.connect(self._database_file, timeout=self._busy_timeout,
+                           check_same_thread=False, factory=_TimedConnection)
+    for pragma in ConnectionPool.PRAGMAS:
+      conn.execute(f'PRAGMA {pragma}')
+    return conn
+
+  def _Reap(self):
+    cutoff = time.monotonic() - self._idle_timeout
+    while self._idle and self._idle[0][1] < cutoff:
+      self._idle.pop(0)[0].close()
+      self._open -= 1
+
+  def Checkout(self) -> sqlite3.Connection:
+    conn = None
+    with self._condition:
+      self._Reap()
+      if not self._condition.wait_for(
+          lambda: self._idle or self._open < self._size,
+          self._checkout_timeout):
+        raise PoolExhausted(
+          f'all {self._size} connections to {self._database_file} stayed '
+          f'leased for {self._checkout_timeout}s')
+      if self._idle:
+        conn = self._idle.pop()[0]
+      else:
+        self._open += 1
+    if conn is None:
+      try:
+        conn = self._Open()
+      except:
+        with self._condition:
+          self._open -= 1
+          self._condition.notify()
+        raise
+    conn.set_trace_callback(ConnectionPool._tracer)
+    return conn
+
+  def Return(self, conn:sqlite3.Connection):
+    if conn.in_transaction:
+      conn.rollback()
+    with self._condition:
+      self._idle.append((conn, time.monotonic()))
+      self._condition.notify()
+
+  @contextlib.contextmanager
+  def Lease(self):
+    conn = getattr(self._local, 'conn', None)
+    if conn is not None:
+      yield conn
+      return
+    conn = self.Checkout()
+    self._local.conn = conn
+    try:
+      yield conn
+    finally:
+      self._local.conn = None
+      self.Return(conn)
+
+  def Stats(self) -> dict:
+    with self._condition:
+      return {
+        'open': self._open,
+        'idle': len(self._idle),
+        'size': self._size,
+      }
+
+
+# Passed as the database file to keep every table in process memory instead.
+MEMORY = ':memory:'
+
+
+class _MemoryTable():
+  '''One table's rows, kept as the encoded tuples sqlite would have stored.
+
+  Rows are keyed by their encoded primary key. Like a sqlite table, a new one
+  has no indexes; CreateIndexes gives each declared Index a dict from its
+  column values to the keys of matching rows.
+  '''
+  def __init__(self, clazz):
+    codec = clazz.__tablespec_codec__
+    self.codec = codec
+    self.positions = {column: i for i, column in enumerate(codec.columns)}
+    self.rows = {}
+    self.indexes = {}
+    self._rowids = iter(range(1 << 62))
+
+  def CreateIndexes(self, clazz):
+    '''Builds the declared indexes this table lacks over its current rows.'''
+    for index in clazz.__tablespec_indexes__:
+      columns = tuple(self.positions[c] for c in index.Columns())
+      if columns in self.indexes:
+        continue
+      self.indexes[columns] = built = {}
+      for key, row in self.rows.items():
+        built.setdefault(tuple(row[i] for i in columns), set()).add(key)
+
+  def _Index(self, key, row:tuple):
+    for columns, index in self.indexes.items():
+      index.setdefault(tuple(row[i] for i in columns), set()).add(key)
+
+  def _Unindex(self, key, row:tuple):
+    for columns, index in self.indexes.items():
+      values = tuple(row[i] for i in columns)
+      index[values].discard(key)
+      if not index[values]:
+        del index[values]
+
+  def Insert(self, row:tuple):
+    if self.codec.pkey is None:
+      key = next(self._rowids)
+    else:
+      key = row[self.codec.pkey]
+      if key in self.rows:
+        raise sqlite3.IntegrityError(
+          f'UNIQUE constraint failed: {self.codec.columns[self.codec.pkey]}')
+    self.rows[key] = row
+    self._Index(key, row)
+
+  def Update(self, encoded:tuple, snapshot:tuple) -> int:
+    '''Writes the columns of |encoded| that differ from |snapshot|.
+
+    Like the sqlite UPDATE, other columns keep whatever is stored and a row
+    version must still match the snapshot's. Returns the rows changed.
+    '''
+    codec = self.codec
+    key = encoded[codec.pkey]
+    stored = self.rows.get(key)
+    if stored is None:
+      return 0
+    row = list(stored)
+    if codec.version is not None:
+      if stored[codec.version] != snapshot[codec.version]:
+        return 0
+      row[codec.version] += 1
+    for i in codec.Dirty(encoded, snapshot):
+      row[i] = encoded[i]
+    self._Unindex(key, stored)
+    self.rows[key] = tuple(row)
+    self._Index(key, self.rows[key])
+    return 1
+
+  def Delete(self, key):
+    row = self.rows.pop(key, None)
+    if row is not None:
+      self._Unindex(key, row)
+
+  def Select(self, keys:dict) -> list:
+    '''The stored rows whose encoded columns equal the encoded |keys|.'''
+    wanted = [(self.positions[column], v) for column, v in keys.items()]
+    positions = {i for i, _ in wanted}
+    values = dict(wanted)
+    pkey = self.codec.pkey
+    if pkey in positions:
+      candidates = [self.rows.get(values[pkey])]
+    else:
+      candidates = self.rows.values()
+      for columns, index in self.indexes.items():
+        if positions.issuperset(columns):
+          keys = index.get(tuple(values[i] for i in columns), ())
+          candidates = [self.rows[key] for key in keys]
+          break
+    return [row for row in candidates
+            if row is not None and all(row[i] == v for i, v in wanted)]
+
+
+class _MemoryTables():
+  '''The MEMORY engine: every table of one SQLStorageBase, under one lock.'''
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._tables = {}
+
+  def Table(self, clazz) -> _MemoryTable:
+    name = clazz.__tablespec_tablename__
+    if name not in self._tables:
+      raise sqlite3.OperationalError(f'no such table: {name}')
+    return self._tables[name]
+
+  def CreateTable(self, clazz):
+    with self._lock:
+      if clazz.__tablespec_tablename__ not in self._tables:
+        self._tables[clazz.__tablespec_tablename__] = _MemoryTable(clazz)
+
+  def Migrate(self, clazz):
+    '''Creates |clazz|'s table if need be and then its missing indexes.'''
+    with self._lock:
+      name = clazz.__tablespec_tablename__
+      if name not in self._tables:
+        self._tables[name] = _MemoryTable(clazz)
+      self._tables[name].CreateIndexes(clazz)
+
+  def Insert(self, clazz, row:tuple):
+    with self._lock:
+      self.Table(clazz).Insert(row)
+
+  def Update(self, clazz, encoded:tuple, snapshot:tuple) -> int:
+    with self._lock:
+      return self.Table(clazz).Update(encoded, snapshot)
+
+  def Delete(self, clazz, key):
+    with self._lock:
+      self.Table(clazz).Delete(key)
+
+  def Select(self, clazz, keys:dict) -> list:
+    with self._lock:
+      return self.Table(clazz).Select(keys)
+
+
+def ShardFiles(dbfile:str, shards:int) -> list:
+  '''The database files holding |shards| shards of |dbfile|.
+
+  A single shard is |dbfile| itself, so unsharded databases keep their name.
+  '''
+  if shards == 1:
+    return [dbfile]
+  base, ext = os.path.splitext(dbfile)
+  return [f'{base}-{shard}{ext}' for shard in range(shards)]
+
+
+def ShardOf(key, shards:int) -> int:
+  '''The shard holding the row whose encoded primary key is |key|.'''
+  if shards == 1:
+    return 0
+  return zlib.crc32(str(key).encode()) % shards
+
+
+os.register_at_fork(after_in_child=ConnectionPool._AfterFork)
+
+
+def _CreateTableQuery(_type) -> str:
+  fields = _type.__tablespec_fields__
+  name = _type.__tablespec_tablename__
+  columns = ','.join([f'{k} {t.SqlText()}' for k,t in fields.items()])
+  return f'CREATE TABLE IF NOT EXISTS {name} ({columns})'
+
+
+def _ColumnDefinition(_type, column:str) -> str:
+  '''A column definition for ALTER TABLE, defaulting to the field default.'''
+  type_ = _type.__tablespec_fields__[column]
+  definition = f'{column} {type_.SqlText()}'
+  default = _type.__dataclass_fields__[column].default
+  if default in (dataclasses.MISSING, None) or 'DEFAULT' in definition:
+    return definition
+  default = type_.ToSql(default)
+  if isinstance(default, str):
+    default = "'" + default.replace("'", "''") + "'"
+  return f'{definition} DEFAULT {default}'
+
+
+def Fingerprint(_type) -> str:
+  '''Changes whenever the columns or indexes of a TableSpec do.'''
+  name = _type.__tablespec_tablename__
+  schema = [_CreateTableQuery(_type)]
+  schema += [_ColumnDefinition(_type, c) for c in _type.__tablespec_fields__]
+  schema += [i.CreateQuery(name) for i in _type.__tablespec_indexes__]
+  return hashlib.sha256('\n'.join(schema).encode()).hexdigest()[:16]
+
+
+class Backfill():
+  '''Fills in |column| of |_type| for rows stored before it was added.
+
+  |compute| gets each such row as a dict of its stored column values and
+  returns the new column's value. Only rows where the column is NULL are
+  touched, so the column should not have a default, and an interrupted
+  backfill picks up where it left off.
+  '''
+  def __init__(self, _type, column:str, compute):
+    if column not in _type.__tablespec_fields__:
+      raise ValueError(f'{_type.__tablespec_tablename__} has no {column}')
+    self.type = _type
+    self.column = column
+    self.compute = compute
+
+  def Run(self, conn:sqlite3.Connection, batch:int) -> int:
+    '''Backfills |batch| rows per transaction; returns the rows filled.'''
+    name = self.type.__tablespec_tablename__
+    type_ = self.type.__tablespec_fields__[self.column]
+    select = (f'SELECT rowid, * FROM {name} WHERE {self.column} IS NULL '
+              'AND rowid > ? ORDER BY rowid LIMIT ?')
+    update = f'UPDATE {name} SET {self.column} = ? WHERE rowid = ?'
+    filled = 0
+    last = -1
+    while True:
+      conn.execute('BEGIN IMMEDIATE')
+      cursor = conn.execute(select, (last, batch))
+      columns = [d[0] for d in cursor.description[1:]]
+      rows = cursor.fetchall()
+      values = []
+      for rowid, *row in rows:
+        value = self.compute(dict(zip(columns, row)))
+        if value is not None:
+          values.append((type_.ToSql(value), rowid))
+      conn.executemany(update, values)
+      conn.commit()
+      filled += len(values)
+      if len(rows) < batch:
+        return filled
+      last = rows[-1][0]
+
+
+_SCHEMA_VERSION = ('CREATE TABLE IF NOT EXISTS schema_version ('
+                   'tablename TEXT PRIMARY KEY, fingerprint TEXT, '
+                   'migrated INTEGER)')
+_migrated = set()
+_migrate_lock = threading.Lock()
+
+
+def _MigrateTable(conn:sqlite3.Connection, _type) -> list:
+  '''Creates |_type|'s table, or adds its missing columns and indexes.'''
+  name = _type.__tablespec_tablename__
+  steps = []
+  existing = {row[1] for row in conn.execute(f'PRAGMA table_info({name})')}
+  if not existing:
+    conn.execute(_CreateTableQuery(_type))
+    steps.append(f'create {name}')
+  for column in _type.__tablespec_fields__:
+    if existing and column not in existing:
+      conn.execute(f'ALTER TABLE {name} ADD COLUMN '
+                   f'{_ColumnDefinition(_type, column)}')
+      steps.append(f'add {name}.{column}')
+  indexes = {row[0] for row in conn.execute(
+    "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ?",
+    (name,))}
+  for index in _type.__tablespec_indexes__:
+    if index.Name(name) not in indexes:
+      conn.execute(index.CreateQuery(name))
+      steps.append(f'index {index.Name(name)}')
+  return steps
+
+
+def Migrate(dbfile:str, tables, shards:int = 1, backfills=(),
+            batch:int = 500) -> list:
+  '''Brings the |tables| stored in |dbfile| up to date with their TableSpecs.
+
+  Each table's Fingerprint is kept in a schema_version table, so a database
+  that is already up to date costs one query per shard, and only once per
+  process. Otherwise the missing tables, columns and indexes are added in
+  one transaction per shard, then |backfills| for those tables are run in
+  transactions of |batch| rows. Returns the steps taken, for logging.
+  '''
+  steps = []
+  with _migrate_lock:
+    for path in ShardFiles(dbfile, shards):
+      path = os.path.abspath(path)
+      pending = [t for t in tables
+                 if (path, t.__tablespec_tablename__) not in _migrated]
+      if not pending:
+        continue
+      with ConnectionPool.For(path).Lease() as conn:
+        conn.execute(_SCHEMA_VERSION)
+        conn.commit()
+        stored = dict(conn.execute(
+          'SELECT tablename, fingerprint FROM schema_version'))
+        stale = [t for t in pending
+                 if stored.get(t.__tablespec_tablename__) != Fingerprint(t)]
+        if stale:
+          conn.execute('BEGIN IMMEDIATE')
+          for _type in stale:
+            steps.extend(_MigrateTable(conn, _type))
+          conn.commit()
+          for backfill in backfills:
+            if backfill.type in stale:
+              filled = backfill.Run(conn, batch)
+              steps.append(f'backfill {backfill.type.__tablespec_tablename__}'
+                           f'.{backfill.column}: {filled} rows')
+          conn.executemany(
+            'INSERT OR REPLACE INTO schema_version VALUES (?, ?, ?)',
+            [(t.__tablespec_tablename__, Fingerprint(t), int(time.time()))
+             for t in stale])
+          conn.commit()
+      _migrated.update((path, t.__tablespec_tablename__) for t in pending)
+  return steps
+
+
 class SQLStorageBase():
-  def __init__(self, dbfile:str):
-    self._conn_map:typing.Mapping[int, sqlite3.Connection] = {}
+  '''Stores TableSpec rows in one or more sqlite files.
+
+  With |shards| > 1, rows are spread over ShardFiles(dbfile, shards) by a hash
+  of their primary key, and each file has its own pool and writer lock. Reads
+  by primary key go to one shard; anything else asks every shard.
+
+  A |dbfile| of MEMORY keeps the tables in dicts instead, with the same
+  primary key, dirty tracking and row version semantics, and no sqlite at
+  all; it is meant for tests and load tests, and ignores |shards|.
+
+  With |group_commit| set, Insert, Update and Delete are handed to one writer
+  thread per file, which commits everything queued within that many seconds
+  in a single transaction; the calls still return only once their write is
+  committed. The setting applies to every user of the same files.
+  '''
+  def __init__(self, dbfile:str, shards:int = 1, group_commit:float = 0):
     self._database_file:str = dbfile
+    self._memory = None
+    self._pools = []
+    if dbfile == MEMORY:
+      self._memory = _MemoryTables()
+    else:
+      self._pools = [
+        ConnectionPool.For(f) for f in ShardFiles(dbfile, shards)]
+    if group_commit:
+      for pool in self._pools:
+        pool.EnableGroupCommit(group_commit)
+
+  def Connection(self, shard:int = 0):
+    '''Leases a pooled connection for the duration of a with block.'''
+    return self._pools[shard].Lease()
+
+  def _Write(self, shard:int, job):
+    '''Runs |job|(connection) and commits it, returning what |job| returned.'''
+    if writer := self._pools[shard].Writer():
+      return writer.Submit(job).result()
+    with self.Connection(shard) as conn:
+      result = job(conn)
+      conn.commit()
+      return result
 
-  def Connection(self, on_create_cb=lambda _:None) -> sqlite3.Connection:
-    thread_id = threading.get_ident()
-    if thread_id in self._conn_map:
-      return self._conn_map[thread_id]
-    self._conn_map[thread_id] = sqlite3.connect(self._database_file)
-    on_create_cb(self._conn_map[thread_id])
-    return self._conn_map[thread_id]
+  def Shards(self) -> range:
+    return range(len(self._pools))
 
-  def Cursor(self, on_connect_db=lambda _:None) -> sqlite3.Connection:
-    return self.Connection(on_connect_db).cursor()
+  def _ShardOf(self, impl) -> int:
+    skey = impl.__tablespec_shardkey__
+    if skey is None or len(self._pools) == 1:
+      return 0
+    key = impl.__tablespec_fields__[skey].ToSql(getattr(impl, skey))
+    return ShardOf(key, len(self._pools))
+
+  def _ShardsFor(self, clazz, keys:dict):
+    '''The shards that can hold rows matching |keys|.'''
+    skey = clazz.__tablespec_shardkey__
+    if skey not in keys or keys[skey] is None:
+      return self.Shards()
+    key = clazz.__tablespec_fields__[skey].ToSql(keys[skey])
+    return [ShardOf(key, len(self._pools))]
+
+  def Migrate(self, *tables, backfills=()) -> list:
+    '''Runs Migrate for |tables| over this storage's files.
+
+    This is cheap once the application has migrated at startup. The MEMORY
+    engine has no files or columns to migrate; like sqlite, it creates the
+    tables and any indexes they lack.
+    '''
+    if self._memory is not None:
+      for _type in tables:
+        self._memory.Migrate(_type)
+      return []
+    return Migrate(self._database_file, tables, len(self._pools), backfills)
 
   def CreateTableForType(self, _type, noexec=False):
+    '''Creates |_type|'s table if it does not exist, and nothing else.
+
+    Columns and indexes added to the TableSpec later are left to Migrate.
+    '''
     if not hasattr(_type, '__tablespec_tablename__'):
       raise ValueError(f'{_type} must be a |sql_storage.TableSpec|')
-    fields = _type.__tablespec_fields__
-    name = _type.__tablespec_tablename__
-    columns = ','.join([f'{k} {t.SqlText()}' for k,t in fields.items()])
-    query = f'CREATE TABLE IF NOT EXISTS {name} ({columns})'
-    if not noexec:
-      self.Cursor().execute(query)
-      self.Connection().commit()
+    query = _CreateTableQuery(_type)
+    if noexec:
+      return query
+    if self._memory is not None:
+      self._memory.CreateTable(_type)
+      return query
+    for shard in self.Shards():
+      with self.Connection(shard) as conn:
+        conn.execute(query)
+        conn.commit()
     return query
 
+  def IndexQueriesForType(self, _type) -> list:
+    if not hasattr(_type, '__tablespec_tablename__'):
+      raise ValueError(f'{_type} must be a |sql_storage.TableSpec|')
+    name = _type.__tablespec_tablename__
+    return [index.CreateQuery(name) for index in _type.__tablespec_indexes__]
+
   def Insert(self, impl, noexec=False):
-    if not hasattr(impl, '__tablespec_tablename__'):
-      raise ValueError(f'{impl} must be a |sql_storage.TableSpec|')
-    fields = impl.__tablespec_fields__
-    name = impl.__tablespec_tablename__
-    columns = ','.join(fields.keys())
-    values = ','.join(f':{field}' for field in fields.keys())
-    rawdata = {k:v.ToSql(getattr(impl,k)) for k,v in fields.items()}
-    query = f'INSERT into {name} ({columns}) values ({values})'
-    if not noexec:
-      self.Cursor().execute(query, rawdata)
-      self.Connection().commit()
+    query, rawdata = self._InsertStatement(impl)
+    if noexec:
+      return query, rawdata
+    if self._memory is not None:
+      self._memory.Insert(type(impl), rawdata)
+    else:
+      self._Write(self._ShardOf(impl), lambda c: c.execute(query, rawdata))
+    impl.__tablespec_snapshot__ = rawdata
     return query, rawdata
 
+  def InsertMany(self, impls, chunk_size:int = 1000) -> int:
+    '''Inserts |impls| with one executemany and commit per chunk and shard.'''
+    inserted = 0
+    if self._memory is not None:
+      for impl in impls:
+        self.Insert(impl)
+        inserted += 1
+      return inserted
+    for chunk in _Chunks(impls, chunk_size):
+      for shard, rows in _GroupBy(chunk, self._ShardOf):
+        statements = [self._InsertStatement(impl) for impl in rows]
+        with self.Connection(shard) as conn:
+          for query, group in _GroupBy(statements, lambda s: s[0]):
+            conn.executemany(query, [rawdata for _, rawdata in group])
+          conn.commit()
+        for impl, (_, rawdata) in zip(rows, statements):
+          impl.__tablespec_snapshot__ = rawdata
+      inserted += len(chunk)
+    return inserted
+
   def Update(self, impl):
     if not hasattr(impl, '__tablespec_primarykey__'):
       raise ValueError(f'{impl} must be a |sql_storage.TableSpec|')
-    sets = {}
-    name = impl.__tablespec_tablename__
-    pkey = impl.__tablespec_primarykey__
-    fields = impl.__tablespec_fields__
-    if not impl.__tablespec_preupdate__:
+    if not _SnapshotOf(impl):
       self.Insert(impl)
       return
-    for field, original in impl.__tablespec_preupdate__.items():
-      current = getattr(impl, field)
-      if current != original:
-        sets[field] = current
-    if not sets:
+    statement = self._UpdateStatement(impl)
+    if not statement:
       return
-    rawdata = {k:v.ToSql(getattr(impl,k)) for k,v in fields.items()}
-    setstr = ','.join([f'{n} = :{n}' for n in sets])
-    query = f'UPDATE {name} SET {setstr} WHERE {pkey} is :{pkey}'
-    self.Cursor().execute(query, rawdata)
-    self.Connection().commit()
+    query, params, encoded = statement
+    if self._memory is not None:
+      updated = self._memory.Update(
+        type(impl), encoded, impl.__tablespec_snapshot__)
+    else:
+      updated = self._Write(
+        self._ShardOf(impl), lambda c: c.execute(query, params).rowcount)
+    self._Updated(impl, encoded, updated)
+
+  def UpdateMany(self, impls, chunk_size:int = 1000) -> int:
+    '''Updates |impls| with one commit per chunk and shard.
+
+    Rows that change the same columns share an executemany. Versioned rows are
+    executed one at a time so each can be checked; those that lost a race are
+    not written, and an UpdateConflict listing them is raised once every
+    chunk has been committed.
+    '''
+    updated = 0
+    conflicts = []
+    for chunk in _Chunks(impls, chunk_size):
+      if self._memory is not None:
+        updated += self._UpdateRowsInMemory(chunk, conflicts)
+        continue
+      for shard, rows in _GroupBy(chunk, self._ShardOf):
+        with self.Connection(shard) as conn:
+          updated += self._UpdateRows(conn, rows, conflicts)
+    if conflicts:
+      raise UpdateConflict(f'{len(conflicts)} rows were changed', conflicts)
+    return updated - len(conflicts)
+
+  def _UpdateRows(self, conn, rows:list, conflicts:list) -> int:
+    inserts = [(impl, *self._InsertStatement(impl))
+               for impl in rows if not _SnapshotOf(impl)]
+    for query, group in _GroupBy(inserts, lambda s: s[1]):
+      conn.executemany(query, [rawdata for _, _, rawdata in group])
+    statements = []
+    for impl in rows:
+      if _SnapshotOf(impl):
+        if statement := self._UpdateStatement(impl):
+          statements.append((impl, *statement))
+    for query, group in _GroupBy(statements, lambda s: s[1]):
+      if group[0][0].__tablespec_rowversion__:
+        counts = [conn.execute(query, p).rowcount for _, _, p, _ in group]
+      else:
+        conn.executemany(query, [p for _, _, p, _ in group])
+        counts = [1] * len(group)
+      for (impl, _, _, encoded), count in zip(group, counts):
+        if count == 1:
+          self._Updated(impl, encoded, count)
+        else:
+          conflicts.append(impl)
+    conn.commit()
+    for impl, _, rawdata in inserts:
+      impl.__tablespec_snapshot__ = rawdata
+    return len(inserts) + len(statements)
+
+  def _UpdateRowsInMemory(self, rows:list, conflicts:list) -> int:
+    updated = 0
+    for impl in rows:
+      if _SnapshotOf(impl) and not self._UpdateStatement(impl):
+        continue
+      try:
+        self.Update(impl)
+      except UpdateConflict:
+        conflicts.append(impl)
+      updated += 1
+    return updated
+
+  def _InsertStatement(self, impl):
+    if not hasattr(impl, '__tablespec_tablename__'):
+      raise ValueError(f'{impl} must be a |sql_storage.TableSpec|')
+    codec = impl.__tablespec_codec__
+    return codec.insert, codec.Encode(impl)
+
+  def _UpdateStatement(self, impl):
+    '''Returns (query, params, encoded) writing |impl|'s dirty columns.
+
+    Only the dirty columns are bound. Returns None if nothing changed.
+    '''
+    codec = impl.__tablespec_codec__
+    snapshot = impl.__tablespec_snapshot__
+    encoded = codec.Encode(impl)
+    dirty = codec.Dirty(encoded, snapshot)
+    if not dirty:
+      return None
+    params = [encoded[i] for i in dirty]
+    params.append(encoded[codec.pkey])
+    if codec.version is not None:
+      params.append(snapshot[codec.version])
+    return codec.Update(dirty), params, encoded
+
+  def _Updated(self, impl, encoded:tuple, rowcount:int):
+    codec = impl.__tablespec_codec__
+    if codec.version is not None:
+      if rowcount != 1:
+        pkey = encoded[codec.pkey]
+        raise UpdateConflict(
+          f'{impl.__tablespec_tablename__} {pkey} was changed')
+      version = impl.__tablespec_snapshot__[codec.version] + 1
+      setattr(impl, codec.columns[codec.version], version)
+      encoded = (encoded[:codec.version] + (version,) +
+                 encoded[codec.version + 1:])
+    impl.__tablespec_snapshot__ = encoded
 
   def GetAll(self, clazz, **keys):
     if not hasattr(clazz, '__tablespec_tablename__'):
       raise ValueError(f'{clazz} must be a |sql_storage.TableSpec|')
     fields = clazz.__tablespec_fields__
-    name = clazz.__tablespec_tablename__
-    columns = ','.join(fields.keys())
-    querystr = 'AND'.join([f'{f} is :{f}' for f in keys.keys()])
-    query = f'SELECT {columns} FROM {name} WHERE {querystr}'
     typed_keys = {k:fields[k].ToSql(v) for k,v in keys.items()}
-    games = self.Cursor().execute(query, typed_keys).fetchall()
-    self.Connection().commit()
-    for unpacked_game in games:
-      constructor_params = {}
-      for value, (name, type_) in zip(unpacked_game, fields.items()):
-        constructor_params[name] = type_.FromSql(value)
-      impl = clazz(**constructor_params)
-      impl.__tablespec_preupdate__ = copy.deepcopy(constructor_params)
-      yield impl
+    if self._memory is not None:
+      for row in self._memory.Select(clazz, typed_keys):
+        yield self._FromRow(clazz, row)
+      return
+    query = clazz.__tablespec_codec__.Select(
+      tuple((k, v is None) for k,v in keys.items()))
+    for shard in self._ShardsFor(clazz, keys):
+      with self.Connection(shard) as conn:
+        games = conn.execute(query, typed_keys).fetchall()
+      for unpacked_game in games:
+        yield self._FromRow(clazz, unpacked_game)
+
+  def GetAllAfter(self, clazz, field:str, after, **keys) -> list:
+    '''Like GetAll, but only rows whose |field| is greater than |after|.
+
+    The rows are returned in |field| order, so an index over the |keys|
+    columns followed by |field| answers this with a single range scan.
+    '''
+    if not hasattr(clazz, '__tablespec_tablename__'):
+      raise ValueError(f'{clazz} must be a |sql_storage.TableSpec|')
+    fields = clazz.__tablespec_fields__
+    typed_keys = {k:fields[k].ToSql(v) for k,v in keys.items()}
+    bound = fields[field].ToSql(after)
+    if self._memory is not None:
+      table = self._memory.Table(clazz)
+      position = table.positions[field]
+      rows = sorted((row for row in self._memory.Select(clazz, typed_keys)
+                     if row[position] > bound), key=lambda r: r[position])
+      return [self._FromRow(clazz, row) for row in rows]
+    query = clazz.__tablespec_codec__.Select(
+      tuple((k, v is None) for k,v in keys.items()))
+    query += (' AND ' if keys else ' WHERE ') + (
+      f'{field} > :after__ ORDER BY {field}')
+    params = dict(typed_keys, after__=bound)
+    rows = []
+    for shard in self._ShardsFor(clazz, keys):
+      with self.Connection(shard) as conn:
+        rows.extend(conn.execute(query, params).fetchall())
+    if len(self._pools) > 1:
+      position = clazz.__tablespec_codec__.columns.index(field)
+      rows.sort(key=lambda r: r[position])
+    return [self._FromRow(clazz, row) for row in rows]
+
+  def GetAllWhereIn(self, clazz, field:str, values, chunk_size:int = 500):
+    '''Like GetAll, but matches every row whose |field| is one of |values|.'''
+    return self.GetMany(clazz, ({field: v} for v in values), chunk_size)
+
+  def GetMany(self, clazz, keysets, chunk_size:int = 500):
+    '''Yields the rows matching any of |keysets|, each a dict like GetAll's.
+
+    Key sets over the same columns are looked up together with a row-value
+    IN (...) query, |chunk_size| key sets per statement to stay under
+    sqlite's limit on host parameters. Key sets naming the primary key are
+    only looked up on their own shard.
+    '''
+    if not hasattr(clazz, '__tablespec_tablename__'):
+      raise ValueError(f'{clazz} must be a |sql_storage.TableSpec|')
+    if self._memory is not None:
+      yield from self._GetManyInMemory(clazz, keysets)
+      return
+    keysets = list(keysets)
+    for shards, group in _GroupBy(
+        keysets, lambda keys: tuple(self._ShardsFor(clazz, keys))):
+      for shard in shards:
+        yield from self._GetManyOnShard(clazz, shard, group, chunk_size)
+
+  def _GetManyOnShard(self, clazz, shard:int, keysets:list, chunk_size:int):
+    fields = clazz.__tablespec_fields__
+    select = clazz.__tablespec_codec__.select
+    shapes = _GroupBy(keysets, lambda keys: tuple(sorted(keys)))
+    for shape, group in shapes:
+      for chunk in _Chunks(group, chunk_size):
+        params = [fields[f].ToSql(keys[f]) for keys in chunk for f in shape]
+        if len(shape) == 1:
+          match = f'{shape[0]} IN ({",".join("?" * len(chunk))})'
+        else:
+          row = '(' + ','.join('?' * len(shape)) + ')'
+          match = (f'({",".join(shape)}) IN '
+                   f'(VALUES {",".join([row] * len(chunk))})')
+        query = f'{select} WHERE {match}'
+        with self.Connection(shard) as conn:
+          rows = conn.execute(query, params).fetchall()
+        for row in rows:
+          yield self._FromRow(clazz, row)
+
+  def _GetManyInMemory(self, clazz, keysets):
+    fields = clazz.__tablespec_fields__
+    seen = set()
+    for keys in keysets:
+      typed_keys = {k: fields[k].ToSql(v) for k, v in keys.items()}
+      for row in self._memory.Select(clazz, typed_keys):
+        if row not in seen:
+          seen.add(row)
+          yield self._FromRow(clazz, row)
+
+  def _FromRow(self, clazz, row:tuple):
+    impl = clazz(*clazz.__tablespec_codec__.Decode(row))
+    impl.__tablespec_snapshot__ = row
+    return impl
 
   def Delete(self, impl):
+    query, params = self._DeleteStatement(impl)
+    if self._memory is not None:
+      self._memory.Delete(type(impl), params[0])
+      return
+    self._Write(self._ShardOf(impl), lambda c: c.execute(query, params))
+
+  def DeleteMany(self, impls, chunk_size:int = 1000) -> int:
+    '''Deletes |impls| with one executemany and commit per chunk and shard.'''
+    deleted = 0
+    if self._memory is not None:
+      for impl in impls:
+        self.Delete(impl)
+        deleted += 1
+      return deleted
+    for chunk in _Chunks(impls, chunk_size):
+      for shard, rows in _GroupBy(chunk, self._ShardOf):
+        statements = [self._DeleteStatement(impl) for impl in rows]
+        with self.Connection(shard) as conn:
+          for query, group in _GroupBy(statements, lambda s: s[0]):
+            conn.executemany(query, [params for _, params in group])
+          conn.commit()
+      deleted += len(chunk)
+    return deleted
+
+  def _DeleteStatement(self, impl):
     if not hasattr(impl, '__tablespec_primarykey__'):
       raise ValueError(f'{impl} must be a |sql_storage.TableSpec|')
     pkey = impl.__tablespec_primarykey__
-    name = impl.__tablespec_tablename__
-    query = f'DELETE FROM {name} WHERE {pkey} is :pkey_value'
-    self.Cursor().execute(query, {'pkey_value': getattr(impl, pkey)})
-    self.Connection().commit()
+    pkey_type = impl.__tablespec_fields__[pkey]
+    codec = impl.__tablespec_codec__
+    return codec.delete, (pkey_type.ToSql(getattr(impl, pkey)),)
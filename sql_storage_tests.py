@@ -1,10 +1,13 @@
 
 import os
+import sqlite3
 import tempfile
+import threading
 import time
 import uuid
 
 from impulse.testing import unittest
+from what2pick import reshard
 from what2pick import sql_storage
 
 
@@ -20,6 +23,47 @@ class PaysHoff:
   last_access: sql_storage.UnixTime
 
 
+@sql_storage.TableSpec('versioned')
+class Versioned:
+  key: sql_storage.PrimaryKey(str)
+  value: int
+  version: sql_storage.RowVersion() = 0
+
+
+@sql_storage.TableSpec('indexed', indexes=[
+  sql_storage.Index('owner'),
+  sql_storage.Index('age', where='done = 0'),
+])
+class Indexed:
+  key: sql_storage.PrimaryKey(str)
+  owner: str
+  age: int
+  done: bool
+
+
+@sql_storage.TableSpec('logged', indexes=[
+  sql_storage.Index('parent', 'seq', unique=True),
+], shard_by='parent')
+class Logged:
+  entry: sql_storage.PrimaryKey(str)
+  parent: str
+  seq: int
+
+
+@sql_storage.TableSpec('room')
+class Room:
+  key: sql_storage.PrimaryKey(str)
+  members: sql_storage.CSVSet(uuid.UUID)
+
+
+@sql_storage.TableSpec('migrated', indexes=[sql_storage.Index('owner')])
+class Migrated:
+  key: sql_storage.PrimaryKey(str)
+  owner: str
+  age: int = 7
+  shout: str = None
+
+
 class MockDAO(sql_storage.SQLStorageBase):
   pass
 
@@ -73,3 +117,357 @@ class SQLStorageUnittests(unittest.TestCase):
     self._mock_dao.Update(gid)
     gid = list(self._mock_dao.GetAll(PaysHoff, gameid=gameid))[0]
     print(gid, '\n')
+
+  def test_getAllWhereIn(self):
+    self._mock_dao.CreateTableForType(PaysHoff)
+    gameids = [uuid.uuid4() for _ in range(5)]
+    for gameid in gameids:
+      self._mock_dao.Insert(PaysHoff(
+        gameid = gameid,
+        admin = gameid,
+        users = [gameid],
+        next_user = gameid,
+        must_add = [],
+        options = [],
+        decided = False,
+        last_access = 0))
+    wanted = set(gameids[1:4])
+    found = list(self._mock_dao.GetAllWhereIn(
+      PaysHoff, 'gameid', list(wanted) + [uuid.uuid4()], chunk_size=2))
+    self.assertEqual(wanted, {game.gameid for game in found})
+
+  def test_connectionPoolIsShared(self):
+    other = MockDAO(self._tf)
+    with self._mock_dao.Connection() as outer:
+      with other.Connection() as inner:
+        self.assertIs(outer, inner)
+      mode = outer.execute('PRAGMA journal_mode').fetchone()[0]
+    self.assertEqual('wal', mode)
+
+  def test_poolCheckoutTimesOut(self):
+    pool = sql_storage.ConnectionPool(self._tf, size=1, checkout_timeout=0.05)
+    held = pool.Checkout()
+    blocked = []
+    def Blocked():
+      try:
+        pool.Checkout()
+      except sql_storage.PoolExhausted as e:
+        blocked.append(e)
+    thread = threading.Thread(target=Blocked)
+    thread.start()
+    thread.join(5)
+    self.assertEqual(1, len(blocked))
+    pool.Return(held)
+    self.assertIs(held, pool.Checkout())
+
+  def test_updateConflict(self):
+    self._mock_dao.CreateTableForType(Versioned)
+    self._mock_dao.Insert(Versioned(key='k', value=1))
+    first = list(self._mock_dao.GetAll(Versioned, key='k'))[0]
+    second = list(self._mock_dao.GetAll(Versioned, key='k'))[0]
+    first.value = 2
+    self._mock_dao.Update(first)
+    self.assertEqual(1, first.version)
+    second.value = 3
+    with self.assertRaises(sql_storage.UpdateConflict):
+      self._mock_dao.Update(second)
+    stored = list(self._mock_dao.GetAll(Versioned, key='k'))[0]
+    self.assertEqual((2, 1), (stored.value, stored.version))
+
+  def test_createIndexes(self):
+    self.assertEqual([
+      'CREATE INDEX IF NOT EXISTS idx_indexed_owner ON indexed (owner)',
+      'CREATE INDEX IF NOT EXISTS idx_indexed_age ON indexed (age) '
+      'WHERE done = 0',
+    ], self._mock_dao.IndexQueriesForType(Indexed))
+    self._mock_dao.CreateTableForType(Indexed)
+    with self._mock_dao.Connection() as conn:
+      self.assertEqual([], conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' "
+        "AND tbl_name = 'indexed' AND sql IS NOT NULL").fetchall())
+    self._mock_dao.Migrate(Indexed)
+    self._mock_dao.Migrate(Indexed)
+    self._mock_dao.Insert(Indexed(key='a', owner='me', age=3, done=False))
+    with self._mock_dao.Connection() as conn:
+      plan = conn.execute('EXPLAIN QUERY PLAN SELECT key FROM indexed '
+                          'WHERE owner = ?', ('me',)).fetchall()
+    self.assertIn('idx_indexed_owner', plan[0][-1])
+    found = list(self._mock_dao.GetAll(Indexed, owner='me', done=False))
+    self.assertEqual(['a'], [row.key for row in found])
+
+  def test_memoryIndexesAreLeftToMigrate(self):
+    dao = MockDAO(sql_storage.MEMORY)
+    dao.CreateTableForType(Indexed)
+    dao.Insert(Indexed(key='a', owner='me', age=3, done=False))
+    self.assertEqual({}, dao._memory.Table(Indexed).indexes)
+    dao.Migrate(Indexed)
+    dao.Migrate(Indexed)
+    dao.Insert(Indexed(key='b', owner='me', age=4, done=False))
+    owner = dao._memory.Table(Indexed).indexes[(1,)]
+    self.assertEqual({('me',): {'a', 'b'}}, owner)
+    found = list(dao.GetAll(Indexed, owner='me', done=False))
+    self.assertEqual(['a', 'b'], sorted(row.key for row in found))
+
+  def test_batchOperations(self):
+    self._mock_dao.CreateTableForType(Indexed)
+    rows = [Indexed(key=str(i), owner='me', age=i, done=False)
+            for i in range(25)]
+    self.assertEqual(25, self._mock_dao.InsertMany(rows, chunk_size=10))
+    found = list(self._mock_dao.GetMany(
+      Indexed, [{'key': '3'}, {'key': '4', 'age': 4}, {'key': '5', 'age': 0}]))
+    self.assertEqual({'3', '4'}, {row.key for row in found})
+    for row in rows[:5]:
+      row.owner = 'you'
+    self.assertEqual(5, self._mock_dao.UpdateMany(rows, chunk_size=2))
+    self.assertEqual(5, len(list(self._mock_dao.GetAll(Indexed, owner='you'))))
+    self.assertEqual(20, self._mock_dao.DeleteMany(rows[5:]))
+    self.assertEqual(5, len(list(self._mock_dao.GetAll(Indexed))))
+
+  def test_shardedStorage(self):
+    tempdir = tempfile.mkdtemp()
+    try:
+      dao = MockDAO(f'{tempdir}/db.sqlite', shards=4)
+      dao.CreateTableForType(Indexed)
+      rows = [Indexed(key=str(i), owner='me', age=i, done=False)
+              for i in range(40)]
+      dao.InsertMany(rows[:30])
+      for row in rows[30:]:
+        dao.Insert(row)
+      counts = []
+      for path in sql_storage.ShardFiles(f'{tempdir}/db.sqlite', 4):
+        with sqlite3.connect(path) as conn:
+          counts.append(conn.execute('SELECT COUNT(*) FROM indexed').fetchone())
+      self.assertEqual(40, sum(count for count, in counts))
+      self.assertTrue(all(count for count, in counts))
+      self.assertEqual(40, len(list(dao.GetAll(Indexed, owner='me'))))
+      self.assertEqual([7], [r.age for r in dao.GetAll(Indexed, key='7')])
+      rows[7].owner = 'you'
+      dao.Update(rows[7])
+      dao.Delete(rows[8])
+      self.assertEqual(['7'], [r.key for r in dao.GetAll(Indexed, owner='you')])
+      self.assertEqual(
+        {'7', '9'}, {r.key for r in dao.GetAllWhereIn(
+          Indexed, 'key', ['7', '8', '9'])})
+
+      copied = reshard.Reshard(
+        f'{tempdir}/db.sqlite', 4, f'{tempdir}/new.sqlite', 2, (Indexed,))
+      self.assertEqual({'indexed': 39}, copied)
+      resharded = MockDAO(f'{tempdir}/new.sqlite', shards=2)
+      self.assertEqual(['you'], [
+        r.owner for r in resharded.GetAll(Indexed, key='7')])
+      self.assertEqual(39, len(list(resharded.GetAll(Indexed))))
+      with self.assertRaises(ValueError):
+        reshard.Reshard(
+          f'{tempdir}/db.sqlite', 4, f'{tempdir}/new.sqlite', 2, (Indexed,))
+    finally:
+      os.system(f'rm -rf {tempdir}')
+
+  def test_appendLog(self):
+    tempdir = tempfile.mkdtemp()
+    try:
+      for dbfile in (f'{tempdir}/db.sqlite', sql_storage.MEMORY):
+        dao = MockDAO(dbfile, shards=4)
+        dao.Migrate(Logged)
+        for parent in ('a', 'b', 'c'):
+          for seq in (3, 1, 4, 2, 5):
+            dao.Insert(Logged(entry=f'{parent}/{seq}', parent=parent, seq=seq))
+        with self.assertRaises(sqlite3.IntegrityError):
+          dao.Insert(Logged(entry='a/2', parent='a', seq=2))
+        self.assertEqual([3, 4, 5], [
+          r.seq for r in dao.GetAllAfter(Logged, 'seq', 2, parent='a')])
+        self.assertEqual([], dao.GetAllAfter(Logged, 'seq', 5, parent='b'))
+        self.assertEqual(3, len(dao.GetAllAfter(Logged, 'seq', 4)))
+      counts = []
+      for path in sql_storage.ShardFiles(f'{tempdir}/db.sqlite', 4):
+        with sqlite3.connect(path) as conn:
+          counts.append(conn.execute(
+            'SELECT COUNT(*) FROM logged GROUP BY parent').fetchall())
+      self.assertEqual([5, 5, 5], sorted(c for s in counts for c, in s))
+      reshard.Reshard(
+        f'{tempdir}/db.sqlite', 4, f'{tempdir}/new.sqlite', 3, (Logged,))
+      resharded = MockDAO(f'{tempdir}/new.sqlite', shards=3)
+      self.assertEqual([], resharded.Migrate(Logged))
+      self.assertEqual([3, 4, 5], [
+        r.seq for r in resharded.GetAllAfter(Logged, 'seq', 2, parent='a')])
+    finally:
+      os.system(f'rm -rf {tempdir}')
+
+  def test_migrate(self):
+    with sqlite3.connect(self._tf) as conn:
+      conn.execute('CREATE TABLE migrated (key TEXT PRIMARY KEY, owner TEXT)')
+      conn.executemany('INSERT INTO migrated VALUES (?, ?)',
+                       [(str(i), f'user{i}') for i in range(5)])
+    backfill = sql_storage.Backfill(
+      Migrated, 'shout', lambda row: row['owner'].upper())
+    self.assertEqual([
+      'add migrated.age', 'add migrated.shout', 'index idx_migrated_owner',
+      'backfill migrated.shout: 5 rows',
+    ], sql_storage.Migrate(self._tf, [Migrated], backfills=[backfill], batch=2))
+    self.assertEqual(
+      {('3', 'user3', 7, 'USER3')},
+      {(r.key, r.owner, r.age, r.shout)
+       for r in self._mock_dao.GetAll(Migrated, key='3')})
+    self.assertEqual([], self._mock_dao.Migrate(Migrated))
+    sql_storage._migrated.clear()
+    self.assertEqual([], sql_storage.Migrate(self._tf, [Migrated]))
+    with sqlite3.connect(self._tf) as conn:
+      self.assertEqual([('migrated', sql_storage.Fingerprint(Migrated))],
+                       conn.execute('SELECT tablename, fingerprint '
+                                    'FROM schema_version').fetchall())
+
+  def test_orderedSet(self):
+    members = [uuid.uuid4() for _ in range(10000)]
+    ordered = sql_storage.OrderedSet(members)
+    ordered.append(members[5])
+    self.assertEqual(members, ordered)
+    self.assertEqual(members[1], ordered.Next(members[0]))
+    self.assertEqual(members[0], ordered.Next(members[-1]))
+    for member in members[1::2]:
+      ordered.remove(member)
+    self.assertEqual(members[::2], list(ordered))
+    self.assertEqual(members[2], ordered.Next(members[0]))
+    self.assertEqual(members[0], ordered.Next(members[-2]))
+    self.assertFalse(members[1] in ordered)
+    with self.assertRaises(ValueError):
+      ordered.remove(members[1])
+    with self.assertRaises(ValueError):
+      ordered.Next(members[1])
+
+    self._mock_dao.CreateTableForType(Room)
+    self._mock_dao.Insert(Room(key='big', members=ordered))
+    room, = self._mock_dao.GetAll(Room, key='big')
+    self.assertEqual(5000, len(room.members))
+    self.assertEqual(members[::2], room.members)
+    room.members.remove(members[0])
+    room.members.append(members[1])
+    self._mock_dao.Update(room)
+    room, = self._mock_dao.GetAll(Room, key='big')
+    self.assertEqual(members[2::2] + [members[1]], list(room.members))
+
+  def test_memoryEngine(self):
+    dao = MockDAO(sql_storage.MEMORY)
+    dao.CreateTableForType(Indexed)
+    dao.CreateTableForType(Versioned)
+    rows = [Indexed(key=str(i), owner='me', age=i, done=False)
+            for i in range(10)]
+    self.assertEqual(10, dao.InsertMany(rows))
+    with self.assertRaises(sqlite3.IntegrityError):
+      dao.Insert(Indexed(key='1', owner='me', age=1, done=False))
+    self.assertEqual([3], [r.age for r in dao.GetAll(Indexed, key='3')])
+    self.assertEqual(10, len(list(dao.GetAll(Indexed, owner='me'))))
+    rows[3].owner = 'you'
+    dao.Update(rows[3])
+    self.assertEqual('you', list(dao.GetAll(Indexed, key='3'))[0].owner)
+    self.assertEqual(['3'], [r.key for r in dao.GetAll(Indexed, owner='you')])
+    self.assertEqual(
+      {'3', '4'}, {r.key for r in dao.GetAllWhereIn(Indexed, 'key', '34')})
+    dao.DeleteMany(rows[5:])
+    self.assertEqual(5, len(list(dao.GetAll(Indexed))))
+
+    first = Versioned(key='k', value=1)
+    dao.Insert(first)
+    second = list(dao.GetAll(Versioned, key='k'))[0]
+    first.value = 2
+    dao.Update(first)
+    second.value = 3
+    with self.assertRaises(sql_storage.UpdateConflict):
+      dao.Update(second)
+    self.assertEqual([(2, 1)], [
+      (r.value, r.version) for r in dao.GetAll(Versioned, key='k')])
+
+  def test_statementHooks(self):
+    timed = []
+    traced = []
+    sql_storage.ConnectionPool.Time(
+      lambda query, seconds: timed.append(
+        sql_storage.DescribeStatement(query)))
+    sql_storage.ConnectionPool.Trace(traced.append)
+    try:
+      self._mock_dao.CreateTableForType(Indexed)
+      self._mock_dao.Insert(Indexed(key='a', owner='me', age=1, done=False))
+      list(self._mock_dao.GetAll(Indexed, key='a'))
+    finally:
+      sql_storage.ConnectionPool.Time(None)
+      sql_storage.ConnectionPool.Trace(None)
+    self.assertIn(('CREATE', 'indexed'), timed)
+    self.assertIn(('INSERT', 'indexed'), timed)
+    self.assertIn(('SELECT', 'indexed'), timed)
+    self.assertIn(('COMMIT', ''), timed)
+    self.assertIn("SELECT key,owner,age,done FROM indexed WHERE key = 'a'",
+                  traced)
+
+  def test_groupCommit(self):
+    tempdir = tempfile.mkdtemp()
+    commits = []
+    sql_storage.ConnectionPool.Time(
+      lambda query, _: query == 'COMMIT' and commits.append(query))
+    try:
+      dao = MockDAO(f'{tempdir}/db.sqlite', group_commit=0.05)
+      dao.CreateTableForType(Indexed)
+      commits.clear()
+      rows = [Indexed(key=str(i), owner='me', age=i, done=False)
+              for i in range(20)]
+      threads = [threading.Thread(target=dao.Insert, args=(row,))
+                 for row in rows]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+      self.assertLess(len(commits), 20)
+      with self.assertRaises(sqlite3.IntegrityError):
+        dao.Insert(Indexed(key='1', owner='me', age=1, done=False))
+      rows[1].owner = 'you'
+      dao.Update(rows[1])
+      dao.Delete(rows[2])
+      self.assertEqual(19, len(list(dao.GetAll(Indexed))))
+      self.assertEqual(['1'], [r.key for r in dao.GetAll(Indexed, owner='you')])
+    finally:
+      sql_storage.ConnectionPool.Time(None)
+      os.system(f'rm -rf {tempdir}')
+
+  def test_compiledRowCodec(self):
+    self._mock_dao.CreateTableForType(Indexed)
+    rows = [Indexed(key=str(i), owner='me', age=i, done=False)
+            for i in range(2000)]
+    self._mock_dao.InsertMany(rows)
+    self.assertFalse(hasattr(rows[0], '__dict__'))
+
+    start = time.perf_counter()
+    found = list(self._mock_dao.GetAll(Indexed, owner='me'))
+    elapsed = time.perf_counter() - start
+    print(f'GetAll: {1e6 * elapsed / len(found):.2f}us per row\n')
+    self.assertEqual(tuple, type(found[0].__tablespec_snapshot__))
+
+    statements = []
+    found[0].age = 9000
+    with self._mock_dao.Connection() as conn:
+      conn.set_trace_callback(statements.append)
+      self._mock_dao.Update(found[0])
+      self._mock_dao.Update(found[1])
+      conn.set_trace_callback(None)
+    updates = [s for s in statements if s.startswith('UPDATE')]
+    self.assertEqual(["UPDATE indexed SET age = 9000 WHERE key is '0'"],
+                     updates)
+
+  def test_lazyColumns(self):
+    self._mock_dao.CreateTableForType(PaysHoff)
+    admin = uuid.uuid4()
+    self._mock_dao.Insert(PaysHoff(
+      gameid = admin,
+      admin = admin,
+      users = [admin],
+      next_user = admin,
+      must_add = [admin],
+      options = ['a', 'b'],
+      decided = False,
+      last_access = 0))
+    game = list(self._mock_dao.GetAll(PaysHoff, gameid=admin))[0]
+    raw = PaysHoff.__dict__['users']._slot.__get__(game)
+    self.assertEqual(str(admin), raw.value)
+    self.assertEqual(['a', 'b'], game.options)
+    game.options.append('c')
+    game.decided = True
+    self._mock_dao.Update(game)
+    self.assertIs(raw, PaysHoff.__dict__['users']._slot.__get__(game))
+    game = list(self._mock_dao.GetAll(PaysHoff, gameid=admin))[0]
+    self.assertEqual((['a', 'b', 'c'], [admin]), (game.options, game.users))
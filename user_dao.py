@@ -1,6 +1,12 @@
 
+import atexit
+import collections
+import logging
+import os
+import threading
 import time
 import uuid
+import weakref
 
 from pylib import typecheck
 
@@ -8,7 +14,13 @@ from what2pick import names
 from what2pick import sql_storage
 
 
-@sql_storage.TableSpec('users')
+# Accounts that have not been used in this long are replaced on login.
+ACCOUNT_LIFETIME = 60 * 60 * 24 * 31
+
+
+@sql_storage.TableSpec('users', indexes=[
+  sql_storage.Index('lastaccess'),
+])
 class User:
   uid: sql_storage.PrimaryKey(uuid.UUID)
   pwd: uuid.UUID
@@ -16,50 +28,231 @@ class User:
   lastaccess: sql_storage.UnixTime
 
 
+class _Session():
+  def __init__(self, user:User, expires:float, written:float):
+    self.user = user
+    self.expires = expires
+    self.written = written
+
+
+# Every open UserDAO, for the process-wide fork and exit hooks.
+_daos = weakref.WeakSet()
+
+
+def _FlushLoop(ref:weakref.ref, closed:threading.Event, interval:float):
+  '''Flushes the DAO behind |ref| every |interval| seconds until it closes.
+
+  Only a weak reference is held between flushes, so a DAO that is dropped
+  without being closed can still be collected, and its thread then ends. A
+  failed flush is logged and retried next time.
+  '''
+  while not closed.wait(interval):
+    dao = ref()
+    if dao is None:
+      return
+    try:
+      dao.FlushAccessTimes()
+    except Exception:
+      logging.exception('flushing access times failed')
+    del dao
+
+
+def _AfterFork():
+  for dao in list(_daos):
+    dao._AfterFork()
+
+
+def _FlushAll():
+  for dao in list(_daos):
+    dao.FlushAccessTimes()
+
+
+os.register_at_fork(after_in_child=_AfterFork)
+atexit.register(_FlushAll)
+
+
 class UserDAO(sql_storage.SQLStorageBase):
-  def __init__(self, dbfile:str):
-    super().__init__(dbfile)
-    self.Cursor(on_connect_db=self._CreateTable)
+  '''Users, with a cache of verified logins in front of the users table.
+
+  A cached (uid, pwd) pair is trusted for |session_ttl| seconds before it is
+  checked against the database again. Logins only move |lastaccess| forward
+  in memory; the rows are written by a background thread, at most once per
+  user every |touch_interval| seconds.
+
+  Users looked up for their names are kept in a separate LRU of
+  |name_capacity| entries for at most |name_ttl| seconds. ChangeUsername
+  keeps them current here, and Forget drops a user renamed by another
+  process.
+
+  Close() stops the flusher after writing what is pending; anything still
+  open is flushed at exit.
+  '''
+  TABLES = (User,)
+
+  def __init__(self, dbfile:str, session_capacity:int = 10000,
+               session_ttl:int = 300, touch_interval:int = 60,
+               name_capacity:int = 10000, name_ttl:int = 60,
+               group_commit:float = 0):
+    super().__init__(dbfile, group_commit=group_commit)
+    self.Migrate(*self.TABLES)
+    names.PrimeNameList()
+    self._session_capacity = session_capacity
+    self._session_ttl = session_ttl
+    self._touch_interval = touch_interval
+    self._sessions_lock = threading.Lock()
+    self._sessions = collections.OrderedDict()
+    self._pending_touches = {}
+    self._name_capacity = name_capacity
+    self._name_ttl = name_ttl
+    self._names_lock = threading.Lock()
+    self._names = collections.OrderedDict()
+    self._closed = threading.Event()
+    self._StartFlusher()
+    _daos.add(self)
 
-  def _CreateTable(self, _):
-    self.CreateTableForType(User)
+  def _AfterFork(self):
+    # Only the forking thread survives; any other may have held a lock.
+    self._sessions_lock = threading.Lock()
+    self._names_lock = threading.Lock()
+    self._closed = threading.Event()
+    self._StartFlusher()
 
-  def CreateUser(self) -> User:
+  def _StartFlusher(self):
+    self._flusher = threading.Thread(
+      target=_FlushLoop, daemon=True,
+      args=(weakref.ref(self), self._closed, self._touch_interval))
+    self._flusher.start()
+
+  def Close(self):
+    '''Stops the flusher and writes any access times it had pending.'''
+    _daos.discard(self)
+    self._closed.set()
+    if self._flusher is not threading.current_thread():
+      self._flusher.join()
+    self.FlushAccessTimes()
+
+  def _CacheSession(self, user:User, written:float) -> _Session:
+    session = _Session(user, time.monotonic() + self._session_ttl, written)
+    with self._sessions_lock:
+      self._sessions[(user.uid, user.pwd)] = session
+      self._sessions.move_to_end((user.uid, user.pwd))
+      while len(self._sessions) > self._session_capacity:
+        self._sessions.popitem(last=False)
+    return session
+
+  def _GetSession(self, uid:uuid.UUID, pwd:uuid.UUID) -> _Session|None:
+    with self._sessions_lock:
+      session = self._sessions.get((uid, pwd))
+      if session is None:
+        return None
+      if session.expires < time.monotonic():
+        del self._sessions[(uid, pwd)]
+        return None
+      self._sessions.move_to_end((uid, pwd))
+      return session
+
+  def _Touch(self, session:_Session):
+    now = sql_storage.UnixTime.Now()
+    session.user.lastaccess = sql_storage.UnixTime(now)
+    with self._sessions_lock:
+      if time.monotonic() - session.written >= self._touch_interval:
+        self._pending_touches[session.user.uid] = session
+
+  def FlushAccessTimes(self):
+    '''Writes pending access times; if that fails, they stay pending.'''
+    with self._sessions_lock:
+      pending = self._pending_touches
+      self._pending_touches = {}
+    now = time.monotonic()
+    try:
+      self.UpdateMany(session.user for session in pending.values())
+    except:
+      with self._sessions_lock:
+        for uid, session in pending.items():
+          self._pending_touches.setdefault(uid, session)
+      raise
+    for session in pending.values():
+      session.written = now
+
+  def CreateUser(self, avoid=()) -> User:
+    '''Creates a user whose random name is not one of |avoid|.'''
     user = User(
       uid = uuid.uuid4(),
       pwd = uuid.uuid4(),
-      name = self.GetRandomName(),
-      lastaccess = 0)
+      name = self.GetRandomName(avoid),
+      lastaccess = sql_storage.UnixTime(sql_storage.UnixTime.Now()))
     self.Insert(user)
+    self._CacheSession(user, time.monotonic())
     return user
 
-  @typecheck.Ensure
-  def GetUsernameByUUID(self, uid:uuid.UUID, pwd=True) -> User | None:
+  def _LoadUser(self, uid:uuid.UUID) -> User | None:
     users = list(self.GetAll(User, uid=uid))
     if len(users) != 1:
       return None
     return users[0]
 
+  def _CacheName(self, user:User):
+    with self._names_lock:
+      self._names[user.uid] = (user, time.monotonic() + self._name_ttl)
+      self._names.move_to_end(user.uid)
+      while len(self._names) > self._name_capacity:
+        self._names.popitem(last=False)
+
+  @typecheck.Ensure
+  def GetUsernameByUUID(self, uid:uuid.UUID, pwd=True) -> User | None:
+    return self.GetUsernamesByUUIDs([uid]).get(uid)
+
+  def GetUsernamesByUUIDs(self, uids) -> dict:
+    '''Maps each of |uids| that exists to its User, in at most one query.'''
+    found = {}
+    missing = set()
+    now = time.monotonic()
+    with self._names_lock:
+      for uid in uids:
+        user, expires = self._names.get(uid, (None, 0))
+        if expires > now:
+          found[uid] = user
+          self._names.move_to_end(uid)
+        else:
+          missing.add(uid)
+    for user in self.GetAllWhereIn(User, 'uid', missing):
+      found[user.uid] = user
+      self._CacheName(user)
+    return found
+
   @typecheck.Ensure
   def LoginAsUser(self, uid:uuid.UUID, pwd:uuid.UUID) -> User:
-    user = self.GetUsernameByUUID(uid)
-    if not user:
-      return self.CreateUser()
+    session = self._GetSession(uid, pwd)
+    if session is None:
+      user = self._LoadUser(uid)
+      if not user:
+        return self.CreateUser()
+      if user.pwd != pwd:
+        return self.CreateUser()
+      session = self._CacheSession(user, 0)
     now = sql_storage.UnixTime.Now()
-    if now - user.lastaccess.Value() > (60 * 60 * 24 * 31):
+    if now - session.user.lastaccess.Value() > ACCOUNT_LIFETIME:
       return self.CreateUser()
-    if user.pwd != pwd:
-      return self.CreateUser()
-    self.Update(user)
-    return user
+    self._Touch(session)
+    return session.user
 
   @typecheck.Ensure
   def ChangeUsername(self, uid:uuid.UUID, pwd:uuid.UUID, name:str) -> User:
     user = self.LoginAsUser(uid, pwd)
     user.name = name[:22]
     self.Update(user)
+    with self._names_lock:
+      self._names.pop(user.uid, None)
     return user
 
+  def Forget(self, uid:uuid.UUID):
+    '''Drops what is cached about a user changed by another process.'''
+    with self._names_lock:
+      self._names.pop(uid, None)
+    with self._sessions_lock:
+      for key in [key for key in self._sessions if key[0] == uid]:
+        del self._sessions[key]
+
   @typecheck.Ensure
-  def GetRandomName(self) -> str:
-    return names.GetRandomFullName()
\ No newline at end of file
+  def GetRandomName(self, avoid=()) -> str:
+    return names.GetRandomFullName(avoid)
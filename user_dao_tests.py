@@ -0,0 +1,164 @@
+
+import gc
+import os
+import sqlite3
+import tempfile
+import threading
+import uuid
+import weakref
+
+from impulse.testing import unittest
+from what2pick import sql_storage
+from what2pick import user_dao
+
+
+class UserDAOUnittests(unittest.TestCase):
+  def setup(self):
+    self._dao = user_dao.UserDAO(sql_storage.MEMORY, touch_interval=3600)
+    self._loads = 0
+    self._writes = []
+    load, update = self._dao._LoadUser, self._dao.UpdateMany
+    def CountingLoad(uid):
+      self._loads += 1
+      return load(uid)
+    def RecordingUpdate(users):
+      users = list(users)
+      self._writes.append([user.uid for user in users])
+      return update(users)
+    self._dao._LoadUser = CountingLoad
+    self._dao.UpdateMany = RecordingUpdate
+
+  def cleanup(self):
+    self._dao.Close()
+
+  def test_loginsAreCached(self):
+    user = self._dao.CreateUser()
+    for _ in range(3):
+      self.assertEqual(user.uid, self._dao.LoginAsUser(user.uid, user.pwd).uid)
+    self.assertEqual(0, self._loads)
+    self._dao._sessions.clear()
+    self.assertEqual(user.uid, self._dao.LoginAsUser(user.uid, user.pwd).uid)
+    self.assertEqual(1, self._loads)
+
+  def test_wrongPasswordGetsNewUser(self):
+    user = self._dao.CreateUser()
+    other = self._dao.LoginAsUser(user.uid, uuid.uuid4())
+    self.assertNotEqual(user.uid, other.uid)
+
+  def test_accessTimesAreCoalesced(self):
+    user = self._dao.CreateUser()
+    self._dao.LoginAsUser(user.uid, user.pwd)
+    self._dao.FlushAccessTimes()
+    self.assertEqual([[]], self._writes)
+    self._dao._touch_interval = 0
+    for _ in range(3):
+      self._dao.LoginAsUser(user.uid, user.pwd)
+    self._dao.FlushAccessTimes()
+    self._dao.FlushAccessTimes()
+    self.assertEqual([[], [user.uid], []], self._writes)
+
+  def test_failedFlushIsRetried(self):
+    user = self._dao.CreateUser()
+    self._dao._touch_interval = 0
+    self._dao.LoginAsUser(user.uid, user.pwd)
+    update = self._dao.UpdateMany
+    def Failing(users):
+      list(users)
+      raise sqlite3.OperationalError('database is locked')
+    self._dao.UpdateMany = Failing
+    with self.assertRaises(sqlite3.OperationalError):
+      self._dao.FlushAccessTimes()
+    self._dao.UpdateMany = update
+    self._dao.FlushAccessTimes()
+    self.assertEqual([[user.uid]], self._writes)
+    stored, = self._dao.GetAll(user_dao.User, uid=user.uid)
+    self.assertEqual(user.lastaccess.Value(), stored.lastaccess.Value())
+
+  def test_flusherSurvivesFailures(self):
+    dao = user_dao.UserDAO(sql_storage.MEMORY, touch_interval=0.01)
+    flushed = threading.Event()
+    update = dao.UpdateMany
+    def FailingOnce(users):
+      users = list(users)
+      if not hasattr(FailingOnce, 'failed'):
+        FailingOnce.failed = True
+        raise sqlite3.OperationalError('database is locked')
+      update(users)
+      if users:
+        flushed.set()
+    dao.UpdateMany = FailingOnce
+    try:
+      user = dao.CreateUser()
+      dao._touch_interval = 0
+      dao.LoginAsUser(user.uid, user.pwd)
+      self.assertTrue(flushed.wait(5))
+      self.assertTrue(dao._flusher.is_alive())
+    finally:
+      dao.Close()
+
+  def test_closeFlushesAndStops(self):
+    user = self._dao.CreateUser()
+    self._dao._touch_interval = 0
+    self._dao.LoginAsUser(user.uid, user.pwd)
+    self._dao.Close()
+    self.assertFalse(self._dao._flusher.is_alive())
+    self.assertEqual([[user.uid]], self._writes)
+    self.assertNotIn(self._dao, user_dao._daos)
+
+  def test_droppedDAOIsCollected(self):
+    dao = user_dao.UserDAO(sql_storage.MEMORY, touch_interval=0.01)
+    flusher = dao._flusher
+    ref = weakref.ref(dao)
+    del dao
+    gc.collect()
+    self.assertIsNone(ref())
+    flusher.join(5)
+    self.assertFalse(flusher.is_alive())
+
+  def test_afterForkResetsLocks(self):
+    self._dao._names_lock.acquire()
+    self._dao._sessions_lock.acquire()
+    self._dao._AfterFork()
+    self.assertFalse(self._dao._names_lock.locked())
+    self.assertFalse(self._dao._sessions_lock.locked())
+    self.assertTrue(self._dao._flusher.is_alive())
+
+  def test_changeUsernameUpdatesNames(self):
+    user = self._dao.CreateUser()
+    self.assertEqual(user.name,
+                     self._dao.GetUsernamesByUUIDs([user.uid])[user.uid].name)
+    self._dao.ChangeUsername(user.uid, user.pwd, 'Someone Else')
+    self.assertEqual('Someone Else',
+                     self._dao.GetUsernamesByUUIDs([user.uid])[user.uid].name)
+
+  def test_namesExpire(self):
+    user = self._dao.CreateUser()
+    self._dao._name_ttl = 0
+    first = self._dao.GetUsernamesByUUIDs([user.uid])[user.uid]
+    self.assertIsNot(first,
+                     self._dao.GetUsernamesByUUIDs([user.uid])[user.uid])
+
+
+class SharedFileUnittests(unittest.TestCase):
+  def setup(self):
+    self._tf = tempfile.mkstemp()[1]
+    self._mine = user_dao.UserDAO(self._tf)
+    self._theirs = user_dao.UserDAO(self._tf)
+
+  def cleanup(self):
+    self._mine.Close()
+    self._theirs.Close()
+    os.remove(self._tf)
+
+  def test_forgetDropsRenamedUser(self):
+    user = self._theirs.CreateUser()
+    name = user.name
+    self._mine.LoginAsUser(user.uid, user.pwd)
+    self._mine.GetUsernamesByUUIDs([user.uid])
+    self._theirs.ChangeUsername(user.uid, user.pwd, 'Someone Else')
+    self.assertEqual(name, self._mine.LoginAsUser(user.uid, user.pwd).name)
+    self._mine.Forget(user.uid)
+    self.assertEqual('Someone Else',
+                     self._mine.LoginAsUser(user.uid, user.pwd).name)
+    self.assertEqual('Someone Else',
+                     self._mine.GetUsernamesByUUIDs([user.uid])[user.uid].name)
@@ -0,0 +1,366 @@
+
+import argparse
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+
+from what2pick import sql_storage
+
+
+_GAME_ID = re.compile(
+  r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+_UID_COOKIE = re.compile(r'uid=([0-9a-f-]{36})')
+
+
+def Percentile(samples:list, fraction:float) -> float:
+  '''The nearest-rank percentile of sorted |samples|, or 0 if there are none.'''
+  if not samples:
+    return 0
+  rank = max(0, min(len(samples) - 1, round(fraction * len(samples)) - 1))
+  return samples[rank]
+
+
+def Summarize(samples:list) -> dict:
+  '''Latency percentiles, in milliseconds, of |samples| given in seconds.'''
+  samples = sorted(samples)
+  return {
+    'count': len(samples),
+    'mean_ms': 1000 * sum(samples) / len(samples) if samples else 0,
+    'p50_ms': 1000 * Percentile(samples, 0.50),
+    'p95_ms': 1000 * Percentile(samples, 0.95),
+    'p99_ms': 1000 * Percentile(samples, 0.99),
+    'max_ms': 1000 * samples[-1] if samples else 0,
+  }
+
+
+class Recorder():
+  '''Collects per-route latencies, errors and sql statement counts.'''
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._latencies = {}
+    self._errors = {}
+    self._statements = {}
+    self._fanout = []
+    self._local = threading.local()
+
+  def CountStatement(self, _):
+    self._local.statements = getattr(self._local, 'statements', 0) + 1
+
+  def Statements(self) -> int:
+    return getattr(self._local, 'statements', 0)
+
+  def Request(self, route:str, seconds:float, ok:bool, statements:int):
+    with self._lock:
+      self._latencies.setdefault(route, []).append(seconds)
+      self._statements[route] = self._statements.get(route, 0) + statements
+      if not ok:
+        self._errors[route] = self._errors.get(route, 0) + 1
+
+  def FanOut(self, seconds:float):
+    with self._lock:
+      self._fanout.append(seconds)
+
+  def Report(self, wall:float, traced:bool) -> dict:
+    with self._lock:
+      routes = {}
+      for route, latencies in sorted(self._latencies.items()):
+        routes[route] = Summarize(latencies)
+        routes[route]['errors'] = self._errors.get(route, 0)
+        routes[route]['rps'] = len(latencies) / wall
+        if traced:
+          routes[route]['sql_per_request'] = (
+            self._statements[route] / len(latencies))
+      total = sum(len(l) for l in self._latencies.values())
+      return {
+        'wall_seconds': wall,
+        'requests': total,
+        'throughput_rps': total / wall,
+        'errors': sum(self._errors.values()),
+        'routes': routes,
+        'fanout': Summarize(self._fanout),
+      }
+
+
+def RouteOf(method:str, path:str) -> str:
+  '''The route a request was for, e.g. "POST /p/<gid>/add".'''
+  path = _GAME_ID.sub('<gid>', path.split('?')[0])
+  return f'{method} {path}'
+
+
+class InProcessTransport():
+  '''Sends requests straight into a Flask app through its test client.'''
+  def __init__(self, app):
+    self._app = app
+
+  def Session(self):
+    return self._app.test_client()
+
+  def Send(self, session, method:str, path:str, body:dict|None) -> tuple:
+    response = session.open(path, method=method, json=body)
+    return (response.status_code, response.get_data(as_text=True),
+            response.headers.get('Location', ''),
+            ' '.join(response.headers.getlist('Set-Cookie')))
+
+
+class HttpTransport():
+  '''Sends requests to a running server, e.g. what2pick_server on :5000.'''
+  def __init__(self, url:str):
+    import requests
+    self._requests = requests
+    self._url = url.rstrip('/')
+
+  def Session(self):
+    return self._requests.Session()
+
+  def Send(self, session, method:str, path:str, body:dict|None) -> tuple:
+    response = session.request(method, self._url + path, json=body,
+                               allow_redirects=False, timeout=120)
+    return (response.status_code, response.text,
+            response.headers.get('Location', ''),
+            response.headers.get('Set-Cookie', ''))
+
+
+class Client():
+  '''One simulated browser: a cookie jar and the user it was signed up as.'''
+  def __init__(self, transport, recorder:Recorder):
+    self._transport = transport
+    self._recorder = recorder
+    self._session = transport.Session()
+    self.uid = None
+    self.location = None
+
+  def Request(self, method:str, path:str, body:dict|None = None) -> tuple:
+    statements = self._recorder.Statements()
+    start = time.perf_counter()
+    status, text, self.location, cookies = self._transport.Send(
+      self._session, method, path, body)
+    elapsed = time.perf_counter() - start
+    self._recorder.Request(RouteOf(method, path), elapsed, status < 400,
+                           self._recorder.Statements() - statements)
+    if match := _UID_COOKIE.search(cookies):
+      self.uid = match.group(1)
+    return status, text
+
+  def Get(self, path:str) -> tuple:
+    return self.Request('GET', path)
+
+  def Post(self, path:str, body:dict|None = None) -> tuple:
+    return self.Request('POST', path, body or {})
+
+
+class Game():
+  '''Plays one game: players take turns adding, then removing, then selecting.
+
+  Watchers join as players and are moved to the watchers by the admin. Every
+  participant long-polls the game from its own thread; the time from the
+  start of a move to each poller waking up is recorded as fan-out delay.
+  '''
+  def __init__(self, transport, recorder:Recorder, players:int, watchers:int,
+               adds:int, seed:int):
+    self._transport = transport
+    self._recorder = recorder
+    self._admin = Client(transport, recorder)
+    self._players = [Client(transport, recorder) for _ in range(players - 1)]
+    self._watchers = [Client(transport, recorder) for _ in range(watchers)]
+    self._adds = adds
+    self._rng = random.Random(seed)
+    self._gid = None
+    self._moved_at = time.perf_counter()
+    self._finished = threading.Event()
+    self.pollers = []
+
+  def _State(self) -> dict:
+    _, text = self._admin.Get(f'/p/{self._gid}/state')
+    return json.loads(text)
+
+  def _Move(self, client:Client, action:str, body:dict|None = None):
+    self._moved_at = time.perf_counter()
+    client.Post(f'/p/{self._gid}/{action}', body)
+
+  def _Poll(self, since:int):
+    poller = Client(self._transport, self._recorder)
+    while not self._finished.is_set():
+      status, text = poller.Get(f'/p/{self._gid}/poll?since={since}')
+      if status != 200:
+        return
+      version = int(text)
+      if version > since:
+        self._recorder.FanOut(time.perf_counter() - self._moved_at)
+      since = version
+
+  def Play(self):
+    self._admin.Get('/signup/p')
+    self._admin.Get('/p')
+    self._gid = _GAME_ID.search(self._admin.location).group(0)
+    for client in self._players + self._watchers:
+      client.Get(f'/signup/p?gid={self._gid}')
+      client.Get(f'/p/{self._gid}')
+    for watcher in self._watchers:
+      self._Move(self._admin, 'adm_kick', {'target': watcher.uid})
+    since = self._State()['version']
+    for _ in range(1 + len(self._players) + len(self._watchers)):
+      poller = threading.Thread(target=self._Poll, args=(since,), daemon=True)
+      poller.start()
+      self.pollers.append(poller)
+    try:
+      self._Turns()
+    finally:
+      self._finished.set()
+
+  def _Turns(self):
+    clients = {c.uid: c for c in [self._admin, *self._players]}
+    for _ in range(self._adds * len(clients)):
+      current = clients[self._State()['state']['next_player']]
+      option = f'option {self._rng.randrange(1 << 20)}'
+      self._Move(current, 'add', {'option': option})
+    while True:
+      state = self._State()['state']
+      current = clients[state['next_player']]
+      if len(state['options']) <= 1:
+        self._finished.set()
+        self._Move(current, 'sel')
+        return
+      option = self._rng.randrange(len(state['options']))
+      self._Move(current, 'del', {'option': option})
+
+
+def Run(transport, games:int, players:int, watchers:int, adds:int,
+        seed:int, traced:bool) -> dict:
+  '''Plays |games| games at once and returns the report.'''
+  recorder = Recorder()
+  if traced:
+    sql_storage.ConnectionPool.Trace(recorder.CountStatement)
+  rooms = [Game(transport, recorder, players, watchers, adds, seed + i)
+           for i in range(games)]
+  threads = [threading.Thread(target=room.Play) for room in rooms]
+  start = time.perf_counter()
+  try:
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    for room in rooms:
+      for poller in room.pollers:
+        poller.join(timeout=5)
+  finally:
+    if traced:
+      sql_storage.ConnectionPool.Trace(None)
+  report = recorder.Report(time.perf_counter() - start, traced)
+  report['config'] = {
+    'games': games, 'players': players, 'watchers': watchers,
+    'adds_per_player': adds, 'seed': seed,
+  }
+  return report
+
+
+def LargeRoom(members:int, moves:int, db_file:str = sql_storage.MEMORY,
+              seed:int = 0) -> dict:
+  '''Times moves in one game with |members| players and as many watchers.
+
+  Every player adds an option, then the admin skips |moves| turns and
+  removes |moves| / 2 options.
+  This drives PaysHoffDAO directly, so the report is the cost of the game
+  logic and storage alone; the HTTP benchmark cannot open thousands of
+  clients in one room.
+  '''
+  import uuid
+  from what2pick import pays_hoff_dao
+  rng = random.Random(seed)
+  dao = pays_hoff_dao.PaysHoffDAO(db_file)
+  admin = uuid.uuid4()
+  gid = dao.CreateGame(admin).gameid
+  timings = {'join': [], 'kick': [], 'add': [], 'skip': [], 'del': []}
+  def Timed(kind:str, method, *args):
+    start = time.perf_counter()
+    method(*args)
+    timings[kind].append(time.perf_counter() - start)
+  people = [uuid.uuid4() for _ in range(2 * members)]
+  for person in people:
+    Timed('join', dao.JoinGame, gid, person)
+  for person in people[members:]:
+    Timed('kick', dao.SetPlayerToWatcher, gid, person, admin)
+  # Everyone adds once, so that removals are allowed afterwards.
+  for i in range(members + 1):
+    game = dao.GetGameById(gid)
+    Timed('add', dao.AddOption, gid, game.next_player, f'option {i}')
+  for _ in range(moves):
+    Timed('skip', dao.AdminSkipNextUser, gid, admin)
+  for _ in range(moves // 2):
+    option = rng.randrange(len(dao.GetGameById(gid).options))
+    Timed('del', dao.RemoveOption, gid, admin, option)
+  return {
+    'config': {'members': members, 'moves': moves, 'target': db_file},
+    'routes': {kind: Summarize(t) for kind, t in timings.items()},
+  }
+
+
+def _RunGames(args) -> dict:
+  tempdir = None
+  if args.url:
+    transport = HttpTransport(args.url)
+  else:
+    from what2pick import what2pick_server
+    db_file = args.db
+    if db_file is None:
+      tempdir = tempfile.mkdtemp()
+      db_file = os.path.join(tempdir, 'storage.db')
+    transport = InProcessTransport(
+      what2pick_server.CreateApp(
+        db_file, args.shards, group_commit=args.group_commit,
+        admit=args.admission))
+  try:
+    report = Run(transport, args.games, args.players, args.watchers,
+                 args.adds, args.seed, traced=not args.url)
+  finally:
+    if tempdir:
+      os.system(f'rm -rf {tempdir}')
+  report['config']['target'] = args.url or args.db or 'temporary file'
+  return report
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description='Plays concurrent what2pick games and reports latencies.')
+  parser.add_argument('--games', type=int, default=10)
+  parser.add_argument('--players', type=int, default=4)
+  parser.add_argument('--watchers', type=int, default=4)
+  parser.add_argument('--adds', type=int, default=2,
+                      help='options each player adds before removals start')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--url', help='benchmark a running server instead')
+  parser.add_argument('--db', help='database file for the in-process app; '
+                                   'defaults to a fresh temporary file, '
+                                   f'or {sql_storage.MEMORY} for no sqlite')
+  parser.add_argument('--shards', type=int, default=1)
+  parser.add_argument('--group-commit', type=float, default=0,
+                      help='seconds of writes to batch into one commit')
+  parser.add_argument('--admission', action='store_true',
+                      help='apply the server\'s rate limits in-process; every '
+                           'in-process client shares one address')
+  parser.add_argument('--large-room', type=int, metavar='MEMBERS',
+                      help='instead time moves in one game with this many '
+                           'players and as many watchers')
+  parser.add_argument('--moves', type=int, default=1000,
+                      help='skips, and twice the removals, to time with '
+                           '--large-room')
+  parser.add_argument('--output', help='write the JSON report here')
+  args = parser.parse_args()
+
+  if args.large_room:
+    report = LargeRoom(args.large_room, args.moves,
+                       args.db or sql_storage.MEMORY, args.seed)
+  else:
+    report = _RunGames(args)
+  text = json.dumps(report, indent=2, sort_keys=True)
+  if args.output:
+    with open(args.output, 'w') as f:
+      f.write(text + '\n')
+  print(text)
+
+
+if __name__ == '__main__':
+  main()
@@ -1,42 +1,152 @@
 
 import datetime
+import collections
+import contextvars
+import difflib
 import flask
+import hashlib
 import jinja2
 import logging
-import time
 import threading
+import time
 import uuid
 
 from impulse.util import resources
 from pylib.web import clask
 from pylib.web import gunicorn
 from pylib.web import http
+from what2pick import admission
+from what2pick import assets
+from what2pick import metrics
+from what2pick import notifications
 from what2pick import user_dao
 from what2pick import pays_hoff_dao
+from what2pick import sql_storage
 
 
-class AutoReloader:
-  def __init__(self):
-    self._condition = threading.Condition()
+REQUEST_SECONDS = metrics.REGISTRY.Histogram(
+  'what2pick_request_seconds', 'Time spent handling each request.',
+  ('method', 'route', 'status'))
+RENDER_SECONDS = metrics.REGISTRY.Histogram(
+  'what2pick_render_seconds', 'Time spent rendering templates.',
+  ('template',))
+SQL_SECONDS = metrics.REGISTRY.Histogram(
+  'what2pick_sql_seconds', 'Time spent in sqlite execute and commit calls.',
+  ('kind', 'table'))
 
-  def notify_task_completion(self):
-    with self._condition:
-      self._condition.notify_all()
+# Statements issued by the current request, when it asked for a SQL trace.
+# A context variable rather than a thread local: under gevent, requests share
+# the thread, and this is made before main patches threading.
+_sql_trace = contextvars.ContextVar('sql_trace', default=None)
 
-  def wait_for_notice(self):
-    try:
-      with self._condition:
-        self._condition.wait(timeout=60)
-    except:
-      time.sleep(30)
+
+def DiffGameState(old:dict, new:dict) -> dict:
+  '''Returns the fields of |new| that differ from |old|.
+
+  Options are sent as [start, end, replacement] edits against the old list,
+  ordered so that applying them back to front keeps the indices valid.
+  '''
+  diff = {}
+  for key, value in new.items():
+    if old.get(key) == value:
+      continue
+    if key != 'options':
+      diff[key] = value
+      continue
+    matcher = difflib.SequenceMatcher(a=old.get(key, []), b=value)
+    diff[key] = [[i1, i2, value[j1:j2]]
+      for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != 'equal']
+  return diff
+
+
+class RenderCache():
+  '''An LRU of rendered pages, keyed by the strong ETag each was served with.
+
+  ETags hash a per-process epoch with the caller's key, so a page cached by a
+  previous process, whose versions started over, is never taken as current.
+  '''
+  def __init__(self, capacity:int = 2048):
+    self._lock = threading.Lock()
+    self._pages = collections.OrderedDict()
+    self._capacity = capacity
+    self._epoch = uuid.uuid4().hex
+
+  def ETag(self, key:tuple) -> str:
+    return hashlib.blake2b(
+      repr((self._epoch, key)).encode(), digest_size=16).hexdigest()
+
+  def Get(self, etag:str) -> bytes|None:
+    with self._lock:
+      if page := self._pages.get(etag):
+        self._pages.move_to_end(etag)
+      return page
+
+  def Put(self, etag:str, page:bytes) -> bytes:
+    with self._lock:
+      self._pages[etag] = page
+      self._pages.move_to_end(etag)
+      while len(self._pages) > self._capacity:
+        self._pages.popitem(last=False)
+      return page
 
 
 class Application(clask.Clask):
-  def __init__(self, db_file:str):
+  def __init__(self, db_file:str, game_shards:int = 1, notifier=None,
+               group_commit:float = 0, max_waiters:int = 1024):
     super().__init__()
-    self._users = user_dao.UserDAO(db_file)
-    self._payshoff = pays_hoff_dao.PaysHoffDAO(db_file)
-    self._autoreloads = {}
+    self._max_waiters = max_waiters
+    self._users = user_dao.UserDAO(db_file, group_commit=group_commit)
+    self._payshoff = pays_hoff_dao.PaysHoffDAO(
+      db_file, shards=game_shards, group_commit=group_commit)
+    self._autoreloads = notifications.NotificationRegistry()
+    self._events = notifications.EventHub()
+    self._notify_locks = [threading.Lock() for _ in range(64)]
+    self._renders = RenderCache()
+    self._notifier = notifier or notifications.LocalNotifier()
+    self._notifier.Start(self.OnRemoteChange)
+    metrics.REGISTRY.Gauge(
+      'what2pick_poll_waiters', 'Requests blocked in /poll.',
+      self._autoreloads.Waiters)
+    metrics.REGISTRY.Gauge(
+      'what2pick_event_subscribers', 'Open /events streams.',
+      self._events.SubscriberCount)
+    metrics.REGISTRY.Gauge(
+      'what2pick_game_cache', 'PaysHoffDAO game cache counters.',
+      lambda: {(k,): v for k, v in self._payshoff.CacheStats().items()},
+      ('stat',))
+    metrics.REGISTRY.Gauge(
+      'what2pick_sql_connections', 'Pooled sqlite connections.',
+      self.ConnectionCounts, ('database', 'state'))
+
+  def ConnectionCounts(self) -> dict:
+    counts = {}
+    for dbfile, pool in sql_storage.ConnectionPool.Pools().items():
+      stats = pool.Stats()
+      counts[(dbfile, 'open')] = stats['open']
+      counts[(dbfile, 'idle')] = stats['idle']
+    return counts
+
+  def Render(self, template:str, **context) -> flask.Response:
+    with RENDER_SECONDS.Time(template):
+      return flask.make_response(flask.render_template(template, **context))
+
+  def RenderCached(self, key:tuple, template:str, context) -> flask.Response:
+    '''Renders |template| once per |key|, answering If-None-Match with 304.
+
+    |key| must determine everything the page shows. |context| is only called
+    to build the template arguments when the page is not cached.
+    '''
+    etag = self._renders.ETag((template, *key))
+    if flask.request.if_none_match.contains(etag):
+      res = flask.make_response('', 304)
+    elif page := self._renders.Get(etag):
+      res = flask.make_response(page)
+    else:
+      page = self.Render(template, **context()).get_data()
+      res = flask.make_response(self._renders.Put(etag, page))
+    res.set_etag(etag)
+    res.headers['Cache-Control'] = 'private, no-cache'
+    return res
 
   def GetUser(self) -> user_dao.User|None:
     username = flask.request.cookies.get('uid')
@@ -60,37 +170,119 @@ class Application(clask.Clask):
     res.headers['Access-Control-Expose-Headers'] = 'Set-Cookie'
     return res
 
-  def NotifyReload(self, uuid):
-    if uuid in self._autoreloads:
-      self._autoreloads[uuid].notify_task_completion()
+  def GetSinceVersion(self) -> int|None:
+    since = (flask.request.headers.get('Last-Event-ID') or
+             flask.request.args.get('since'))
+    if not since:
+      return None
+    try:
+      return int(since)
+    except ValueError:
+      raise http.HttpException(
+        'since must be an integer', http.Code.BAD_REQUEST)
+
+  def SerializeGame(self, game:pays_hoff_dao.PaysHoff) -> dict:
+    game = self._payshoff.Copy(game)
+    users = self._users.GetUsernamesByUUIDs([*game.players, *game.watchers])
+    def Named(uids):
+      return [[str(uid), users[uid].name if uid in users else '']
+              for uid in uids]
+    return {
+      'admin': str(game.admin),
+      'next_player': str(game.next_player),
+      'decided': game.decided,
+      'kick_on_last_remove': game.kick_on_last_remove,
+      'must_add': [str(uid) for uid in game.must_add],
+      'options': list(game.options),
+      'players': Named(game.players),
+      'watchers': Named(game.watchers),
+    }
+
+  def ViewerFlags(self, game:pays_hoff_dao.PaysHoff,
+                  user:user_dao.User) -> dict:
+    '''What |user| may do in |game|; the membership checks are O(1).'''
+    am_current = (game.next_player == user.uid) and (not game.decided)
+    am_admin = game.admin == user.uid and (not game.decided)
+    return {
+      'am_current': am_current,
+      'am_admin': am_admin,
+      'am_watcher': user.uid in game.watchers,
+      'can_add': am_current,
+      'can_remove': (am_current and user.uid not in game.must_add) or am_admin,
+      'can_select': (am_current and not game.must_add
+                     and len(game.options) == 1),
+    }
+
+  def NotifyReload(self, uuid, publish:bool = True):
+    # Reading the game under its lock keeps recorded states in version order
+    # when two moves on the same game land at once; other games go ahead.
+    with self._notify_locks[hash(uuid) % len(self._notify_locks)]:
+      state = self.SerializeGame(self._payshoff.GetGameById(uuid))
+      version = self._autoreloads.Notify(uuid, state)
+    self._events.Publish(uuid, 'reload', str(version), eventid=version)
+    if publish:
+      self._notifier.Publish(str(uuid), version)
+
+  def ReloadGamesOf(self, uid:uuid.UUID, publish:bool = True):
+    '''Re-serializes the cached games showing the name of user |uid|.'''
+    for gid in self._payshoff.CachedGamesOf(uid):
+      self.NotifyReload(gid, publish)
+
+  def OnRemoteChange(self, gid:str, version:int):
+    '''Wakes local clients after another worker changed game |gid|.
+
+    The state is serialized again by whichever request asks for it first.
+    A key of user/<uid> instead means that user was renamed. The games cached
+    here that show the name are reloaded, without publishing them again.
+    '''
+    if gid.startswith('user/'):
+      uid = uuid.UUID(gid.removeprefix('user/'))
+      self._users.Forget(uid)
+      self.ReloadGamesOf(uid, publish=False)
+      return
+    gid = uuid.UUID(gid)
+    self._payshoff.Forget(gid)
+    version = self._autoreloads.Notify(gid, after=version)
+    self._events.Publish(gid, 'reload', str(version), eventid=version)
+
+  def NamesInGame(self, gid:str|None) -> set:
+    '''The names of everyone in game |gid|, if there is such a game.'''
+    try:
+      game = gid and self._payshoff.GetGameById(uuid.UUID(gid), noexcept=True)
+    except ValueError:
+      return set()
+    if not game:
+      return set()
+    game = self._payshoff.Copy(game)
+    users = self._users.GetUsernamesByUUIDs([*game.players, *game.watchers])
+    return {user.name for user in users.values()}
 
-  def Wait(self, uuid):
-    if uuid not in self._autoreloads:
-      self._autoreloads[uuid] = AutoReloader()
-    self._autoreloads[uuid].wait_for_notice()
+  def Wait(self, uuid, since:int|None = None) -> int:
+    '''Raises notifications.TooManyWaiters past |max_waiters| per game.'''
+    return self._autoreloads.Wait(
+      uuid, since, max_waiters=self._max_waiters)
 
   @clask.Clask.Route(path='/')
   def Index(self):
     user = self.GetUser()
     user_is_logged_in:bool = (user != None)
     username:str = user.name if user else ""
-    res = flask.make_response(flask.render_template(
-      'index.html',
-      user_is_logged_in = user_is_logged_in,
-      username = username
-    ))
+    res = self.RenderCached(
+      (user_is_logged_in, username), 'index.html', lambda: dict(
+        user_is_logged_in = user_is_logged_in,
+        username = username,
+      ))
     return self.SaveLogin(res, user)
 
   @clask.Clask.Route(path='/signup/<redir>')
   def CreateUser(self, redir:str):
     user = self.GetUser()
+    game_id = flask.request.args.get('gid') if redir == 'p' else None
     if not user:
-      user = self._users.CreateUser()
+      user = self._users.CreateUser(self.NamesInGame(game_id))
     location = '/'
-    if redir == 'p':
-      game_id = flask.request.args.get('gid')
-      if game_id:
-        location = f'/p/{game_id}'
+    if game_id:
+      location = f'/p/{game_id}'
     return self.SaveLogin(
       flask.redirect(location, http.Code.TEMPORARY_REDIRECT), user)
 
@@ -100,6 +292,8 @@ class Application(clask.Clask):
     name = name[:16].strip()
     if name:
       user = self._users.ChangeUsername(user.uid, user.pwd, name)
+      self._notifier.Publish(f'user/{user.uid}', 0)
+      self.ReloadGamesOf(user.uid)
     res = flask.make_response('OK')
     return self.SaveLogin(res, user)
 
@@ -118,8 +312,7 @@ class Application(clask.Clask):
     gid = uuid.UUID(gid)
     user = self.GetUser()
     if not user:
-      return flask.make_response(flask.render_template(
-        'payshoff.html',
+      return self.RenderCached((gid,), 'payshoff.html', lambda: dict(
         game_id = gid,
         user_is_logged_in = False))
     game, trigger_update = self._payshoff.JoinGame(gid, user.uid)
@@ -127,33 +320,42 @@ class Application(clask.Clask):
       res = flask.make_response('OK', 302)
       res.headers['Location'] = f'/p/{game.gameid}'
       return self.SaveLogin(res, user)
-    am_current = (game.next_player == user.uid) and (not game.decided)
-    am_admin = game.admin == user.uid and (not game.decided)
-    can_remove = (am_current and (user.name not in game.must_add)) or am_admin
-    can_select = am_current and (not game.must_add) and len(game.options) == 1
-    current_player = self._users.GetUsernameByUUID(game.next_player)
-    players = [self._users.GetUsernameByUUID(uid) for uid in game.players]
-    watchers = [self._users.GetUsernameByUUID(uid) for uid in game.watchers]
-    res = flask.make_response(flask.render_template(
-      'payshoff.html',
-      user_is_logged_in = True,
-      username = user.name,
-      gameoptions = game.options,
-      can_remove = can_remove,
-      can_add = am_current,
-      can_select = can_select,
-      decided = game.decided,
-      game_id = game.gameid,
-      current_player = current_player,
-      am_admin = am_admin,
-      players = players,
-      watchers = watchers,
-      am_watcher = (user in game.watchers),
-      kick_on_remove = game.kick_on_last_remove,
-      debug_info = f'{user}\n{game}',
-    ))
     if trigger_update:
       self.NotifyReload(gid)
+    # Read after the join, and before the game is rendered, so the page is
+    # never older than the version it claims.
+    version = self._autoreloads.Version(gid)
+    flags = self.ViewerFlags(game, user)
+    am_current, am_admin = flags['am_current'], flags['am_admin']
+    can_remove, can_select = flags['can_remove'], flags['can_select']
+    am_watcher = flags['am_watcher']
+    # Everything below depends on the game, which |version| stands for, or on
+    # these few flags and the viewer's name; most viewers share a page.
+    role = (am_current, am_admin, can_remove, can_select, am_watcher)
+    def Context():
+      shown = self._payshoff.Copy(game)
+      users = self._users.GetUsernamesByUUIDs(
+        [shown.next_player, *shown.players, *shown.watchers])
+      return dict(
+        user_is_logged_in = True,
+        username = user.name,
+        gameoptions = shown.options,
+        can_remove = can_remove,
+        can_add = am_current,
+        can_select = can_select,
+        decided = shown.decided,
+        game_id = shown.gameid,
+        version = version,
+        current_player = users.get(shown.next_player),
+        am_admin = am_admin,
+        players = [users.get(uid) for uid in shown.players],
+        watchers = [users.get(uid) for uid in shown.watchers],
+        am_watcher = am_watcher,
+        kick_on_remove = shown.kick_on_last_remove,
+        debug_info = f'{shown}',
+      )
+    res = self.RenderCached(
+      (gid, version, role, user.name), 'payshoff.html', Context)
     return self.SaveLogin(res, user)
 
   @clask.Clask.Route(path='/p/<gid>/add', method=http.Method.POST)
@@ -207,23 +409,184 @@ class Application(clask.Clask):
     self.NotifyReload(gid)
     return self.SaveLogin(flask.make_response('OK', 200), user)
 
+  @clask.Clask.Route(path='/p/<gid>/state')
+  def GetGameState(self, gid):
+    gid = uuid.UUID(gid)
+    user = self.RequireUser()
+    since = self.GetSinceVersion()
+    game = self._payshoff.GetGameById(gid)
+    version, state = self._autoreloads.Latest(gid)
+    if state is None:
+      state = self._autoreloads.Record(gid, version, self.SerializeGame(game))
+    body = {'version': version, 'viewer': self.ViewerFlags(game, user)}
+    previous = None
+    if since is not None:
+      previous = self._autoreloads.State(gid, since)
+    if previous is None:
+      body['state'] = state
+    else:
+      body['diff'] = DiffGameState(previous, state)
+    return self.SaveLogin(flask.jsonify(body), user)
+
+  @clask.Clask.Route(path='/p/<gid>/moves')
+  def GetGameMoves(self, gid):
+    '''The moves made after move ?after=N, for clients replaying the game.
+
+    N is a move number, not a version: versions count notices, which need
+    not match moves one to one.
+    '''
+    gid = uuid.UUID(gid)
+    user = self.RequireUser()
+    try:
+      after = int(flask.request.args.get('after', 0))
+    except ValueError:
+      raise http.HttpException(
+        'after must be an integer', http.Code.BAD_REQUEST)
+    self._payshoff.GetGameById(gid)
+    moves = [m.ToJson() for m in self._payshoff.GetMoves(gid, after)]
+    return self.SaveLogin(flask.jsonify({'moves': moves}), user)
+
   @clask.Clask.Route(path='/p/<gid>/poll')
   def AwaitRefreshNotice(self, gid):
     gid = uuid.UUID(gid)
+    since = self.GetSinceVersion()
     if game := self._payshoff.GetGameById(gid):
-      self.Wait(gid)
-      return 'reload', 200
+      try:
+        return str(self.Wait(gid, since)), 200
+      except notifications.TooManyWaiters:
+        return admission.TooManyRequests(5)
     raise http.HttpException.NotFound(gid)
 
+  @clask.Clask.Route(path='/p/<gid>/events')
+  def StreamGameEvents(self, gid):
+    gid = uuid.UUID(gid)
+    since = self.GetSinceVersion()
+    self._payshoff.GetGameById(gid)
+    def CatchUp():
+      # Like Wait, anything but the current version is stale: one from
+      # another worker or from before a restart may compare higher.
+      version = self._autoreloads.Version(gid)
+      if since is not None and version != since:
+        yield ('reload', str(version), version)
+    return flask.Response(
+      self._events.Stream(gid, CatchUp),
+      mimetype='text/event-stream',
+      headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+  @clask.Clask.Route(path='/metrics')
+  def ExportMetrics(self):
+    return flask.Response(metrics.REGISTRY.Render(),
+                          mimetype='text/plain; version=0.0.4')
+
+
+def _TimeStatement(query:str, seconds:float):
+  SQL_SECONDS.Observe(seconds, *sql_storage.DescribeStatement(query))
+
+
+def _TraceStatement(query:str):
+  if (statements := _sql_trace.get()) is not None:
+    statements.append(query)
+
+
+def _StartRequest():
+  flask.g.request_start = time.perf_counter()
+  _sql_trace.set([] if flask.request.headers.get('X-Trace-SQL') else None)
+
+
+def _FinishRequest(response:flask.Response) -> flask.Response:
+  rule = flask.request.url_rule
+  REQUEST_SECONDS.Observe(
+    time.perf_counter() - flask.g.request_start, flask.request.method,
+    rule.rule if rule else '<unmatched>', str(response.status_code))
+  statements = _sql_trace.get()
+  _sql_trace.set(None)
+  for statement in statements or ():
+    response.headers.add('X-SQL-Trace', ' '.join(statement.split()))
+  return response
+
+
+def DefaultAdmission(room_size:int = 1024) -> admission.Admission:
+  '''Limits on the routes a looping or misbehaving client can hammer.
+
+  Every member of a game re-polls when it changes, so the per-game poll
+  budget grows with |room_size|, the most members a game is expected to
+  have watching at once.
+  '''
+  limits = admission.Admission()
+  client_moves = admission.TokenBuckets(rate=5, burst=20)
+  game_moves = admission.TokenBuckets(rate=20, burst=60)
+  for action in ('add', 'del', 'sel', 'adm_skip', 'adm_kick',
+                 'toggle_dec_mode'):
+    limits.Limit('POST', f'/p/<gid>/{action}', client_moves, game_moves)
+  client_polls = admission.TokenBuckets(rate=2, burst=10)
+  game_polls = admission.TokenBuckets(rate=room_size, burst=2 * room_size)
+  for action in ('poll', 'events'):
+    limits.Limit('GET', f'/p/<gid>/{action}', client_polls, game_polls)
+  return limits
+
+
+def MigrateSchema(db_file:str, game_shards:int = 1) -> list:
+  '''Brings the database up to date before any request is served.'''
+  if db_file == sql_storage.MEMORY:
+    return []
+  steps = sql_storage.Migrate(db_file, user_dao.UserDAO.TABLES)
+  steps += sql_storage.Migrate(
+    db_file, pays_hoff_dao.PaysHoffDAO.TABLES, game_shards)
+  for step in steps:
+    logging.info('schema migration: %s', step)
+  return steps
+
+
+def CreateApp(db_file:str = 'storage.db', game_shards:int = 1,
+              trace_sql:bool = False, notify_dir:str|None = None,
+              group_commit:float = 0, admit:bool = True,
+              room_size:int = 1024):
+  '''Builds the app. |trace_sql| lets requests carrying an X-Trace-SQL header
+  get every statement they issued back as X-SQL-Trace response headers;
+  the statements include bound values, so leave it off in production.
+
+  Workers sharing a |notify_dir| wake each other's pollers, which lets one
+  box run several gunicorn workers against the same database. A non-zero
+  |group_commit| batches writes arriving within that many seconds into one
+  commit; see SQLStorageBase. |admit| applies DefaultAdmission's limits.
 
-def CreateApp():
+  |room_size| is how many members of one game may be waiting on it at once,
+  per worker; it sizes the long-poll waiter cap and the per-game poll limit.
+  '''
   content = f'{resources.Resources.Dir()}/what2pick/frontend'
   app = flask.Flask(__name__, static_folder=content, template_folder=content)
-  Application.Launch(app, 'storage.db')
+  assets.AssetBundle(content).Install(app)
+  notifier = None
+  if notify_dir:
+    notifier = notifications.SocketNotifier(notify_dir)
+  MigrateSchema(db_file, game_shards)
+  Application.Launch(
+    app, db_file, game_shards, notifier, group_commit, room_size)
+  app.before_request(_StartRequest)
+  app.after_request(_FinishRequest)
+  if admit:
+    DefaultAdmission(room_size).Install(app)
+  sql_storage.ConnectionPool.Time(_TimeStatement)
+  if trace_sql:
+    sql_storage.ConnectionPool.Trace(_TraceStatement)
   return app
 
 
 def main():
   logging.getLogger('eventlet').disabled = True #(logging.ERROR)
   logging.getLogger('werkzeug').disabled = True #(logging.ERROR)
-  gunicorn.GunicornHost(CreateApp(), {'bind': '0.0.0.0:5000'}).run()
+  # Open /events streams and /poll waits park on threading events and
+  # conditions. Patched to gevent's, a parked subscriber is a greenlet
+  # waiting on its socket rather than a thread, so a worker holds as many as
+  # it has connections. The patch must come before CreateApp starts threads
+  # or makes the locks they wait on; locks made at import are never held
+  # across a switch. sqlite calls do not yield, so each worker runs its
+  # queries one at a time.
+  from gevent import monkey
+  monkey.patch_all()
+  gunicorn.GunicornHost(CreateApp(), {
+    'bind': '0.0.0.0:5000',
+    'worker_class': 'gevent',
+    'worker_connections': 10000,
+  }).run()
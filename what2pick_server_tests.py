@@ -0,0 +1,162 @@
+
+import sys
+import threading
+import uuid
+
+import flask
+
+from impulse.testing import unittest
+from what2pick import sql_storage
+from what2pick import user_dao
+from what2pick import what2pick_server
+
+
+class DiffGameStateUnittests(unittest.TestCase):
+  def test_changedFieldsOnly(self):
+    old = {'decided': False, 'next_player': 'a', 'options': ['x', 'y']}
+    new = {'decided': False, 'next_player': 'b', 'options': ['x', 'y']}
+    self.assertEqual({'next_player': 'b'},
+                     what2pick_server.DiffGameState(old, new))
+
+  def test_optionEditsApplyBackToFront(self):
+    old = {'options': ['a', 'b', 'c', 'd']}
+    new = {'options': ['a', 'c', 'd', 'e']}
+    diff = what2pick_server.DiffGameState(old, new)
+    options = list(old['options'])
+    for start, end, replacement in reversed(diff['options']):
+      options[start:end] = replacement
+    self.assertEqual(new['options'], options)
+
+
+class SqlTraceUnittests(unittest.TestCase):
+  def test_onlyTheTracedRequestsStatements(self):
+    app = flask.Flask(__name__)
+    with app.test_request_context('/', headers={'X-Trace-SQL': '1'}):
+      what2pick_server._StartRequest()
+      what2pick_server._TraceStatement('SELECT 1')
+      other = threading.Thread(
+        target=what2pick_server._TraceStatement, args=('SELECT 2',))
+      other.start()
+      other.join()
+      res = what2pick_server._FinishRequest(flask.Response('OK'))
+    self.assertEqual(['SELECT 1'], res.headers.getlist('X-SQL-Trace'))
+    with app.test_request_context('/'):
+      what2pick_server._StartRequest()
+      what2pick_server._TraceStatement('SELECT 3')
+      res = what2pick_server._FinishRequest(flask.Response('OK'))
+    self.assertEqual([], res.headers.getlist('X-SQL-Trace'))
+
+
+class ApplicationUnittests(unittest.TestCase):
+  def setup(self):
+    self._app = what2pick_server.Application(sql_storage.MEMORY)
+    self._users = self._app._users
+    self._games = self._app._payshoff
+
+  def test_notifyReloadDoesNotBlockOtherGames(self):
+    admin = self._users.CreateUser()
+    first = self._games.CreateGame(admin.uid).gameid
+    stripes = len(self._app._notify_locks)
+    second = first
+    while hash(second) % stripes == hash(first) % stripes:
+      second = self._games.CreateGame(admin.uid).gameid
+    serializing, release = threading.Event(), threading.Event()
+    serialize = self._app.SerializeGame
+    def SlowSerialize(game):
+      if game.gameid == first:
+        serializing.set()
+        release.wait(5)
+      return serialize(game)
+    self._app.SerializeGame = SlowSerialize
+    slow = threading.Thread(target=self._app.NotifyReload, args=(first,))
+    slow.start()
+    try:
+      serializing.wait(5)
+      before = self._app._autoreloads.Version(second)
+      self._app.NotifyReload(second)
+      self.assertGreater(self._app._autoreloads.Version(second), before)
+      self.assertTrue(slow.is_alive())
+    finally:
+      release.set()
+      slow.join()
+
+  def test_remoteRenamesAreForgotten(self):
+    user = self._users.CreateUser()
+    self._users.GetUsernamesByUUIDs([user.uid])
+    row, = self._users.GetAll(user_dao.User, uid=user.uid)
+    row.name = 'Someone Else'
+    self._users.Update(row)
+    self._app.OnRemoteChange(f'user/{user.uid}', 0)
+    self.assertEqual('Someone Else',
+                     self._users.GetUsernamesByUUIDs([user.uid])[user.uid].name)
+
+  def test_renamesReloadGamesShowingTheName(self):
+    admin, other = self._users.CreateUser(), self._users.CreateUser()
+    shown = self._games.CreateGame(admin.uid).gameid
+    elsewhere = self._games.CreateGame(other.uid).gameid
+    before = [self._app._autoreloads.Version(gid)
+              for gid in (shown, elsewhere)]
+    self._users.ChangeUsername(admin.uid, admin.pwd, 'Someone Else')
+    self._app.OnRemoteChange(f'user/{admin.uid}', 0)
+    self.assertGreater(self._app._autoreloads.Version(shown), before[0])
+    self.assertEqual(before[1], self._app._autoreloads.Version(elsewhere))
+    _, state = self._app._autoreloads.Latest(shown)
+    self.assertIn('Someone Else', str(state))
+
+  def test_movesAreListedAfterAMoveNumber(self):
+    admin = self._users.CreateUser()
+    gid = self._games.CreateGame(admin.uid).gameid
+    for option in ('pizza', 'tacos'):
+      self._games.AddOption(gid, admin.uid, option)
+    self._app.GetUser = lambda: admin
+    app = flask.Flask(__name__)
+    for query, expected in (('', [1, 2]), ('?after=1', [2]),
+                            ('?since=1', [1, 2])):
+      with app.test_request_context(f'/p/{gid}/moves{query}',
+                                    headers={'Last-Event-ID': '2'}):
+        moves = self._app.GetGameMoves(str(gid)).get_json()['moves']
+        self.assertEqual(expected, [move['seq'] for move in moves])
+
+  def test_serializingRacesMoves(self):
+    admin = self._users.CreateUser()
+    gid = self._games.CreateGame(admin.uid).gameid
+    players = [uuid.uuid4() for _ in range(1000)]
+    for player in players:
+      self._games.JoinGame(gid, player)
+    done, errors = threading.Event(), []
+    def Serialize():
+      game = self._games.GetGameById(gid)
+      while not done.is_set():
+        try:
+          self._app.SerializeGame(game)
+        except Exception as e:
+          errors.append(e)
+          return
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    reader = threading.Thread(target=Serialize)
+    reader.start()
+    try:
+      for player in players:
+        self._games.SetPlayerToWatcher(gid, player, admin.uid)
+    finally:
+      done.set()
+      reader.join()
+      sys.setswitchinterval(interval)
+    self.assertEqual([], errors)
+
+  def test_eventsCatchUpFromForeignVersions(self):
+    admin = self._users.CreateUser()
+    gid = self._games.CreateGame(admin.uid).gameid
+    version = self._app._autoreloads.Notify(gid)
+    app = flask.Flask(__name__)
+    for since, expected in ((version, ': keepalive\n\n'),
+                            (version - 1, f'id: {version}\n'),
+                            (version << 8, f'id: {version}\n')):
+      with app.test_request_context(f'/p/{gid}/events',
+                                    headers={'Last-Event-ID': str(since)}):
+        self._app._events._keepalive = 0
+        stream = self._app.StreamGameEvents(str(gid)).response
+        self.assertEqual('retry: 3000\n\n', next(stream))
+        self.assertEqual(expected, next(stream))
+        stream.close()